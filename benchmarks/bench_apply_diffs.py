@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""
+Benchmark of manifest replay (fsutil.apply_diffs). Builds a manifest of
+--files entries and replays --diffs diffs of --changes changes each over it,
+a mix of new, changed, moved and deleted files.
+
+The previous implementation, which rebuilt the whole manifest list for every
+diff, can be run for comparison with --legacy. It is O(diffs x files) so
+should only be used with small sizes.
+
+    python benchmarks/bench_apply_diffs.py --files 1000000 --diffs 10000
+"""
+import argparse, copy, random, time, sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rrbackup.fsutil as sfs
+
+def legacy_apply_diffs(diffs, manifest):
+    manifest = copy.deepcopy(manifest)
+    key_filter = lambda item : { key : value for key, value in item.items() if key != 'status'}
+
+    for diff in diffs:
+        manifest_dict = {item['path'] : None for item in manifest}
+        moved = {change['moved_from'] : None for change in diff if change['status'] == 'moved'}
+        deleted = {item['path'] : None for item in diff
+            if item['status'] in ['deleted', 'changed', 'moved'] or item['path'] in manifest_dict}
+
+        applied = [key_filter(item) for item in manifest
+            if  item['path'] not in deleted and item['path'] not in moved]
+        applied += [key_filter(item) for item in diff if item['status'] in ['new', 'changed', 'moved']]
+        manifest = applied
+
+    return manifest
+
+def make_item(path, i):
+    return {'path'       : path,
+            'created'    : 1500000000.0 + i,
+            'last_mod'   : 1500000000.0 + i,
+            'hash'       : '%064x' % i,
+            'real_path'  : path,
+            'version_id' : 'v%032d' % i}
+
+def generate(n_files, n_diffs, n_changes, seed):
+    """ Returns the initial manifest and a generator of diffs, diffs are generated
+    lazily so that memory use is dominated by the manifest being replayed. """
+    manifest = [make_item('/dir%d/file%d' % (i % 1000, i), i) for i in range(n_files)]
+
+    def diffs():
+        rnd = random.Random(seed)
+        live = [item['path'] for item in manifest]
+        counter = n_files
+        for _ in range(n_diffs):
+            diff = []; touched = set()
+            for _ in range(n_changes):
+                op = rnd.random(); counter += 1
+                idx = rnd.randrange(len(live)) if live else 0
+
+                # a diff never contains more than one change to the same path
+                if op < 0.4 or len(live) < 2 or live[idx] in touched:
+                    path = '/new%d/file%d' % (counter % 1000, counter)
+                    live.append(path)
+                    change = make_item(path, counter); change['status'] = 'new'
+                else:
+                    if op < 0.8:
+                        change = make_item(live[idx], counter); change['status'] = 'changed'
+                    elif op < 0.9:
+                        path = '/moved%d/file%d' % (counter % 1000, counter)
+                        change = make_item(path, counter)
+                        change['status'] = 'moved'; change['moved_from'] = live[idx]
+                        live[idx] = path
+                    else:
+                        change = {'path' : live[idx], 'status' : 'deleted'}
+                        live[idx] = live[-1]; live.pop()
+                touched.add(change['path'])
+                if 'moved_from' in change: touched.add(change['moved_from'])
+                diff.append(change)
+            yield diff
+
+    return manifest, diffs
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark manifest replay')
+    parser.add_argument('--files',   type = int, default = 1000000)
+    parser.add_argument('--diffs',   type = int, default = 10000)
+    parser.add_argument('--changes', type = int, default = 10)
+    parser.add_argument('--seed',    type = int, default = 1)
+    parser.add_argument('--legacy',  action = 'store_true', help = 'also time the previous implementation')
+    args = parser.parse_args()
+
+    manifest, diffs = generate(args.files, args.diffs, args.changes, args.seed)
+    print('%d files, %d diffs of %d changes' % (args.files, args.diffs, args.changes))
+
+    start = time.time()
+    result = sfs.apply_diffs(diffs(), manifest)
+    print('apply_diffs:        %.2fs, %d files' % (time.time() - start, len(result)))
+
+    if args.legacy:
+        start = time.time()
+        legacy = legacy_apply_diffs(diffs(), manifest)
+        print('legacy apply_diffs: %.2fs, %d files' % (time.time() - start, len(legacy)))
+
+        key = lambda item: item['path']
+        if sorted(result, key = key) != sorted(legacy, key = key): raise SystemExit('Results differ')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""
+Benchmark of large object downloads (s3_interface.ranged_download) against a
+single streaming GET (s3_interface.streaming_download). S3 is replaced by a
+local stand-in which serves every request with a fixed --latency and at most
+--bandwidth MB/s, as a single connection to S3 is limited in the same way.
+
+    python benchmarks/bench_ranged_get.py --size 256 --workers 1 2 4 8
+"""
+import argparse, io, os, struct, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rrbackup.pipeline as pipeline
+import rrbackup.s3_interface as s3_interface
+
+class throttled_body:
+    """ Response body which is read no faster than 'bandwidth' bytes per second """
+    def __init__(self, data, bandwidth):
+        self.body = io.BytesIO(data); self.bandwidth = bandwidth
+
+    def read(self, size = -1):
+        res = self.body.read(size)
+        time.sleep(len(res) / self.bandwidth)
+        return res
+
+class throttled_client:
+    """ Serves a single object, every request costs 'latency' seconds before the first byte """
+    class exceptions:
+        class NoSuchKey(Exception): pass
+
+    def __init__(self, data, latency, bandwidth):
+        self.data = data; self.latency = latency; self.bandwidth = bandwidth
+
+    def get_object(self, Bucket, Key, VersionId = None, Range = None):
+        time.sleep(self.latency)
+        res = {'VersionId' : 'v1', 'ContentType' : '', 'Metadata' : {}, 'LastModified' : None}
+        data = self.data
+        if Range is not None:
+            first, last = (int(i) for i in Range.split('=')[1].split('-'))
+            last = min(last, len(data) - 1); data = data[first : last + 1]
+            res['ContentRange'] = 'bytes %d-%d/%d' % (first, last, len(self.data))
+        res['Body'] = throttled_body(data, self.bandwidth); res['ContentLength'] = len(data)
+        return res
+
+def make_object(size, chunk_size):
+    header = pipeline.serialise_pipeline_format({'version' : 1, 'chunk_size' : chunk_size, 'format' : {}})
+    return struct.pack('!I', len(header)) + header + os.urandom(size)
+
+def run(download, conn):
+    start = time.time(); total = 0
+    download.begin(conn, 'key', None)
+    while True:
+        chunk = download.next_chunk()
+        if chunk is None: break
+        total += len(chunk)
+    return total, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size',       type = int,   default = 128,  help = 'object size in MB')
+    parser.add_argument('--chunk-size', type = int,   default = 5,    help = 'pipeline chunk size in MB')
+    parser.add_argument('--part-size',  type = int,   default = 16,   help = 'ranged GET part size in MB')
+    parser.add_argument('--latency',    type = float, default = 0.05, help = 'seconds before the first byte of each request')
+    parser.add_argument('--bandwidth',  type = float, default = 50,   help = 'MB/s of each connection')
+    parser.add_argument('--workers',    type = int,   default = [2, 4, 8], nargs = '+')
+    args = parser.parse_args()
+
+    mb = 1048576
+    conn = {'client' : throttled_client(make_object(args.size * mb, args.chunk_size * mb),
+                                        args.latency, args.bandwidth * mb),
+            'bucket' : 'bucket'}
+
+    total, elapsed = run(s3_interface.streaming_download(), conn)
+    print('single GET        %7.2fs  %8.1f MB/s' % (elapsed, total / mb / elapsed))
+
+    for workers in args.workers:
+        total, elapsed = run(s3_interface.ranged_download(workers, args.part_size * mb), conn)
+        print('ranged, %2d workers %6.2fs  %8.1f MB/s' % (workers, elapsed, total / mb / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
-import functools, time, datetime, fnmatch, os, json, fcntl
+import functools, itertools, tempfile, time, fnmatch, os, json, fcntl, bisect, threading
 import collections
 from termcolor import colored
 
 #---
 import rrbackup.pipeline as pipeline
 import rrbackup.crypto   as crypto
+import rrbackup.diff_cache as diff_cache
+import rrbackup.diff_codec as diff_codec
+import rrbackup.manifest_store as manifest_store
+import rrbackup.parallel as parallel
+import rrbackup.restore as restore
+import rrbackup.mount as mount_fs
+import rrbackup.retention as retention
+import rrbackup.verify as verify_objects
+import rrbackup.daemon as daemon
 from . import fsutil as sfs
 
 
@@ -13,6 +22,9 @@ def default_config(interface):
     """ The default configuration structure. """
     conf = { 'base_path'                      : None,             # The root from where the backup is performed
              'remote_manifest_diff_file'      : 'manifest_diffs', # Location of the remote manifest diffs
+             'remote_manifest_snapshot_file'  : 'manifest_snapshots', # Location of full manifest snapshots
+             'remote_manifest_baseline_file'  : 'manifest_baseline', # Manifest at the oldest version kept by prune
+             'remote_pruned_versions_file'    : 'pruned_versions',# Versions whose files have been removed by prune
              'remote_gc_log_file'             : 'gc_log',         # Location of the remote garbage collection log
              'remote_garbage_object_log_file' : 'garbage_objects',# Accumulating log of garbage objects
              'remote_base_path'               : 'files',          # The directory used to store files on S3
@@ -27,6 +39,22 @@ def default_config(interface):
              'ignore_files'                   : [],               # files to ignore
              'skip_delete'                    : [],               # files which should never be deleted from manifest
              'visit_mountpoints'              : True,             # Should files in a unix mount point be included in backup?
+             'manifest_encoding'              : 'json',           # Encoding of manifest diffs and snapshots, 'json' or 'compact'
+             'meta_fetch_concurrency'         : 8,                # Number of manifest diff versions fetched concurrently
+             'gc_list_concurrency'            : 8,                # Number of directories listed concurrently by garbage collection
+             'gc_delete_concurrency'          : 4,                # Number of batches of up to 1000 garbage objects deleted concurrently
+             'garbage_log_batch_segments'     : 100,              # Number of garbage log segments cleaned or merged at once
+             'ranged_get_workers'             : 4,                # Number of parts of a large file fetched concurrently, 1 disables
+             'ranged_get_part_size'           : 1048576 * 16,     # Size of each part fetched, files no larger than this use a single GET
+             'manifest_snapshot_diffs'        : 100,              # Write a full manifest snapshot after this many diffs, 0 disables
+             'manifest_snapshot_bytes'        : 1048576 * 50,     # or once this many bytes of diffs have been written, 0 disables
+             'change_detection'               : 'size_mtime',     # How changed files are detected, 'mtime', 'size_mtime' or 'ctime'
+             'detect_moves'                   : True,             # Record renamed and moved files as moves rather than delete and add
+             'low_memory_scan'                : False,            # Detect changes with bounded memory, requires the sqlite manifest store
+             'scan_run_size'                  : 1000000,          # Number of scanned files sorted in memory at once in low memory mode
+             'scan_spill_dir'                 : None,             # Directory for sorted runs of scan results, None uses the system default
+             'split_chunk_bytes'              : 0,                # Also split once the files to upload in a chunk total this many bytes, 0 disables
+             'split_chunk_seconds'            : 0,                # and commit once uploading a chunk has taken this many seconds, 0 disables
              'split_chunk_size'               : 0}                # The manifest can be split into smaller chunks to
                                                                   # allow large updates to recover more easily in case
                                                                   # of connection loss. As this system is inherently designed
@@ -35,6 +63,13 @@ def default_config(interface):
                                                                   # commit
 
     conf = interface.add_default_config(conf)
+    conf = diff_cache.add_default_config(conf)
+    conf = manifest_store.add_default_config(conf)
+    conf = restore.add_default_config(conf)
+    conf = mount_fs.add_default_config(conf)
+    conf = retention.add_default_config(conf)
+    conf = verify_objects.add_default_config(conf)
+    conf = daemon.add_default_config(conf)
     return crypto.add_default_config(conf)
 
 ###################################################################################
@@ -43,6 +78,16 @@ def validate_config(parsed_config):
     if 'file_pipeline' in parsed_config and not isinstance(parsed_config['file_pipeline'], list): raise SystemExit('file_pipeline in conf file mist be a list')
     if 'ignore_files'  in parsed_config and not isinstance(parsed_config['ignore_files'], list):  raise SystemExit('ignore_files in conf file mist be a list')
     if 'skip_delete'   in parsed_config and not isinstance(parsed_config['skip_delete'], list):   raise SystemExit('skip_delete in conf file mist be a list')
+    if 'manifest_encoding' in parsed_config and parsed_config['manifest_encoding'] not in ['json', 'compact']:
+        raise SystemExit("manifest_encoding in conf file must be 'json' or 'compact'")
+    manifest_store.validate_config(parsed_config)
+    restore.validate_config(parsed_config)
+    retention.validate_config(parsed_config)
+    daemon.validate_config(parsed_config)
+    if 'change_detection' in parsed_config and parsed_config['change_detection'] not in sfs.CHANGE_POLICIES:
+        raise SystemExit("change_detection in conf file must be one of " + ', '.join(sfs.CHANGE_POLICIES))
+    if 'low_memory_scan' in parsed_config and parsed_config['low_memory_scan'] and not manifest_store.is_indexed(parsed_config):
+        raise SystemExit("low_memory_scan requires local_manifest_store to be 'sqlite'")
 
 ###################################################################################
 def merge_config(config, parsed_config):
@@ -61,6 +106,7 @@ def new_manifest():
     """
 
     return { 'latest_remote_diff' : {},
+             'since_snapshot'     : {'diffs' : 0, 'bytes' : 0},
              'files'              : []}
 
 ###################################################################################
@@ -85,7 +131,10 @@ def init(interface, conn, config):
 ###################################################################################
 def write_json_to_remote(config, path : str, data_to_write):
     meta = {'path' : path, 'header' : pipeline.serialise_pipeline_format(meta_pl_format)}
-    return pl_out(json.dumps(data_to_write).encode('utf-8'), meta, config)
+    data = json.dumps(data_to_write, default = sfs.json_default).encode('utf-8')
+    meta = pl_out(data, meta, config)
+    meta['size'] = len(data)
+    return meta
 
 ###################################################################################
 def read_json_from_remote(config, path : str, version_id = None):
@@ -96,32 +145,72 @@ def read_json_from_remote(config, path : str, version_id = None):
     try: data, object_meta = pl_in(meta, config)
     except ValueError: return None, None
 
-    return json.loads(data), object_meta
+    return json.loads(data, object_hook = sfs.json_object_hook), object_meta
 
 
+###################################################################################
+def write_manifest_object(config, path : str, items, meta = None):
+    """ Write a manifest diff or snapshot, a list of manifest items with optional
+    metadata, to the remote using the configured encoding. The encoding is recorded
+    in the pipeline header. """
+
+    pl_format = {'version' : meta_pl_format['version'], 'format' : dict(meta_pl_format['format'])}
+
+    if 'manifest_encoding' in config and config['manifest_encoding'] == 'compact':
+        pl_format['format']['encoding'] = {'F' : diff_codec.FORMAT}
+        data = diff_codec.encode(items, meta)
+
+    elif meta is None: data = json.dumps(list(items), default = sfs.json_default).encode('utf-8')
+    else:              data = json.dumps(dict(meta, files = list(items)), default = sfs.json_default).encode('utf-8')
+
+    res = pl_out(data, {'path' : path, 'header' : pipeline.serialise_pipeline_format(pl_format)}, config)
+    res['size'] = len(data)
+    return res
 
 ###################################################################################
-def streaming_file_upload(interface, conn, config, local_file_path, system_path):
+def decode_manifest_object(data : bytes, header : bytes):
+    """ Decode the body of a manifest diff or snapshot read from the remote, returns a
+    tuple of (metadata, list of manifest items). Objects written before encodings
+    were introduced are JSON and have no encoding in their header. """
+
+    if 'encoding' in pipeline.parse_pipeline_format(header)['format']:
+        return diff_codec.decode(data)
+
+    body = json.loads(data, object_hook = sfs.json_object_hook)
+    if isinstance(body, list): return {}, body
+
+    items = body.pop('files')
+    return body, items
+
+
+###################################################################################
+def file_pipeline_header(config, system_path):
+    """ The serialised pipeline format files at 'system_path' are stored with """
 
     #Determine the correct pipeline format to use for this file from the configuration
     try: pipeline_format = next((plf for wildcard, plf in config['file_pipeline']
                                  if fnmatch.fnmatch(system_path, wildcard)))
     except StopIteration: raise SystemExit('No pipeline format matches ')
 
-    # Get remote file path
-    remote_file_path = sfs.cpjoin(config['remote_base_path'], system_path)
-
-    #----
     pipeline_configuration = pipeline.get_default_pipeline_format()
     pipeline_configuration['chunk_size'] = config['chunk_size']
     pipeline_configuration['format'] = {i : None for i in pipeline_format}
     if 'encrypt' in pipeline_configuration['format']:
         pipeline_configuration['format']['encrypt'] = config['crypto']['encrypt_opts']
 
+    return pipeline.serialise_pipeline_format(pipeline_configuration)
+
+
+###################################################################################
+def streaming_file_upload(interface, conn, config, local_file_path, system_path):
+
+    # Get remote file path
+    remote_file_path = sfs.cpjoin(config['remote_base_path'], system_path)
+
     #-----
     upload = interface.streaming_upload()
     pl     = pipeline.build_pipeline_streaming(upload, 'out')
-    pl.pass_config(config, pipeline.serialise_pipeline_format(pipeline_configuration))
+    pl.pass_config(config, file_pipeline_header(config, system_path))
 
     upload.begin(conn, remote_file_path)
 
@@ -143,17 +232,31 @@ def streaming_file_upload(interface, conn, config, local_file_path, system_path)
 
 
 ###################################################################################
-def streaming_file_download(interface, conn, config, remote_file_path, version_id, local_file_path):
-    download_stream  = interface.streaming_download()
+def open_streaming_file(interface, conn, config, remote_file_path, version_id):
+    """ Start downloading an object, returns the size of its decoded contents, found from the
+    size of the stored object, and an iterator over them a chunk at a time """
+    workers = config['ranged_get_workers'] if 'ranged_get_workers' in config else 1
+    if workers > 1: download_stream = interface.ranged_download(workers, config['ranged_get_part_size'])
+    else:           download_stream = interface.streaming_download()
     header = download_stream.begin(conn, remote_file_path, version_id)[0]
     pl                = pipeline.build_pipeline_streaming(download_stream, 'in')
     pl.pass_config(config, header)
 
-    sfs.make_dirs_if_dont_exist(local_file_path)
-    with open(local_file_path, 'wb') as fle:
+    def chunks():
         while True:
             res = pl.next_chunk()
             if res is None: break
+            yield res
+
+    return pipeline.streaming_content_size(header, download_stream.total), chunks()
+
+def streaming_file_chunks(interface, conn, config, remote_file_path, version_id):
+    """ Download an object, yielding its decoded contents a chunk at a time """
+    yield from open_streaming_file(interface, conn, config, remote_file_path, version_id)[1]
+
+def streaming_file_download(interface, conn, config, remote_file_path, version_id, local_file_path):
+    with open(local_file_path, 'wb') as fle:
+        for res in streaming_file_chunks(interface, conn, config, remote_file_path, version_id):
             fle.write(res)
 
 
@@ -164,137 +267,364 @@ def get_remote_manifest_versions(interface, conn, config):
 
 ###################################################################################
 def get_remote_manifest_diff(config, version_id = None):
-    meta = {'path'       : config['remote_manifest_diff_file'],
-            'version_id' : version_id,
-            'header'     : pipeline.serialise_pipeline_format(meta_pl_format)}
-    data, meta2 = pl_in(meta, config)
-    return { 'version_id'    : version_id,
+    cached = diff_cache.get(config, version_id)
+    if cached is not None: data, meta2 = cached
+    else:
+        meta = {'path'       : config['remote_manifest_diff_file'],
+                'version_id' : version_id,
+                'header'     : pipeline.serialise_pipeline_format(meta_pl_format)}
+        data, meta2 = pl_in(meta, config)
+        diff_cache.put(config, meta2['version_id'], data, meta2)
+
+    diff_meta, body = decode_manifest_object(data, meta2['header'])
+    return { 'version_id'    : meta2['version_id'],
              'last_modified' : meta2['last_modified'],
-             'body'          : json.loads(data)}
+             'meta'          : diff_meta,
+             'body'          : body}
 
 
 ###################################################################################
-def get_remote_manifest_diffs(interface, conn, config):
-    """ Get and sort the progression of change differences from the remote """
+def fetch_remote_manifest_diff_version(config, version):
+    """ Download and decode one version of the remote manifest diff, given as an
+    item from the version listing. The local cache is used when possible. """
 
-    diffs = []
-    for v in get_remote_manifest_versions(interface, conn, config):
+    cached = diff_cache.get(config, version['VersionId'])
+    if cached is not None: data, meta2 = cached
+    else:
         meta = {'path'       : config['remote_manifest_diff_file'],
-                'version_id' : v['VersionId'],
+                'version_id' : version['VersionId'],
                 'header'     : pipeline.serialise_pipeline_format(meta_pl_format)}
         data, meta2 = pl_in(meta, config)
-        diffs.append({ 'version_id' : v['VersionId'],
-                       'body' : data,
-                       'meta' : meta2})
+        diff_cache.put(config, version['VersionId'], data, meta2)
 
-    return list(diffs)
+    return { 'version_id' : version['VersionId'],
+             'body' : data,
+             'meta' : meta2}
 
 
 ###################################################################################
-def rebuild_manifest_from_diffs(versions, version_id = None):
-    """ Rebuild manifest from a series of diffs, passed as an array of
-    boot key objects """
+def iter_remote_manifest_diffs(interface, conn, config, versions = None):
+    """ Yield the progression of change differences from the remote in order. If
+    'versions' is given only those versions of the diff are downloaded. Versions are
+    fetched concurrently, but only a bounded number are held in memory at once. """
+
+    if versions is None:
+        versions = get_remote_manifest_versions(interface, conn, config)
+
+    # Diff versions are immutable so only those not already in the local cache are fetched
+    workers = config['meta_fetch_concurrency'] if 'meta_fetch_concurrency' in config else 1
+    try:
+        for diff in parallel.ordered_map(functools.partial(fetch_remote_manifest_diff_version, config),
+                                         versions, workers):
+            yield diff
+    finally:
+        diff_cache.evict(config)
+
+
+###################################################################################
+def get_remote_manifest_diffs(interface, conn, config, versions = None):
+    """ Get and sort the progression of change differences from the remote. If
+    'versions' is given only those versions of the diff are downloaded. """
+
+    return list(iter_remote_manifest_diffs(interface, conn, config, versions))
+
+
+###################################################################################
+def rebuild_manifest_from_diffs(versions, version_id = None, snapshot = None, first_index = 0):
+    """ Rebuild manifest from a series of diffs, passed as an iterable of
+    boot key objects, which are consumed as they are applied. If a snapshot
+    is given the diffs are applied on top of it, and must be those written
+    after the version it covers. 'first_index' is the position of the first
+    diff in the version listing, used to number diffs written by older
+    versions which do not record a sequence number. """
 
     # filter these to find the diffs up until the desired version
-    if version_id is not None:
-        filtered = []
+    if version_id is not None and snapshot is not None and snapshot['version_id'] == version_id:
+        versions = []
+
+    applied = {'latest' : None, 'meta' : None, 'diffs' : 0, 'bytes' : 0}
+    def parse_diffs():
+        parent = snapshot['version_id'] if snapshot is not None else None
         for vers in versions:
-            filtered.append(vers)
-            if vers['version_id'] == version_id:
-                break
-        else:
-            raise SystemExit('The given version ID ' + version_id + ' does not exist')
+            diff_meta, diff = decode_manifest_object(vers['body'], vers['meta']['header'])
 
-        versions = filtered
+            # Each diff records the version it was written on top of
+            if 'parent' in diff_meta and parent is not None and diff_meta['parent'] != parent:
+                raise SystemExit('Remote manifest diff ' + vers['version_id'] + ' is out of sequence')
+            parent = vers['version_id']
 
-    # merge the diffs
-    diffs = [json.loads(vers['body']) for vers in versions]
+            applied['latest'] = vers
+            applied['meta'] = diff_meta
+            applied['diffs'] += 1
+            applied['bytes'] += len(vers['body'])
+            yield diff
 
+            if version_id is not None and vers['version_id'] == version_id:
+                return
+
+        if version_id is not None and (snapshot is None or snapshot['version_id'] != version_id):
+            raise SystemExit('The given version ID ' + version_id + ' does not exist')
+
+    # merge the diffs
     file_manifest = new_manifest()
-    file_manifest['files'] = sfs.apply_diffs(diffs, file_manifest['files'])
-    file_manifest['latest_remote_diff'] = {'version_id' : versions[-1]['version_id'],
-                                           'last_modified' : ''}#versions[-1]['last_modified']}
+    base_files = snapshot['files'] if snapshot is not None else []
+    file_manifest['files'] = sfs.apply_diffs(parse_diffs(), base_files)
+
+    latest = applied['latest']
+    if latest is not None:
+        seq = applied['meta']['seq'] if 'seq' in applied['meta'] else first_index + applied['diffs']
+        file_manifest['latest_remote_diff'] = {'version_id' : latest['version_id'], 'seq' : seq}
+    else:
+        file_manifest['latest_remote_diff'] = {'version_id' : snapshot['version_id'], 'seq' : snapshot['seq']}
+
+    file_manifest['since_snapshot'] = {'diffs' : applied['diffs'], 'bytes' : applied['bytes']}
+    return file_manifest
+
+
+###################################################################################
+def find_manifest_snapshot(interface, conn, config, versions, target):
+    """ Find the newest full manifest snapshot covering a diff at or before
+    versions[target], where versions is the listing of the remote manifest diffs.
+    Returns None if no usable snapshot exists. Once the backup has been pruned the
+    manifest baseline covers the oldest remaining diff, and is used when no snapshot is. """
+
+    snapshots = interface.list_versions(conn, config['remote_manifest_snapshot_file'])
+    positions = {v['VersionId'] : i for i, v in enumerate(versions)}
+
+    # A snapshot is always written after the diff it covers and before the next diff,
+    # so anything newer than the diff following the target cannot be used. S3 timestamps
+    # are of limited resolution, so the version each candidate covers is still checked.
+    cutoff = versions[target + 1]['LastModified'] if target + 1 < len(versions) else None
+
+    for snap in reversed(snapshots):
+        if snap['Key'] != config['remote_manifest_snapshot_file']: continue
+        if cutoff is not None and snap['LastModified'] > cutoff: continue
+        if snap['LastModified'] < versions[0]['LastModified']: break
+
+        meta = {'path'       : config['remote_manifest_snapshot_file'],
+                'version_id' : snap['VersionId'],
+                'header'     : pipeline.serialise_pipeline_format(meta_pl_format)}
+        try: data, meta2 = pl_in(meta, config)
+        except ValueError: continue
+
+        snapshot_meta, files = decode_manifest_object(data, meta2['header'])
+        if snapshot_meta['version_id'] not in positions: continue
+
+        index = positions[snapshot_meta['version_id']]
+        if index > target: continue
+
+        return {'version_id' : snapshot_meta['version_id'],
+                'index'      : index,
+                'seq'        : snapshot_meta['seq'] if 'seq' in snapshot_meta else index + 1,
+                'files'      : files}
+
+    baseline = read_manifest_baseline(config)
+    if baseline is None: return None
+
+    baseline_meta, files = baseline
+    if baseline_meta['version_id'] not in positions or positions[baseline_meta['version_id']] > target: return None
+
+    return {'version_id' : baseline_meta['version_id'],
+            'index'      : positions[baseline_meta['version_id']],
+            'seq'        : baseline_meta['seq'],
+            'files'      : files}
+
+
+###################################################################################
+def read_manifest_baseline(config):
+    """ The manifest written by prune at the oldest version it kept, as a tuple of
+    (metadata, list of manifest items), or None if the backup has never been pruned """
+
+    meta = {'path'       : config['remote_manifest_baseline_file'],
+            'version_id' : None,
+            'header'     : pipeline.serialise_pipeline_format(meta_pl_format)}
+    try: data, meta2 = pl_in(meta, config)
+    except ValueError: return None
+
+    return decode_manifest_object(data, meta2['header'])
+
+
+###################################################################################
+def read_pruned_versions(config):
+    """ Ids of the versions which remain in the diff history, but whose files prune has removed """
+
+    pruned = read_json_from_remote(config, config['remote_pruned_versions_file'])[0]
+    return set(pruned) if pruned is not None else set()
+
+
+###################################################################################
+def get_manifest_at_version(interface, conn, config, version_id = None):
+    """ Rebuild the manifest as it was at 'version_id', or the latest version if this
+    is None. Starts from the nearest full manifest snapshot and downloads only the diffs
+    written after it. Returns None if no manifest exists on the remote. """
+
+    versions = get_remote_manifest_versions(interface, conn, config)
+    if versions == []:
+        if version_id is not None: raise SystemExit('The given version ID ' + version_id + ' does not exist')
+        return None
+
+    if version_id is None: target = len(versions) - 1
+    else:
+        try: target = next(i for i, v in enumerate(versions) if v['VersionId'] == version_id)
+        except StopIteration: raise SystemExit('The given version ID ' + version_id + ' does not exist')
+
+        if version_id in read_pruned_versions(config):
+            raise SystemExit('The given version ID ' + version_id + ' has been pruned')
+
+    snapshot = find_manifest_snapshot(interface, conn, config, versions, target)
+    first = snapshot['index'] + 1 if snapshot is not None else 0
+
+    diffs = iter_remote_manifest_diffs(interface, conn, config, versions[first : target + 1])
+    return rebuild_manifest_from_diffs(diffs, version_id, snapshot, first)
+
+
+###################################################################################
+def count_diff_towards_snapshot(file_manifest, diff_size):
+    """ Count a newly written diff towards the next manifest snapshot """
+
+    counters = file_manifest.setdefault('since_snapshot', {'diffs' : 0, 'bytes' : 0})
+    counters['diffs'] += 1
+    counters['bytes'] += diff_size
     return file_manifest
 
+
 ###################################################################################
-def get_manifest(interface, conn, config):
+def write_manifest_snapshot_if_due(config, file_manifest):
+    """ Write a full manifest snapshot to the remote once enough diffs, or bytes of
+    diffs, have accumulated since the last one. This bounds the number of diffs that
+    have to be replayed to rebuild the manifest. Called after the local manifest has
+    been committed, so the snapshot can be streamed from the local store when the file
+    list is not held in memory. """
+
+    counters = file_manifest['since_snapshot'] if 'since_snapshot' in file_manifest else {'diffs' : 0, 'bytes' : 0}
+
+    max_diffs = config['manifest_snapshot_diffs'] if 'manifest_snapshot_diffs' in config else 0
+    max_bytes = config['manifest_snapshot_bytes'] if 'manifest_snapshot_bytes' in config else 0
+
+    if not ((max_diffs > 0 and counters['diffs'] >= max_diffs) or
+            (max_bytes > 0 and counters['bytes'] >= max_bytes)):
+        return file_manifest
+
+    print('Writing manifest snapshot')
+    files = file_manifest['files'] if 'files' in file_manifest else manifest_store.iter_sorted(config)
+    write_manifest_object(config, config['remote_manifest_snapshot_file'], files,
+                          {'version_id' : file_manifest['latest_remote_diff']['version_id'],
+                           'seq'        : file_manifest['latest_remote_diff']['seq']})
+
+    # If this is lost in a crash another snapshot is written after the next diff
+    file_manifest['since_snapshot'] = {'diffs' : 0, 'bytes' : 0}
+    manifest_store.commit(config, file_manifest, [])
+    return file_manifest
+
+
+###################################################################################
+def get_manifest(interface, conn, config, with_files = True):
     """ Get the manifest. If a locally cached manifest exists this is used,
     otherwise the manifest is rebuilt from the diff sequence on the remote.
+    If 'with_files' is false the file list may be left out when the local store
+    can stream it, see manifest_store.iter_sorted.
     """
 
     try:
-        file_manifest = json.loads(sfs.file_get_contents(config['local_manifest_file']))
+        file_manifest = manifest_store.load(config, with_files)
 
         try: latest = get_remote_manifest_diff(config)
         except ValueError: raise SystemExit('Local manifest exists but remote missing, suspect tampering')
 
-        if file_manifest['latest_remote_diff']['last_modified'] != latest['last_modified'].isoformat():
+        local = file_manifest['latest_remote_diff']
+
+        # Manifests written by older versions do not record the sequence number of their
+        # latest diff, it is found from the position of the diff in the version listing
+        versions = None
+        if 'seq' not in local:
+            versions = get_remote_manifest_versions(interface, conn, config)
+            try: local['seq'] = next(i for i, v in enumerate(versions) if v['VersionId'] == local['version_id']) + 1
+            except StopIteration: raise SystemExit('Latest remote manifest does not align with local manifest')
+
+        if latest['version_id'] != local['version_id']:
             # If the client where to crash between writing the remote diff and local manifest the remote manifest
-            # will be one version ahead of the local. Handle this transparently by rebuilding the local manifest.
-            # Under normal circumstances the remote should never be more than one diff ahead.
-            local_manifest_time = datetime.datetime.strptime(file_manifest['latest_remote_diff']['last_modified'].replace('T', ' ').split('+')[0], '%Y-%m-%d %H:%M:%S')
-            remote_diff_time    = latest['last_modified'].replace(tzinfo=None)
-            if remote_diff_time > local_manifest_time:
-                diffs = get_remote_manifest_diffs(interface, conn, config)
-                if local_manifest_time == diffs[-2]['meta']['last_modified'].replace(tzinfo=None):
-                    print('Remote is one diff ahead of local, updating local manifest')
-                    new_diff = json.loads(diffs[-1]['body'])
-                    file_manifest['files'] = sfs.apply_diffs([new_diff], file_manifest['files'])
-
-                    file_manifest['latest_remote_diff'] = {'version_id' : diffs[-1]['meta']['version_id'], 'last_modified' : diffs[-1]['meta']['last_modified'].isoformat()}
-
-                    #============================================
-                    write_local_manifest(config, file_manifest)
-                    return file_manifest
-
-                else: raise SystemExit('Latest remote manifest does not align with local manifest')
-            else: raise SystemExit('Latest remote manifest does not align with local manifest')
+            # will be one version ahead of the local. Each diff records the version it was written on top of, so
+            # this is detected and handled transparently by applying the diff to the local manifest. Under normal
+            # circumstances the remote should never be more than one diff ahead.
+            if 'parent' in latest['meta']: parent = latest['meta']['parent']
+            else:
+                # diffs written by older versions do not record their parent, use the version listing
+                if versions is None: versions = get_remote_manifest_versions(interface, conn, config)
+                parent = versions[-2]['VersionId'] if len(versions) > 1 and versions[-1]['VersionId'] == latest['version_id'] else None
+
+            if parent != local['version_id']:
+                raise SystemExit('Latest remote manifest does not align with local manifest')
+
+            print('Remote is one diff ahead of local, updating local manifest')
+            if 'files' in file_manifest: file_manifest['files'] = sfs.apply_diffs([latest['body']], file_manifest['files'])
+
+            file_manifest['latest_remote_diff'] = {'version_id' : latest['version_id'],
+                                                   'seq'        : latest['meta']['seq'] if 'seq' in latest['meta'] else local['seq'] + 1}
+
+            #============================================
+            manifest_store.commit(config, file_manifest, latest['body'])
 
         return file_manifest
 
     except IOError:
-        versions = get_remote_manifest_diffs(interface, conn, config)
-        if versions != []: return rebuild_manifest_from_diffs(versions)
-        else: return new_manifest() # No manifest exists on s3
+        file_manifest = get_manifest_at_version(interface, conn, config)
+        if file_manifest is None: return new_manifest() # No manifest exists on s3
+
+        # Store the rebuilt manifest so following commits can be applied to it
+        if not ('read_only' in config and config['read_only']):
+            write_local_manifest(config, file_manifest)
+            if not with_files and manifest_store.is_indexed(config): del file_manifest['files']
+        return file_manifest
 
 
 ###################################################################################
 def write_local_manifest(config, file_manifest):
-    """ Write the local manifest, done using write and move for atomicity """
+    """ Write the local manifest in full, atomically """
 
-    sfs.file_put_contents(config['local_manifest_file']+'.tmp', json.dumps(file_manifest))
-    os.rename(config['local_manifest_file']+'.tmp', config['local_manifest_file'])
+    manifest_store.write(config, file_manifest)
+
+
+###################################################################################
+def batch_changes(changes, max_files = 0, max_bytes = 0):
+    """ Group a stream of changes into batches. A batch is closed once it holds 'max_files'
+    changes, or the files which may need uploading in it total 'max_bytes', a limit of 0
+    disables it. Only the batch being filled is held in memory. """
+
+    batch = []; batch_bytes = 0
+    for item in changes:
+        batch.append(item)
+        if item['status'] in ['new', 'changed'] and 'size' in item: batch_bytes += item['size']
+
+        if (max_files > 0 and len(batch) >= max_files) or (max_bytes > 0 and batch_bytes >= max_bytes):
+            yield batch
+            batch = []; batch_bytes = 0
+
+    if len(batch) != 0: yield batch
 
 
 ###################################################################################
 def split_files_changes_into_chunks(config, localy_changed_files):
     # Allow changes to be split into chunks to handle a large number of changes
     # made to a filesystem mostly consisting of large files, where the upload
-    # may fail mid-process. Useful for initial uploads
-    changed_files_chunked = []
+    # may fail mid-process. Useful for initial uploads. Chunks are limited by
+    # the number of files and by the number of bytes to upload.
+    chunk_size  = config['split_chunk_size']  if 'split_chunk_size'  in config else 0
+    chunk_bytes = config['split_chunk_bytes'] if 'split_chunk_bytes' in config else 0
 
-    if localy_changed_files !={}:
-        localy_changed_files_list = [changed for p, changed in localy_changed_files.items()]
+    return list(batch_changes(localy_changed_files.values(), chunk_size, chunk_bytes))
 
-        # Allow diff to be split into chunks to handle large uploads
-        chunk_size = config['split_chunk_size'] if 'split_chunk_size' in config else 0
 
-        if chunk_size > 0:
-
-            chunk = []
-            for item in localy_changed_files_list:
-                chunk.append(item)
-                if len(chunk) >= chunk_size:
-                    changed_files_chunked.append(chunk)
-                    chunk = []
-
-            if len(chunk) != 0:
-                changed_files_chunked.append(chunk)
+###################################################################################
+def iter_change_chunks(config, localy_changed_files):
+    """ Lazily splits a stream of changes into chunks, as split_files_changes_into_chunks.
+    Only one chunk is held in memory, so if chunking is disabled the chunk size is
+    bounded by 'scan_run_size' instead. """
 
-        else:
-            changed_files_chunked = [localy_changed_files_list]
+    chunk_size  = config['split_chunk_size']  if 'split_chunk_size'  in config else 0
+    chunk_bytes = config['split_chunk_bytes'] if 'split_chunk_bytes' in config else 0
+    if chunk_size <= 0: chunk_size = config['scan_run_size'] if 'scan_run_size' in config else 1000000
 
-    return changed_files_chunked
+    return batch_changes(localy_changed_files, chunk_size, chunk_bytes)
 
 
 ###################################################################################
@@ -308,7 +638,21 @@ def referance_duplicate_to_master(master_file, duplicate_file):
 
 
 ###################################################################################
-def deduplicate_changes_and_create_diff(config, changed_files, file_manifest):
+def manifest_hash_index(file_manifest, warm = None):
+    """ Index of the files in the manifest by hash. If 'warm' state is given, see backup,
+    the index is kept in it and only rebuilt once the manifest has changed. """
+
+    latest = file_manifest['latest_remote_diff']['version_id'] if 'version_id' in file_manifest['latest_remote_diff'] else None
+    if warm is not None and 'hash_index' in warm and warm['hash_index'][0] == latest:
+        return warm['hash_index'][1]
+
+    index = {sfs.entry_hash_key(f) : f for f in file_manifest['files']}
+    if warm is not None: warm['hash_index'] = (latest, index)
+    return index
+
+
+###################################################################################
+def deduplicate_changes_and_create_diff(config, changed_files, file_manifest, warm = None):
     """ Performs file de-duplication against the previous manifest and works out
     which files need to be uploaded, creating a new diff """
 
@@ -317,8 +661,13 @@ def deduplicate_changes_and_create_diff(config, changed_files, file_manifest):
     changed_files = sfs.hash_new_files(changed_files, config['base_path'])
     changed_files = sorted(changed_files,key=lambda fle:(os.path.dirname(fle['path']), os.path.basename(fle['path'])))
 
-    # for de-duplication we create an index of the hashes in the previous manifest
-    file_hashes_in_previous_manifest = {f['hash'] : f for f in file_manifest['files']}
+    # for de-duplication we need an index of the hashes in the previous manifest,
+    # if the local manifest store is not indexed we have to create one
+    if manifest_store.is_indexed(config):
+        find_in_previous_manifest = lambda change: manifest_store.find_by_hash(config, change['hash'])
+    else:
+        previous_hashes = manifest_hash_index(file_manifest, warm)
+        find_in_previous_manifest = lambda change: previous_hashes.get(sfs.entry_hash_key(change))
     file_hashes_in_this_revision = {}
 
 
@@ -339,6 +688,9 @@ def deduplicate_changes_and_create_diff(config, changed_files, file_manifest):
             except OSError: continue
 
             # -------------------------------------------------------------
+            # The previous manifest is searched once per file, as each search may be a database query
+            duplicate_from_previous_manifest = find_in_previous_manifest(change) if local_file_size != 0 else None
+
             # If a file is empty it cannot possibly be a duplicate,
             # as empty files cannot be stored in s3
             if local_file_size == 0:
@@ -347,10 +699,8 @@ def deduplicate_changes_and_create_diff(config, changed_files, file_manifest):
 
             # If the hash already exists in the previous manifest or has been seen already in the
             # current run, the file has been moved or is a duplicate, don't need to upload it again
-            elif change['hash'] in file_hashes_in_previous_manifest:
+            elif duplicate_from_previous_manifest is not None:
                 msg += colored(' (De-duplicated)', 'yellow')
-
-                duplicate_from_previous_manifest = file_hashes_in_previous_manifest[change['hash']]
                 new_diff.append(referance_duplicate_to_master(duplicate_from_previous_manifest, change))
 
             # new duplicates need to be handled specially as the metadata
@@ -375,11 +725,20 @@ def deduplicate_changes_and_create_diff(config, changed_files, file_manifest):
             print(colored('Deleting: ' + change['path'], 'red'))
             new_diff.append(change)
 
+        elif change['status'] == 'moved':
+            # The object stored for the file is unchanged, so nothing needs to be uploaded
+            print(colored('Moving: ' + change['moved_from'] + ' -> ' + change['path'], 'yellow'))
+            new_diff.append(change)
+
     return new_diff, need_to_upload, new_duplicates
 
 
 ###################################################################################
-def upload_changed_files(interface, conn, config, file_manifest, new_diff, need_to_upload, new_duplicates):
+def upload_changed_files(interface, conn, config, file_manifest, new_diff, need_to_upload, new_duplicates, deadline = None):
+    """ Upload new files and write the diff. If a 'deadline' is given files which have not
+    been started when it passes are deferred, so that the work done so far can be committed.
+    Returns the updated manifest and a list of the deferred changes. """
+
     # Before we actually upload anything, we store the list of what we are about
     # to upload on the remote in order to garbage collect failed uploads without
     # checking every version of the manifest against all existing objects
@@ -390,7 +749,13 @@ def upload_changed_files(interface, conn, config, file_manifest, new_diff, need_
 
     #--
     new_uploads = {}
+    deferred    = []
     for file_to_upload in need_to_upload:
+        # at least one file is always processed so that every batch makes progress
+        if deadline is not None and new_uploads != {} and time.time() > deadline:
+            deferred.append(file_to_upload)
+            continue
+
         local_file_path = sfs.cpjoin(config['base_path'], file_to_upload['path'])
 
         # Attempt to get the file size to see if the file is empty as s3 does
@@ -424,32 +789,39 @@ def upload_changed_files(interface, conn, config, file_manifest, new_diff, need_
         # also log to new uploads so duplicates of these files can be referenced correctly below
         new_uploads[file_to_upload['hash']] = file_to_upload
 
-    # process duplicates of new files
+    if deferred != []: print(colored('Deferring ' + str(len(deferred)) + ' files to the next commit', 'yellow'))
+
+    # process duplicates of new files, those of files which were not uploaded are deferred
     for duplicate_file in new_duplicates:
+        if duplicate_file['hash'] not in new_uploads:
+            deferred.append(duplicate_file)
+            continue
+
         master_file = new_uploads[duplicate_file['hash']]
         new_diff.append(referance_duplicate_to_master(master_file, duplicate_file))
 
-    # upload the diff
-    upload_metadata = write_json_to_remote(config, config['remote_manifest_diff_file'], new_diff)
+    # upload the diff, recording its sequence number and the version it follows so that
+    # the local and remote manifests can be aligned without relying on time stamps
+    latest = file_manifest['latest_remote_diff']
+    diff_meta = {'seq'    : latest['seq'] + 1 if 'seq' in latest else 1,
+                 'parent' : latest['version_id'] if 'version_id' in latest else None}
+    upload_metadata = write_manifest_object(config, config['remote_manifest_diff_file'], new_diff, diff_meta)
 
-    # for some reason have to get the key again to obtain it's time stamp
-    last_uploaded_diff = interface.get_object(conn, config['remote_manifest_diff_file'],
-                                              version_id = upload_metadata['version_id'])
+    # apply the diff to the local manifest, in low memory mode the
+    # file list is not held in memory and the diff is applied by the store
+    if 'files' in file_manifest: file_manifest['files'] = sfs.apply_diffs([new_diff], file_manifest['files'])
+    file_manifest['latest_remote_diff'] = {'version_id' : upload_metadata['version_id'], 'seq' : diff_meta['seq']}
 
-    # apply the diff to the local manifest
-    file_manifest['files'] = sfs.apply_diffs([new_diff], file_manifest['files'])
-    file_manifest['latest_remote_diff'] = {
-        'version_id' : last_uploaded_diff['version_id'],
-        'last_modified' : last_uploaded_diff['last_modified'].isoformat()
-    }
-
-    return file_manifest
+    return count_diff_towards_snapshot(file_manifest, upload_metadata['size']), deferred
 
 
 ###################################################################################
-def backup(interface, conn, config):
+def backup(interface, conn, config, warm = None):
     """ Compares the current state of the local filesystem with a historic state
-    stored in a manifest, and uploads the differances to the remote store """
+    stored in a manifest, and uploads the differances to the remote store. A long
+    running process can pass a dict as 'warm', in which the manifest and the index
+    used for de-duplication are kept for the next backup. It must be emptied if
+    the backup fails. """
 
     if 'read_only' in config and config['read_only']: raise SystemExit('read only')
 
@@ -461,36 +833,104 @@ def backup(interface, conn, config):
 
     # Scan the local filesystem to obtain its current state
     visit_mountpoints = 'visit_mountpoints' in config and config['visit_mountpoints']
+    low_memory = 'low_memory_scan' in config and config['low_memory_scan']
+    detect_moves = 'detect_moves' in config and config['detect_moves']
 
-    file_manifest = get_manifest(interface, conn, config)
-    current_state, errors = sfs.get_file_list(config['base_path'], config['ignore_files'],
-                                              visit_mountpoints = visit_mountpoints)
+    # The manifest kept from the previous backup is used as long as nothing else has committed since
+    file_manifest = None
+    if warm is not None and 'manifest' in warm:
+        try: latest = get_remote_manifest_diff(config)
+        except ValueError: latest = None
+        if latest is not None and 'version_id' in warm['manifest']['latest_remote_diff'] \
+                and latest['version_id'] == warm['manifest']['latest_remote_diff']['version_id']:
+            file_manifest = warm['manifest']
+
+    if file_manifest is None:
+        file_manifest = get_manifest(interface, conn, config, with_files = not low_memory)
+
+    # Files modified close to the start of the previous scan are re-checked, as their time stamp may
+    # not have changed if they were written again. The start of this scan is stored with the manifest.
+    policy  = config['change_detection'] if 'change_detection' in config else 'size_mtime'
+    racy_ns = None
+    if policy != 'mtime' and 'scan_started_ns' in file_manifest:
+        racy_ns = file_manifest['scan_started_ns'] - sfs.RACY_WINDOW_NS
+    file_manifest['scan_started_ns'] = time.time_ns()
+
+    if low_memory:
+        # The scan is sorted by path in bounded runs spilled to disk, and merge joined
+        # against the manifest streamed from the local store in path order. Changes
+        # are produced lazily, so only one chunk of them is held in memory at a time.
+        errors = []
+        run_size  = config['scan_run_size'] if 'scan_run_size' in config else 1000000
+        spill_dir = config['scan_spill_dir'] if 'scan_spill_dir' in config else None
+
+        current_state = sfs.external_sort(sfs.iter_file_list(config['base_path'], config['ignore_files'],
+                                                             visit_mountpoints, errors),
+                                          lambda fle: fle['path'], run_size, spill_dir)
+
+        localy_changed_files = sfs.iter_manifest_changes(current_state, manifest_store.iter_sorted(config, file_manifest),
+                                                         policy, racy_ns)
+
+        changed_files_chunked = iter_change_chunks(config, localy_changed_files)
+
+        # changes arrive in path order, so moves can only be detected within a chunk
+        if detect_moves:
+            changed_files_chunked = (list(sfs.detect_moved_files(sfs.make_dict(chunk), config['base_path'],
+                                                                 config['skip_delete']).values())
+                                     for chunk in changed_files_chunked)
 
-    # filter ignore files
-    #current_state = sfs.filter_file_list(current_state, config['ignore_files'])
-    #errors        = sfs.filter_file_list([{'path' : e} for e in errors], config['ignore_files'])
+    else:
+        current_state, errors = sfs.get_file_list(config['base_path'], config['ignore_files'],
+                                                  visit_mountpoints = visit_mountpoints)
 
-    if errors != []:
-        for e in errors: print(colored('Could not read ' + e, 'red'))
-        print('--------------')
+        # filter ignore files
+        #current_state = sfs.filter_file_list(current_state, config['ignore_files'])
+        #errors        = sfs.filter_file_list([{'path' : e} for e in errors], config['ignore_files'])
+
+        if errors != []:
+            for e in errors: print(colored('Could not read ' + e, 'red'))
+            print('--------------')
 
-    #Find changed files
-    localy_changed_files = sfs.find_manifest_changes(current_state, file_manifest['files'])
+        #Find changed files
+        localy_changed_files = sfs.find_manifest_changes(current_state, file_manifest['files'], policy, racy_ns)
+        if detect_moves:
+            localy_changed_files = sfs.detect_moved_files(localy_changed_files, config['base_path'], config['skip_delete'])
 
-    changed_files_chunked = split_files_changes_into_chunks(config, localy_changed_files)
+        changed_files_chunked = split_files_changes_into_chunks(config, localy_changed_files)
 
     # =============================================================================
-    for changed_files in changed_files_chunked:
+    # Files in the next chunk are hashed while the current one is uploaded. De-duplication is
+    # left until the previous chunk is committed as it may reference files uploaded in it.
+    hash_chunk = lambda changed_files: sfs.hash_new_files(changed_files, config['base_path'])
+    changed_files_chunked = parallel.ordered_map(hash_chunk, changed_files_chunked, 1, 2)
+
+    # A commit is also made once uploading a chunk has taken 'split_chunk_seconds', the
+    # files which remain are carried into the next chunk
+    chunk_seconds = config['split_chunk_seconds'] if 'split_chunk_seconds' in config else 0
+    deferred = []
+
+    while True:
+        changed_files = next(changed_files_chunked, None)
+        if changed_files is None:
+            if deferred == []: break
+            changed_files = []
+
+        changed_files = deferred + changed_files
         print('--------------')
 
-        new_diff, need_to_upload, new_duplicates = deduplicate_changes_and_create_diff(config, changed_files, file_manifest)
+        new_diff, need_to_upload, new_duplicates = deduplicate_changes_and_create_diff(config, changed_files, file_manifest, warm)
 
-        file_manifest = upload_changed_files(interface, conn, config, file_manifest, new_diff, need_to_upload, new_duplicates)
+        # Nothing is committed for a chunk left with no changes, such as one holding only files
+        # re-checked because of the racy window, so no empty version of the diff is written
+        deferred = []
+        if new_diff == [] and need_to_upload == [] and new_duplicates == []: continue
 
-        write_local_manifest(config, file_manifest)
+        deadline = time.time() + chunk_seconds if chunk_seconds > 0 else None
+        file_manifest, deferred = upload_changed_files(interface, conn, config, file_manifest, new_diff,
+                                                       need_to_upload, new_duplicates, deadline)
 
-        # minimum resolution on s3 timestamps is 1 second, make sure delete marker comes last
-        time.sleep(1)
+        manifest_store.commit(config, file_manifest, new_diff)
+        file_manifest = write_manifest_snapshot_if_due(config, file_manifest)
 
         # delete the garbage collection log, done last in case of crash
         # to avoid leaving garbage objects on the remote
@@ -499,39 +939,213 @@ def backup(interface, conn, config):
 
         print('--------------')
 
+    # in low memory mode read errors are only known once the scan has been sorted
+    if low_memory and errors != []:
+        for e in errors: print(colored('Could not read ' + e, 'red'))
+        print('--------------')
+
+    if warm is not None: warm['manifest'] = file_manifest
+
     # unlock
     fcntl.flock(lockfile, fcntl.LOCK_UN)
     os.remove(lockfile_path)
+    lockfile.close()
 
 ###################################################################################
+def filter_download_files(files, ignore_filters = None):
+    files = sorted(files, key=lambda fle: (os.path.dirname(fle['path']), os.path.basename(fle['path'])))
+
+    if ignore_filters is not None:
+        for fil in ignore_filters:
+            files = sfs.filter_f_list(files, fil)
+    return files
+
 def download(interface, conn, config, version_id, target_directory, ignore_filters = None):
     """ Download files from a specified version """
 
     if 'write_only' in config and config['write_only']: raise SystemExit('write only')
 
-    versions = get_remote_manifest_diffs(interface, conn, config)
-    file_manifest = rebuild_manifest_from_diffs(versions, version_id)
+    file_manifest = get_manifest_at_version(interface, conn, config, version_id)
+    version_paths = {fle['path'] for fle in file_manifest['files']}
+    file_manifest['files'] = filter_download_files(file_manifest['files'], ignore_filters)
 
-    file_manifest['files'] = sorted(file_manifest['files'],key=lambda fle:
-        (os.path.dirname(fle['path']), os.path.basename(fle['path'])))
+    # download the objects in the manifest
+    fetch = functools.partial(streaming_file_download, interface, conn, config)
+    restore.restore_files(config, fetch, file_manifest['files'], target_directory)
 
-    if ignore_filters is not None:
-        for fil in ignore_filters:
-            file_manifest['files'] = sfs.filter_f_list(file_manifest['files'], fil)
+    # files excluded by the filters are kept if they are in the version
+    if 'restore_delete_extra' in config and config['restore_delete_extra']:
+        restore.remove_extra_files(target_directory, version_paths)
 
-    # download the objects in the manifest
-    for fle in file_manifest['files']:
-        print('Downloading: ' + fle['path'])
 
-        local_file_path = sfs.cpjoin(target_directory, fle['path'])
+def download_tar(interface, conn, config, version_id, fileobj, ignore_filters = None, compression = None):
+    """ Write the files from a specified version to 'fileobj' as a tar stream, without
+    writing anything else to disk. 'compression' is None, 'gz', 'bz2', 'xz' or 'zst'. """
+
+    if 'write_only' in config and config['write_only']: raise SystemExit('write only')
+
+    file_manifest = get_manifest_at_version(interface, conn, config, version_id)
+    files = filter_download_files(file_manifest['files'], ignore_filters)
+
+    open_object = functools.partial(open_streaming_file, interface, conn, config)
+    restore.restore_tar(config, open_object, files, fileobj, compression)
+
+
+def mount(interface, conn, config, mountpoint):
+    """ Mount every version as a read-only file system at 'mountpoint', see mount.py """
+
+    if 'write_only' in config and config['write_only']: raise SystemExit('write only')
+
+    pruned = read_pruned_versions(config)
+    versions = [v for v in get_remote_manifest_versions(interface, conn, config) if v['VersionId'] not in pruned]
+
+    # the sizes of files recorded by older versions come from a single listing of the bucket
+    stored_sizes = None; listing_lock = threading.Lock()
+    def load_files(version_id):
+        nonlocal stored_sizes
+        files = get_manifest_at_version(interface, conn, config, version_id)['files']
+        if all('size' in fle or ('empty' in fle and fle['empty']) for fle in files): return files
+
+        with listing_lock:
+            if stored_sizes is None:
+                stored_sizes = {(vers['Key'], vers['VersionId']) : vers['Size']
+                                for vers in interface.iter_versions(conn, config['remote_base_path'] + '/')}
+
+        return mount_fs.fill_sizes(files, stored_sizes,
+                                   lambda fle: sfs.cpjoin(config['remote_base_path'], fle['real_path']),
+                                   lambda fle: file_pipeline_header(config, fle['path']))
+
+    def read_range(real_path, version_id, first, last):
+        res = interface.get_object(conn, sfs.cpjoin(config['remote_base_path'], real_path),
+                                   version_id = version_id, byte_range = (first, last))
+        data = res['body'].read()
+        return data, int(res['content_range'].split('/')[1]) if res['content_range'] is not None else len(data)
+
+    mount_fs.mount(config, versions, load_files, read_range, mountpoint)
 
-        if 'empty' in fle:
-            sfs.make_dirs_if_dont_exist(local_file_path)
-            open(local_file_path, 'w').close()
-        else:
-            remote_file_path = sfs.cpjoin(config['remote_base_path'], fle['real_path'])
-            sfs.make_dirs_if_dont_exist(local_file_path)
-            streaming_file_download(interface, conn, config, remote_file_path, fle['version_id'], local_file_path)
+
+def verify(interface, conn, config, version_id = None, deep = False, sample = 1.0):
+    """ Check the objects referenced by a version, the latest if 'version_id' is None, without
+    restoring it, see verify.py. The sizes of all of them are checked against a listing of the
+    bucket, and if 'deep' is set the contents of a 'sample' fraction of them are downloaded and
+    checked against their hashes. Returns the problems found as (status, key, version id). """
+
+    if 'write_only' in config and config['write_only']: raise SystemExit('write only')
+
+    file_manifest = get_manifest_at_version(interface, conn, config, version_id)
+    if file_manifest is None: raise SystemExit('There is no manifest on the remote (nothing to verify).')
+
+    objects = verify_objects.stored_objects(file_manifest['files'],
+                                            lambda fle: sfs.cpjoin(config['remote_base_path'], fle['real_path']))
+
+    def get_range(key, object_version, first, last):
+        return interface.get_object(conn, key, version_id = object_version, byte_range = (first, last))['body'].read()
+
+    print('Checking the sizes of ' + str(len(objects)) + ' objects')
+    problems = verify_objects.check_sizes(
+        objects, interface.iter_versions(conn, config['remote_base_path'] + '/'),
+        lambda fle: file_pipeline_header(config, fle['path']),
+        functools.partial(verify_objects.read_stored_header, get_range))
+
+    for status, key, object_version in problems:
+        print(colored(status.capitalize() + ': ' + str((key, object_version)), 'red'))
+
+    if deep:
+        # objects already known to be missing or damaged are not downloaded
+        bad = {(key, object_version) for status, key, object_version in problems}
+        sampled = {obj : fle for obj, fle in objects.items()
+                   if obj not in bad and verify_objects.is_sampled(obj[0], obj[1], sample)}
+
+        progress = verify_objects.checkpoint(config['verify_checkpoint_file'],
+                                             {'version_id' : file_manifest['latest_remote_diff']['version_id'],
+                                              'sample'     : sample})
+        if progress.done != {}: print('Resuming, ' + str(len(progress.done)) + ' objects already checked')
+        problems += [(status, key, object_version) for (key, object_version), status in progress.done.items() if status != 'ok']
+
+        print('Checking the contents of ' + str(len(sampled)) + ' objects')
+        fetch_chunks = functools.partial(streaming_file_chunks, interface, conn, config)
+        for count, (status, key, object_version) in enumerate(verify_objects.check_hashes(config, sampled, fetch_chunks, progress), 1):
+            if status != 'ok':
+                print(colored(status.capitalize() + ': ' + str((key, object_version)), 'red'))
+                problems.append((status, key, object_version))
+            if count % 1000 == 0: print('Checked ' + str(count) + ' objects')
+
+        progress.remove()
+
+    print('Problems found: ' + str(len(problems)))
+    return problems
+
+
+###################################################################################
+def serve(interface, conn, config, stop = None):
+    """ Run backups on an interval in a long running process, answering list_versions,
+    list_files and list_changes queries from the state it holds, see daemon.py. The
+    file list of the latest version is the manifest kept by the backups, and those of
+    other versions are kept once they have been rebuilt. """
+
+    if 'read_only' in config and config['read_only']: raise SystemExit('read only')
+
+    warm = {}; state = {'failed' : False, 'latest' : None, 'versions' : None}
+    file_lists = collections.OrderedDict(); lock = threading.Lock()
+
+    def run_backup():
+        # an interrupted backup may have left garbage, which init would usually clean
+        if state['failed']:
+            interface.delete_failed_uploads(conn)
+            garbage_collect(interface, conn, config, 'simple')
+
+        try: backup(interface, conn, config, warm)
+        except (Exception, SystemExit):
+            warm.clear(); state['failed'] = True
+            raise
+
+        state['failed'] = False
+        file_manifest = warm['manifest']
+        with lock:
+            state['latest'] = (file_manifest['latest_remote_diff']['version_id'] if 'version_id' in file_manifest['latest_remote_diff'] else None,
+                               file_manifest['files'] if 'files' in file_manifest else None)
+            state['versions'] = None
+
+    #----
+    def check_readable():
+        if 'write_only' in config and config['write_only']: raise SystemExit('Write only')
+
+    def list_versions():
+        check_readable()
+        with lock: versions = state['versions']
+        if versions is None:
+            pruned = read_pruned_versions(config)
+            versions = [{'VersionId' : v['VersionId'], 'LastModified' : v['LastModified'].isoformat()}
+                        for v in get_remote_manifest_versions(interface, conn, config) if v['VersionId'] not in pruned]
+            with lock: state['versions'] = versions
+        return versions
+
+    def list_files(version_id):
+        check_readable()
+        with lock:
+            if version_id in file_lists:
+                file_lists.move_to_end(version_id)
+                return file_lists[version_id]
+            latest = state['latest']
+
+        if latest is not None and latest[0] == version_id and latest[1] is not None: files = latest[1]
+        else: files = get_manifest_at_version(interface, conn, config, version_id)['files']
+        paths = [fle['path'] for fle in filter_download_files(files)]
+
+        max_versions = config['daemon_cached_versions'] if 'daemon_cached_versions' in config else 4
+        with lock:
+            file_lists[version_id] = paths
+            while len(file_lists) > max(1, max_versions): file_lists.popitem(last = False)
+        return paths
+
+    def list_changes(version_id):
+        check_readable()
+        return [{key : change[key] for key in ['status', 'path', 'moved_from'] if key in change}
+                for change in get_remote_manifest_diff(config, version_id)['body']]
+
+    daemon.serve(config, run_backup, {'list_versions' : list_versions,
+                                      'list_files'    : list_files,
+                                      'list_changes'  : list_changes}, stop)
 
 
 ############################################################################################
@@ -564,7 +1178,6 @@ def garbage_collect(interface, conn, config, mode='simple'):
     # ----------------------------------------------------------------------
     # Perform GC
     # ----------------------------------------------------------------------
-    missing_objects = []
     garbage_objects = []
 
     #---------------
@@ -573,8 +1186,23 @@ def garbage_collect(interface, conn, config, mode='simple'):
 
     #---------------
     elif mode == 'full':
-        missing_objects, garbage_objects = varify_manifest(interface, conn, config)
-        if missing_objects != []: raise SystemExit('Missing objects found')
+        # Garbage is spilled to disk until the whole bucket has been checked, as
+        # nothing is deleted if any objects are missing
+        with tempfile.TemporaryFile('w+', dir = config['scan_spill_dir'] if 'scan_spill_dir' in config else None) as spill:
+            missing_count = 0
+            for status, key, version_id in iter_full_gc(interface, conn, config):
+                if status == 'missing':
+                    print(colored('Missing object: ' + str((key, version_id)), 'red')); missing_count += 1
+                else: spill.write(json.dumps([key, version_id]) + '\n')
+
+            if missing_count > 0: raise SystemExit('Missing objects found')
+
+            spill.seek(0)
+            garbage = (tuple(json.loads(line)) for line in spill)
+            while True:
+                batch = list(itertools.islice(garbage, 100000))
+                if batch == []: break
+                delete_garbage_objects(interface, conn, config, batch, is_write_only)
 
     #---------------
     else: raise SystemExit('Invalid GC mode')
@@ -596,14 +1224,15 @@ def verify_manifest_with_gc_log(interface, conn, config):
     manifest = get_manifest(interface, conn, config)
     manifest_index = {fle['path'] : fle for fle in manifest['files']}
 
+    # The latest versions of everything in the log are listed in bulk
+    workers = config['gc_list_concurrency'] if 'gc_list_concurrency' in config else 1
+    latest_versions = interface.list_latest_versions(
+        conn, [sfs.cpjoin(config['remote_base_path'], item['path']) for item in gc_log], workers)
+
     garbage_objects = []
     for item in gc_log:
         remote_path     = sfs.cpjoin(config['remote_base_path'], item['path'])
-        object_versions = interface.list_versions(conn, remote_path)
-
-        latest_version  = None
-        if len(object_versions) > 0:
-            latest_version = object_versions[-1]
+        latest_version  = latest_versions[remote_path] if remote_path in latest_versions else None
 
         # Check if the version of the object stored on the remote is newer than the
         # one in the local manifest. If so, the latest remote version is garbage
@@ -639,37 +1268,90 @@ def verify_manifest_with_gc_log(interface, conn, config):
     return garbage_objects
 
 ############################################################################################
-def varify_manifest(interface, conn, config):
-    """ Check that every item in the manifest actually exists on the remote. """
-
-    # Get every version of every object
-    all_objects = {(i['Key'], i['VersionId']) : None for i in interface.list_versions(conn)}
-
-    # get every object and version in every version of the manifest
-    manifest_referanced_objects = {}
-    for diff in get_remote_manifest_diffs(interface, conn, config):
-        for change in json.loads(diff['body']):
+def iter_referenced_objects(interface, conn, config):
+    """ Every object and version referenced by every version of the manifest, as [key, version id,
+    pruned], where pruned is true if the reference is from a version whose files prune removed """
+    baseline = read_manifest_baseline(config)
+    if baseline is not None:
+        for item in baseline[1]:
+            if 'empty' in item and item['empty']: continue
+            yield [sfs.cpjoin(config['remote_base_path'], item['real_path']), item['version_id'], False]
+
+    pruned = read_pruned_versions(config)
+    for diff in iter_remote_manifest_diffs(interface, conn, config):
+        for change in decode_manifest_object(diff['body'], diff['meta']['header'])[1]:
             if 'empty' in change and change['empty']: continue
 
-            real_path = sfs.cpjoin(config['remote_base_path'], change['real_path'])
-            version_id = change['version_id']
-
-            if (real_path, version_id) not in manifest_referanced_objects:
-                manifest_referanced_objects[(real_path, version_id)] = None
+            # deletions refer to an object added by an earlier version, which may have been pruned
+            if change['status'] == 'deleted': continue
+
+            # moves only reference the object of the item they were moved from
+            if change['status'] == 'moved' and 'real_path' not in change: continue
+
+            yield [sfs.cpjoin(config['remote_base_path'], change['real_path']), change['version_id'],
+                   diff['version_id'] in pruned]
+
+def iter_full_gc(interface, conn, config):
+    """ Check every object version on the remote against every version referenced by the
+    manifest, yielding ('missing', key, version id) for referenced versions which do not exist
+    and ('garbage', key, version id) for versions which are not referenced. Versions referenced
+    only by pruned versions of the manifest are expected to be missing. S3 lists versions
+    by key, and the references are sorted by key with external_sort, spilling to disk, so
+    both are streamed and compared one key at a time however large the bucket is. """
+
+    # The remote manifest diffs themselves, gc log, garbage log and salt file are not garbage
+    meta_keys = {config['remote_gc_log_file'], config['remote_manifest_diff_file'],
+                 config['remote_manifest_snapshot_file'], config['remote_garbage_object_log_file'],
+                 config['remote_manifest_baseline_file'], config['remote_pruned_versions_file'], 'salt_file'}
+    def is_meta(key):
+        return key in meta_keys or key.startswith(garbage_log_prefix(config))
+
+    referenced = sfs.external_sort(iter_referenced_objects(interface, conn, config), key = lambda ref: ref[0],
+                                   run_size = config['scan_run_size'] if 'scan_run_size' in config else 1000000,
+                                   tmp_dir = config['scan_spill_dir'] if 'scan_spill_dir' in config else None)
+
+    def by_key(items):
+        for key, group in itertools.groupby(items, key = lambda item: item[0]):
+            yield key, [item[1] for item in group]
+
+    def refs_by_key(items):
+        # version ids in the order first referenced, mapped to whether a missing object is an error
+        for key, group in itertools.groupby(items, key = lambda item: item[0]):
+            expected = {}
+            for item in group: expected[item[1]] = expected.get(item[1], False) or not item[2]
+            yield key, expected
+
+    listed = by_key((v['Key'], v['VersionId']) for v in interface.iter_versions(conn))
+    referenced = refs_by_key(referenced)
+
+    obj = next(listed, None); ref = next(referenced, None)
+    while obj is not None or ref is not None:
+        if ref is None or (obj is not None and obj[0] < ref[0]):
+            if not is_meta(obj[0]):
+                for version_id in obj[1]: yield 'garbage', obj[0], version_id
+            obj = next(listed, None)
+
+        elif obj is None or ref[0] < obj[0]:
+            for version_id, required in ref[1].items():
+                if required: yield 'missing', ref[0], version_id
+            ref = next(referenced, None)
 
-    #Add the remote manifest diffs themselves, gc log and salt file as they are not garbage
-    for k in all_objects.keys():
-        if(k[0] in [config['remote_gc_log_file'], config['remote_manifest_diff_file'],
-                    config['remote_garbage_object_log_file'], 'salt_file']):
-            manifest_referanced_objects[k] = None
-
-    # Remove objects referenced in the manifest
-    missing_objects = []
-    for k in manifest_referanced_objects.keys():
-        if k not in all_objects: missing_objects.append(k)
-        else: del all_objects[k]
+        else:
+            stored = set(obj[1])
+            for version_id, required in ref[1].items():
+                if required and version_id not in stored: yield 'missing', ref[0], version_id
+            if not is_meta(obj[0]):
+                for version_id in obj[1]:
+                    if version_id not in ref[1]: yield 'garbage', obj[0], version_id
+            obj = next(listed, None); ref = next(referenced, None)
 
-    garbage_objects = list(all_objects.keys())
+def varify_manifest(interface, conn, config):
+    """ Check that every item in the manifest actually exists on the remote, returns lists
+    of the missing and garbage objects. See iter_full_gc for a streaming version. """
+    missing_objects = []; garbage_objects = []
+    for status, key, version_id in iter_full_gc(interface, conn, config):
+        if status == 'missing': missing_objects.append((key, version_id))
+        else:                   garbage_objects.append((key, version_id))
     return missing_objects, garbage_objects
 
 
@@ -681,20 +1363,64 @@ def delete_garbage_objects(interface, conn, config, garbage_objects, is_write_on
     # else append them onto the garbage object log.
     if not is_write_only:
         for item in garbage_objects:
-            print(colored('Deleting garbage object: ' + str(item) , 'red'))
-            try: interface.delete_object(conn, item[0], version_id = item[1])
-            except: print(colored('(Warning) The garbage object has already been deleted.', 'yellow'))
+            print(colored('Deleting garbage object: ' + str(tuple(item)) , 'red'))
+
+        workers = config['gc_delete_concurrency'] if 'gc_delete_concurrency' in config else 1
+        for error in interface.delete_versions(conn, garbage_objects, workers):
+            print(colored('(Warning) Could not delete garbage object: ' + str((error['Key'], error['VersionId']))
+                          + ', ' + error['Code'] + ': ' + error['Message'], 'yellow'))
     else:
         for item in garbage_objects:
             print(colored('Appending to garbage object log: ' + str(item) , 'red'))
 
-        log = read_json_from_remote(config, config['remote_garbage_object_log_file'])[0]
-        if log is None:
-            log = []
+        append_garbage_log_segment(config, garbage_objects)
 
-        log.append(garbage_objects)
 
-        write_json_to_remote(config, config['remote_garbage_object_log_file'], log)
+############################################################################################
+# The garbage object log is a set of small immutable segments, each written once under a
+# unique name below 'remote_garbage_object_log_file', so appending to it never has to read
+# or rewrite what is already there. Older versions wrote a single object at that name
+# holding a list of lists, which is still cleaned.
+############################################################################################
+def garbage_log_prefix(config):
+    return config['remote_garbage_object_log_file'] + '/'
+
+def append_garbage_log_segment(config, garbage_objects):
+    name = '%020d' % time.time_ns() + '-' + os.urandom(4).hex()
+    write_json_to_remote(config, garbage_log_prefix(config) + name, [list(item) for item in garbage_objects])
+
+def list_garbage_log_segments(interface, conn, config):
+    """ Segments of the garbage log as (key, version id), oldest first """
+    return [(v['Key'], v['VersionId']) for v in interface.iter_versions(conn, garbage_log_prefix(config))]
+
+def read_garbage_log_segments(config, segments):
+    """ The garbage objects listed in a batch of segments, which are read concurrently """
+    def read_segment(segment):
+        return read_json_from_remote(config, segment[0], segment[1])[0] or []
+
+    workers = config['meta_fetch_concurrency'] if 'meta_fetch_concurrency' in config else 1
+    return [tuple(item) for log in parallel.ordered_map(read_segment, segments, workers) for item in log]
+
+def delete_garbage_log_segments(interface, conn, config, segments):
+    workers = config['gc_delete_concurrency'] if 'gc_delete_concurrency' in config else 1
+    errors = interface.delete_versions(conn, segments, workers)
+    for error in errors:
+        print(colored('(Warning) Could not delete garbage log segment: ' + error['Key'] + ', ' + error['Message'], 'yellow'))
+    return errors == []
+
+def compact_garbage_log(interface, conn, config):
+    """ Merge the segments of the garbage object log into fewer, larger ones without deleting
+    any garbage, for clients with permission to delete versions of the log but which do not
+    clean it. Segments written while this runs are left as they are. """
+    segments = list_garbage_log_segments(interface, conn, config)
+    batch_size = config['garbage_log_batch_segments'] if 'garbage_log_batch_segments' in config else 100
+
+    for i in range(0, len(segments), batch_size):
+        batch = segments[i : i + batch_size]
+        if len(batch) < 2: break
+        append_garbage_log_segment(config, read_garbage_log_segments(config, batch))
+        delete_garbage_log_segments(interface, conn, config, batch)
+        print('Merged ' + str(len(batch)) + ' garbage log segments')
 
 
 ############################################################################################
@@ -711,13 +1437,149 @@ def clean_gc_log(interface, conn, config):
                           "ensure 'allow_delete_versions' is enabled in configuration file")
 
     gc_log = read_json_from_remote(config, config['remote_garbage_object_log_file'])[0]
+    segments = list_garbage_log_segments(interface, conn, config)
 
-    if gc_log is None:
+    if gc_log is None and segments == []:
         raise SystemExit("There is no gc log on the remote (nothing to do).")
 
-    flattened_gc_log = [item for a in gc_log for item in a]
+    # A log written by an older version
+    if gc_log is not None:
+        flattened_gc_log = [item for a in gc_log for item in a]
+        delete_garbage_objects(interface, conn, config, flattened_gc_log, False)
+        interface.delete_object(conn, config['remote_garbage_object_log_file'])
+
+    # Segments are consumed a batch at a time, and each batch is deleted once the garbage
+    # it lists has been, so an interrupted clean only repeats the current batch
+    batch_size = config['garbage_log_batch_segments'] if 'garbage_log_batch_segments' in config else 100
+    for i in range(0, len(segments), batch_size):
+        batch = segments[i : i + batch_size]
+        delete_garbage_objects(interface, conn, config, read_garbage_log_segments(config, batch), False)
+        delete_garbage_log_segments(interface, conn, config, batch)
+
+
+############################################################################################
+def prune(interface, conn, config, dry_run = False):
+    """
+    Remove the versions of the backup which are not kept by the retention rules, see
+    retention.py, and every object version which only they referenced.
+
+    Manifest diffs older than the oldest version kept are deleted, and replaced with a baseline,
+    a full manifest at that version, so the remaining history starts from it. Versions between
+    those kept remain in the diff history, as the diffs after them depend on them, but are
+    recorded as pruned so they cannot be restored, and their objects are deleted. Objects are
+    found by replaying the diffs and counting references to each, an object being needed if it
+    is referenced by any version kept.
+    """
+
+    if 'read_only' in config and config['read_only']: raise SystemExit('read only')
+    if 'write_only' in config and config['write_only']: raise SystemExit('write only')
+    if 'allow_delete_versions' in config and not config['allow_delete_versions']:
+        raise SystemExit("Pruning deletes versions from the remote, ensure 'allow_delete_versions' is enabled in configuration file")
+    retention.validate_config(config)
+    if not retention.has_rules(config):
+        raise SystemExit('No retention rules are configured, see retain_last, retain_daily and retain_weekly')
+
+    #Local lock, as a backup must not commit while the history is being rewritten
+    lockfile_path = config['local_lock_file']
+    lockfile = open(lockfile_path, 'a')
+    try: fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError: raise SystemExit('Locked by another process')
+
+    versions = get_remote_manifest_versions(interface, conn, config)
+    pruned = read_pruned_versions(config)
+    kept = retention.select_versions(config, [v for v in versions if v['VersionId'] not in pruned])
+    kept_indexes = [i for i, v in enumerate(versions) if v['VersionId'] in kept]
+    to_prune = [v['VersionId'] for v in versions if v['VersionId'] not in kept and v['VersionId'] not in pruned]
 
-    delete_garbage_objects(interface, conn, config, flattened_gc_log, False)
+    if to_prune == []:
+        print('Nothing to prune')
+    else:
+        cutoff = kept_indexes[0]
+
+        #----
+        def obj_of(item):
+            if 'empty' in item and item['empty']: return None
+            return sfs.cpjoin(config['remote_base_path'], item['real_path']), item['version_id']
+
+        def is_kept_between(first, last):
+            pos = bisect.bisect_left(kept_indexes, first)
+            return pos < len(kept_indexes) and kept_indexes[pos] <= last
+
+        references = collections.Counter(); born = {}; garbage = {}
+        def add(item, index):
+            obj = obj_of(item)
+            if obj is None: return
+            if references[obj] == 0: born[obj] = index; garbage.pop(obj, None)
+            references[obj] += 1
+
+        def remove(item, index):
+            obj = obj_of(item)
+            if obj is None: return
+            references[obj] -= 1
+            if references[obj] > 0: return
+
+            # the object was referenced by every version from when it was added until this one
+            del references[obj]
+            if not is_kept_between(born.pop(obj), index - 1): garbage[obj] = None
+
+        #----
+        snapshot = find_manifest_snapshot(interface, conn, config, versions, 0)
+        first = snapshot['index'] + 1 if snapshot is not None else 0
+        seq = snapshot['seq'] if snapshot is not None else 0
+
+        replay = sfs.manifest_replay(snapshot['files'] if snapshot is not None else None)
+        for item in replay.files.values(): add(item, first - 1)
+
+        baseline_files = None; baseline_seq = None
+        diffs = iter_remote_manifest_diffs(interface, conn, config, versions[first:])
+        for index, diff in enumerate(diffs, first):
+            diff_meta, body = decode_manifest_object(diff['body'], diff['meta']['header'])
+            seq = diff_meta['seq'] if 'seq' in diff_meta else seq + 1
+
+            paths = {change['path'] for change in body} | {change['moved_from'] for change in body if change['status'] == 'moved'}
+            before = [replay.files[path] for path in paths if path in replay.files]
+            replay.apply(body)
+
+            # added first, so objects which remain referenced are not seen to be released
+            for item in [replay.files[path] for path in paths if path in replay.files]: add(item, index)
+            for item in before: remove(item, index)
+
+            if index == cutoff: baseline_files = replay.to_list(); baseline_seq = seq
+
+        print('Pruning ' + str(len(to_prune)) + ' versions, keeping ' + str(len(kept_indexes)))
+        print('Unreferenced objects: ' + str(len(garbage)))
+        print('Manifest diffs replaced by baseline: ' + str(cutoff))
+
+        if not dry_run:
+            # The baseline and pruned versions are written first, so if interrupted nothing
+            # remaining refers to a deleted object without being recorded as pruned
+            if cutoff > 0:
+                write_manifest_object(config, config['remote_manifest_baseline_file'], baseline_files,
+                                      {'version_id' : versions[cutoff]['VersionId'], 'seq' : baseline_seq})
+
+            write_json_to_remote(config, config['remote_pruned_versions_file'],
+                                 [v['VersionId'] for v in versions if v['VersionId'] in pruned or v['VersionId'] in to_prune])
+
+            garbage = list(garbage)
+            for i in range(0, len(garbage), 100000):
+                delete_garbage_objects(interface, conn, config, garbage[i : i + 100000], False)
+
+            # Diffs before the baseline, snapshots of them, earlier baselines and records of pruned versions are no longer needed
+            old_meta = [(v['Key'], v['VersionId']) for v in versions[:cutoff]]
+            old_meta += [(v['Key'], v['VersionId']) for v in interface.list_versions(conn, config['remote_pruned_versions_file'])
+                         if v['Key'] == config['remote_pruned_versions_file']][:-1]
+            if cutoff > 0:
+                old_meta += [(v['Key'], v['VersionId']) for v in interface.list_versions(conn, config['remote_manifest_snapshot_file'])
+                             if v['Key'] == config['remote_manifest_snapshot_file'] and v['LastModified'] < versions[cutoff]['LastModified']]
+                old_meta += [(v['Key'], v['VersionId']) for v in interface.list_versions(conn, config['remote_manifest_baseline_file'])
+                             if v['Key'] == config['remote_manifest_baseline_file']][:-1]
+
+            workers = config['gc_delete_concurrency'] if 'gc_delete_concurrency' in config else 1
+            for error in interface.delete_versions(conn, old_meta, workers):
+                print(colored('(Warning) Could not delete ' + str((error['Key'], error['VersionId']))
+                              + ', ' + error['Code'] + ': ' + error['Message'], 'yellow'))
 
-    # Delete the gc log file
-    interface.delete_object(conn, config['remote_garbage_object_log_file'])
+    # unlock
+    fcntl.flock(lockfile, fcntl.LOCK_UN)
+    os.remove(lockfile_path)
+    lockfile.close()
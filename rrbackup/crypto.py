@@ -100,6 +100,14 @@ class streaming_encrypt:
             chunk = res
         self.child.next_chunk(chunk); self.chunk_id += 1
 
+def streaming_overhead(pl_format: dict):
+    """ Bytes added to a streamed object by encryption, as a tuple of (bytes before the
+    first chunk, bytes added to each chunk) """
+    if 'encrypt' in pl_format['format']:
+        return (pysodium.crypto_secretstream_xchacha20poly1305_HEADERBYTES,
+                pysodium.crypto_secretstream_xchacha20poly1305_ABYTES)
+    return 0, 0
+
 class streaming_decrypt:
     def __init__(self, child):
         self.child           = child
@@ -136,3 +144,26 @@ class streaming_decrypt:
             return msg
         else:
             return self.child.next_chunk()
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class seekable_decrypt:
+    """ Decrypts the chunks of a streamed object out of order. Each chunk can only be
+    decrypted with the stream state left by the chunk before it, so the state is kept
+    for every chunk reached, and reading a chunk not yet reached means decrypting
+    forward from the nearest earlier one. """
+
+    def __init__(self, config, pipeline_header: bytes, stream_header: bytes):
+        self.pipeline_header = pipeline_header
+        key = config['crypto']['stream_crypt_key']
+        self.states = {0 : pysodium.crypto_secretstream_xchacha20poly1305_init_pull(stream_header, key)}
+
+    def nearest_state(self, index: int) -> int:
+        """ Index of the nearest chunk at or before 'index' which can be decrypted """
+        return max(i for i in self.states if i <= index)
+
+    def decrypt(self, index: int, chunk: bytes) -> bytes:
+        # the state is updated in place by libsodium, so a copy is used
+        state = bytes(bytearray(self.states[index]))
+        msg = pysodium.crypto_secretstream_xchacha20poly1305_pull(state, chunk, self.pipeline_header)[0]
+        self.states[index + 1] = state
+        return msg
@@ -0,0 +1,115 @@
+"""
+Long running backup service. Starting rrbackup connects to S3, derives the encryption
+keys and reads the local manifest, all of which are repeated on every run when backups
+are run frequently from cron. The service does this once, then runs a backup every
+'daemon_interval' seconds, keeping the manifest and the index used for de-duplication
+in memory between them.
+
+While it runs, queries are answered over a Unix socket at 'daemon_socket' from the
+state it holds. A request is a single line of JSON, {"command" : name, "args" : [...]},
+answered by a single line, {"result" : ...} or {"error" : message}. The socket is
+only accessible to the user running the service.
+"""
+import os, json, time, socket, signal, threading, traceback, socketserver
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['daemon_socket']          = 'rrbackup.sock'   # Unix socket the backup service answers queries on
+    config['daemon_interval']        = 900               # Seconds from the start of one backup to the next
+    config['daemon_cached_versions'] = 4                 # Number of version file lists kept in memory by the service
+    return config
+
+def validate_config(config: dict):
+    if 'daemon_interval' in config and (not isinstance(config['daemon_interval'], (int, float)) or config['daemon_interval'] <= 0):
+        raise SystemExit('daemon_interval in conf file must be a number of seconds greater than 0')
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class query_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try: request = json.loads(line)
+            except ValueError: request = None
+
+            if not isinstance(request, dict) or 'command' not in request:
+                response = {'error' : 'Invalid request'}
+            elif request['command'] not in self.server.queries:
+                response = {'error' : 'Unknown command'}
+            else:
+                response = self.answer(request)
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    def answer(self, request: dict) -> dict:
+        try:
+            return {'result' : self.server.queries[request['command']](*(request['args'] if 'args' in request else []))}
+        except SystemExit as e:
+            return {'error' : str(e)}
+        except Exception as e: # pylint: disable=broad-except
+            return {'error' : type(e).__name__ + ': ' + str(e)}
+
+class query_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, queries: dict):
+        self.queries = queries
+        super().__init__(path, query_handler)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def query(config: dict, command: str, args = None):
+    """ Send a query to a running service and return the result. Raises OSError if the
+    service is not running, and SystemExit if the query fails. """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(config['daemon_socket'])
+        sock.sendall(json.dumps({'command' : command, 'args' : args or []}).encode('utf-8') + b'\n')
+
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+
+    if line == b'': raise ConnectionError('The backup service closed the connection')
+    response = json.loads(line)
+    if 'error' in response: raise SystemExit(response['error'])
+    return response['result']
+
+def remove_stale_socket(path: str):
+    """ Remove a socket left by a service which did not shut down cleanly """
+    if not os.path.exists(path): return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try: sock.connect(path)
+        except ConnectionRefusedError: os.remove(path); return
+    raise SystemExit('The backup service is already running')
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def serve(config: dict, run_backup, queries: dict, stop: threading.Event = None):
+    """ Run 'run_backup' every 'daemon_interval' seconds, answering 'queries', a dict of
+    command names to functions returning something which can be encoded as JSON, until
+    'stop' is set or the process is interrupted. Failed backups are reported and retried
+    at the next interval. """
+    stop = stop if stop is not None else threading.Event()
+    interval = config['daemon_interval'] if 'daemon_interval' in config else 900
+    path = config['daemon_socket']
+
+    remove_stale_socket(path)
+    old_umask = os.umask(0o177)
+    try: server = query_server(path, queries)
+    finally: os.umask(old_umask)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    print('Listening on ' + path)
+
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try: run_backup()
+            except (Exception, SystemExit): # pylint: disable=broad-except
+                traceback.print_exc()
+                print('Backup failed, retrying in ' + str(interval) + ' seconds')
+
+            stop.wait(max(0, started + interval - time.monotonic()))
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(path)
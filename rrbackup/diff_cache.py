@@ -0,0 +1,101 @@
+"""
+Manifest diff versions are immutable once written, so after being downloaded
+and decoded they can be kept on the local disk and reused when the manifest
+is next rebuilt. Entries are keyed by version id, integrity checked when read
+and the cache is kept below a configured size by evicting the least recently
+used entries.
+"""
+import os, json, struct, hashlib, datetime
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['local_diff_cache_dir']  = None              # Directory used to cache manifest diffs, None disables the cache
+    config['local_diff_cache_size'] = 1048576 * 512     # Maximum size of the cache in bytes
+    return config
+
+def enabled(config: dict) -> bool:
+    return 'local_diff_cache_dir' in config and config['local_diff_cache_dir'] is not None
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def entry_path(config: dict, version_id: str) -> str:
+    return os.path.join(config['local_diff_cache_dir'], hashlib.sha256(version_id.encode('utf-8')).hexdigest())
+
+def digest(config: dict, version_id: str, record: bytes) -> bytes:
+    """ Entries are authenticated with the encryption key when one is configured, otherwise
+    a plain hash is used which detects corruption but not deliberate modification. """
+    key = config['crypto']['stream_crypt_key'] if 'crypto' in config and 'stream_crypt_key' in config['crypto'] else b''
+    hsh = hashlib.blake2b(key=key, digest_size=32)
+    hsh.update(version_id.encode('utf-8'))
+    hsh.update(record)
+    return hsh.digest()
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def get(config: dict, version_id: str):
+    """ Returns the cached (data, meta) for a diff version, or None if it is not cached
+    or the cached copy fails the integrity check. """
+    if not enabled(config) or version_id is None: return None
+
+    path = entry_path(config, version_id)
+    try:
+        with open(path, 'rb') as fle: raw = fle.read()
+    except IOError: return None
+
+    record = raw[32:]
+    if len(raw) < 36 or digest(config, version_id, record) != raw[:32]:
+        print('Discarding corrupt cache entry for diff version ' + version_id)
+        try: os.remove(path)
+        except OSError: pass
+        return None
+
+    meta_length = struct.unpack('!I', record[:4])[0]
+    cached_meta = json.loads(record[4 : 4 + meta_length])
+    data = record[4 + meta_length:]
+
+    # touch the entry so eviction is least recently used
+    try: os.utime(path)
+    except OSError: pass
+
+    meta = {'path'          : cached_meta['path'],
+            'version_id'    : version_id,
+            'header'        : cached_meta['header'].encode('utf-8'),
+            'last_modified' : datetime.datetime.fromisoformat(cached_meta['last_modified'])}
+    return data, meta
+
+def put(config: dict, version_id: str, data: bytes, meta: dict):
+    """ Store a decoded diff version, written using write and move for atomicity """
+    if not enabled(config) or version_id is None: return
+
+    os.makedirs(config['local_diff_cache_dir'], exist_ok=True)
+
+    cached_meta = json.dumps({'path'          : meta['path'],
+                              'header'        : meta['header'].decode('utf-8'),
+                              'last_modified' : meta['last_modified'].isoformat()}).encode('utf-8')
+    record = struct.pack('!I', len(cached_meta)) + cached_meta + data
+
+    path = entry_path(config, version_id)
+    with open(path + '.tmp', 'wb') as fle:
+        fle.write(digest(config, version_id, record) + record)
+    os.rename(path + '.tmp', path)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def evict(config: dict):
+    """ Remove least recently used entries until the cache is within its size limit """
+    if not enabled(config): return
+
+    try: names = os.listdir(config['local_diff_cache_dir'])
+    except OSError: return
+
+    entries = []
+    for name in names:
+        path = os.path.join(config['local_diff_cache_dir'], name)
+        try: st = os.stat(path)
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= config['local_diff_cache_size']: break
+        try: os.remove(path)
+        except OSError: pass
+        total -= size
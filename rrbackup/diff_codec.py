@@ -0,0 +1,196 @@
+"""
+Compact binary encoding of manifest diffs and snapshots. The JSON encoding
+repeats every key and every directory name for each file and stores hashes as
+hex, so the diffs written by initial backups of large trees are very large.
+
+The layout is:
+
+    magic 'RRD' and format version byte
+    meta           : varint length, JSON object
+    directory table: varint count, then varint length and utf8 for each
+    version table  : varint count, then varint length and utf8 for each
+    entry count    : varint
+    entries        : varint flags, varint status, varint directory index,
+                     varint length and utf8 of the name, then the fields
+                     selected by the flags in the order of the flag bits
+
+Directories and version ids are dictionary coded, sha256 hashes are stored as
+32 raw bytes, floating point times as 8 byte doubles and sizes, nanosecond
+times and inode numbers as varints. 'real_path' takes no
+space when it is the same as 'path'. Anything else is kept in a per-entry JSON
+object. Decoding produces fsutil.manifest_entry objects.
+
+Objects using this encoding are marked by an 'encoding' item in their pipeline
+header, anything without one is JSON.
+"""
+import json, struct, sys
+from rrbackup.fsutil.compact import manifest_entry, MISSING, SAME_PATH, hash_key
+
+MAGIC   = b'RRD'
+VERSION = 2
+FORMAT  = 'rrd2'   # identifier stored in the pipeline header
+
+# version 1 is version 2 without the integer file state fields
+SUPPORTED_VERSIONS = [1, 2]
+
+STATUSES = [None, 'new', 'changed', 'deleted', 'moved']
+
+F_CREATED        = 1
+F_LAST_MOD       = 2
+F_DIGEST         = 4
+F_HASH_STRING    = 8
+F_REAL_PATH_SAME = 16
+F_REAL_PATH      = 32
+F_VERSION        = 64
+F_EXTRA          = 128
+F_SIZE           = 256
+F_MTIME_NS       = 512
+F_CTIME_NS       = 1024
+F_INODE          = 2048
+
+# integer fields, stored as varints
+INT_FIELDS = ((F_SIZE, 'size'), (F_MTIME_NS, 'mtime_ns'), (F_CTIME_NS, 'ctime_ns'), (F_INODE, 'inode'))
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def write_varint(out: bytearray, value: int):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_string(out: bytearray, value: str):
+    data = value.encode('utf-8')
+    write_varint(out, len(data))
+    out += data
+
+class reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data); self.pos = 0
+
+    def varint(self) -> int:
+        result = shift = 0
+        while True:
+            byte = self.data[self.pos]; self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80: return result
+            shift += 7
+
+    def raw(self, length: int) -> bytes:
+        if self.pos + length > len(self.data): raise ValueError('Truncated diff')
+        res = bytes(self.data[self.pos : self.pos + length]); self.pos += length
+        return res
+
+    def string(self) -> str:
+        return self.raw(self.varint()).decode('utf-8')
+
+    def double(self) -> float:
+        return struct.unpack('!d', self.raw(8))[0]
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def encode(items, meta: dict = None) -> bytes:
+    """ Encode a list of manifest items, a diff or a full manifest, with an optional
+    dict of metadata which must be JSON serialisable. """
+
+    directories = {}; versions = {}
+    body = bytearray(); count = 0
+
+    for item in items:
+        count += 1
+        entry = item if isinstance(item, manifest_entry) else manifest_entry(item)
+        extra = dict(entry.extra) if entry.extra is not MISSING else {}
+        flags = 0; fields = bytearray()
+
+        status = extra.pop('status', None)
+        if status not in STATUSES: extra['status'] = status; status = None
+
+        for flag, value in ((F_CREATED, entry.created), (F_LAST_MOD, entry.last_mod)):
+            if isinstance(value, float):
+                flags |= flag; fields += struct.pack('!d', value)
+            elif value is not MISSING:
+                extra['created' if flag == F_CREATED else 'last_mod'] = value
+
+        if isinstance(entry.digest, bytes) and len(entry.digest) == 32:
+            flags |= F_DIGEST; fields += entry.digest
+        elif isinstance(entry.digest, str):
+            flags |= F_HASH_STRING; write_string(fields, entry.digest)
+        elif entry.digest is not MISSING:
+            extra['hash'] = entry.digest
+
+        if entry.real_path_ is SAME_PATH:
+            flags |= F_REAL_PATH_SAME
+        elif isinstance(entry.real_path_, str):
+            flags |= F_REAL_PATH; write_string(fields, entry.real_path_)
+        elif entry.real_path_ is not MISSING:
+            extra['real_path'] = entry.real_path_
+
+        if isinstance(entry.version_id, str):
+            flags |= F_VERSION; write_varint(fields, versions.setdefault(entry.version_id, len(versions)))
+        elif entry.version_id is not MISSING:
+            extra['version_id'] = entry.version_id
+
+        for flag, key in INT_FIELDS:
+            value = getattr(entry, key)
+            if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+                flags |= flag; write_varint(fields, value)
+            elif value is not MISSING:
+                extra[key] = value
+
+        if extra != {}:
+            flags |= F_EXTRA; write_string(fields, json.dumps(extra))
+
+        write_varint(body, flags)
+        write_varint(body, STATUSES.index(status))
+        write_varint(body, 0 if entry.directory is MISSING else directories.setdefault(entry.directory, len(directories)) + 1)
+        write_string(body, entry.name)
+        body += fields
+
+    out = bytearray(MAGIC); out.append(VERSION)
+    write_string(out, json.dumps(meta if meta is not None else {}))
+
+    for table in (directories, versions):
+        write_varint(out, len(table))
+        for value in table: write_string(out, value)   # dicts preserve insertion order, which is the index
+
+    write_varint(out, count)
+    return bytes(out + body)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def decode(data: bytes):
+    """ Decode to a tuple of (meta, list of manifest_entry) """
+
+    if data[:3] != MAGIC: raise ValueError('Not an encoded diff')
+    if data[3] not in SUPPORTED_VERSIONS: raise ValueError('Unsupported diff encoding version ' + str(data[3]))
+
+    rdr = reader(data); rdr.pos = 4
+    meta = json.loads(rdr.string())
+
+    directories = [sys.intern(rdr.string()) for _ in range(rdr.varint())]
+    versions    = [sys.intern(rdr.string()) for _ in range(rdr.varint())]
+
+    items = []
+    for _ in range(rdr.varint()):
+        entry = manifest_entry()
+        flags  = rdr.varint()
+        status = STATUSES[rdr.varint()]
+        dir_index = rdr.varint()
+        if dir_index > 0: entry.directory = directories[dir_index - 1]
+        entry.name = rdr.string()
+
+        if flags & F_CREATED:        entry.created    = rdr.double()
+        if flags & F_LAST_MOD:       entry.last_mod   = rdr.double()
+        if flags & F_DIGEST:         entry.digest     = rdr.raw(32)
+        if flags & F_HASH_STRING:    entry.digest     = hash_key(rdr.string())
+        if flags & F_REAL_PATH_SAME: entry.real_path_ = SAME_PATH
+        if flags & F_REAL_PATH:      entry.real_path_ = rdr.string()
+        if flags & F_VERSION:        entry.version_id = versions[rdr.varint()]
+
+        for flag, key in INT_FIELDS:
+            if flags & flag: setattr(entry, key, rdr.varint())
+
+        if flags & F_EXTRA:
+            for key, value in json.loads(rdr.string()).items(): entry[key] = value
+        if status is not None: entry['status'] = status
+
+        items.append(entry)
+
+    return meta, items
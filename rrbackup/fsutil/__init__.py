@@ -1,5 +1,6 @@
-import os.path, fnmatch, json, hashlib, copy
+import os.path, fnmatch, json, hashlib, heapq, tempfile
 from collections import defaultdict
+from .compact import manifest_entry, to_entry, hash_key, entry_hash_key, json_default, json_object_hook
 
 ############################################################################################
 def force_unicode(text):
@@ -72,9 +73,14 @@ def get_single_file_info(f_path, int_path):
     """ Gets the creates and last change times for a single file,
     f_path is the path to the file on disk, int_path is an internal
     path relative to a root directory.  """
-    return { 'path'     : force_unicode(int_path),
-             'created'  : os.path.getctime(f_path),
-             'last_mod' : os.path.getmtime(f_path)}
+    stat = os.stat(f_path)
+    return manifest_entry({ 'path'     : force_unicode(int_path),
+                            'created'  : stat.st_ctime,
+                            'last_mod' : stat.st_mtime,
+                            'mtime_ns' : stat.st_mtime_ns,
+                            'ctime_ns' : stat.st_ctime_ns,
+                            'size'     : stat.st_size,
+                            'inode'    : stat.st_ino})
 
 ############################################################################################
 def hash_file(file_path, block_size = 65536):
@@ -88,10 +94,11 @@ def hash_file(file_path, block_size = 65536):
     return sha.hexdigest()
 
 ############################################################################################
-def get_file_list(path, ignore_filters = None, visit_mountpoints = True):
-    """ Recursively lists all files in a file system below 'path'. """
-    f_list = []
-    read_errors = []
+def iter_file_list(path, ignore_filters = None, visit_mountpoints = True, read_errors = None):
+    """ Recursively lists all files in a file system below 'path', yielding them as they are
+    found. Paths which could not be read are appended to 'read_errors' if it is given. """
+    if read_errors is None: read_errors = []
+
     def recur_dir(path, newpath = os.path.sep):
         try: files = os.listdir(path)
         except OSError:
@@ -111,17 +118,60 @@ def get_file_list(path, ignore_filters = None, visit_mountpoints = True):
 
             if visit_path:
                 if os.path.isdir(f_path):
-                    recur_dir(f_path, cpjoin(newpath, fle))
+                    yield from recur_dir(f_path, cpjoin(newpath, fle))
                 elif os.path.isfile(f_path):
                     try:
                         open(f_path, 'r').close()
-                        f_list.append(get_single_file_info(f_path, cpjoin(newpath, fle)))
+                        yield get_single_file_info(f_path, cpjoin(newpath, fle))
                     except IOError:
                         read_errors.append(f_path)
 
-    recur_dir(path)
+    yield from recur_dir(path)
+
+############################################################################################
+def get_file_list(path, ignore_filters = None, visit_mountpoints = True):
+    """ Recursively lists all files in a file system below 'path'. """
+    read_errors = []
+    f_list = list(iter_file_list(path, ignore_filters, visit_mountpoints, read_errors))
     return f_list, read_errors
 
+############################################################################################
+def external_sort(items, key, run_size = 1000000, tmp_dir = None):
+    """ Sort an iterable of manifest items which may not fit in memory. Items are sorted in
+    runs of 'run_size', which are spilled to temporary files if there is more than one,
+    and the runs are merged as the result is iterated. At most one run is held in memory. """
+
+    items = iter(items)
+    run = []
+    for item in items:
+        run.append(item)
+        if len(run) >= run_size: break
+    else:
+        # everything fits in a single run, no need to touch the disk
+        run.sort(key = key)
+        yield from run
+        return
+
+    with tempfile.TemporaryDirectory(dir = tmp_dir) as spill_dir:
+        run_files = []
+        while run != []:
+            run.sort(key = key)
+            run_path = os.path.join(spill_dir, str(len(run_files)))
+            with open(run_path, 'w') as fle:
+                for item in run: fle.write(json.dumps(item, default = json_default) + '\n')
+            run_files.append(run_path)
+
+            run = []
+            for item in items:
+                run.append(item)
+                if len(run) >= run_size: break
+
+        def read_run(run_path):
+            with open(run_path, 'r') as fle:
+                for line in fle: yield json.loads(line, object_hook = json_object_hook)
+
+        yield from heapq.merge(*[read_run(run_path) for run_path in run_files], key = key)
+
 ############################################################################################
 def make_dict(s_list):
     """ Convert file list into a dictionary with the file path as its key, and meta data
@@ -129,8 +179,55 @@ def make_dict(s_list):
     return { l_itm['path'] : l_itm for l_itm in s_list}
 
 ############################################################################################
-def find_manifest_changes(new_file_state, old_file_state):
-    """ Find what has changed between two sets of files """
+CHANGE_POLICIES = {'mtime'      : [],
+                   'size_mtime' : ['size', 'mtime_ns'],
+                   'ctime'      : ['size', 'mtime_ns', 'ctime_ns', 'inode']}
+
+# Files modified within this long before the previous scan started may have been
+# modified again without their time stamp changing, on file systems with coarse times
+RACY_WINDOW_NS = 2 * 10**9
+
+def file_changed(new_itm, old_itm, policy = 'size_mtime', racy_ns = None):
+    """ Has a file changed since its state was recorded in the manifest. The 'mtime' policy
+    compares the floating point modification time only, 'size_mtime' the size and modification
+    time in nanoseconds, and 'ctime' also the inode and inode change time, which catches
+    rewrites that restore the modification time. Items in older manifests may not record the
+    new fields, which are then not compared, falling back to the floating point time.
+
+    If 'racy_ns' is given, files which were modified at or after it when they were recorded are
+    always treated as changed, see RACY_WINDOW_NS. """
+
+    fields = CHANGE_POLICIES[policy]
+
+    if 'mtime_ns' not in fields or 'mtime_ns' not in new_itm or 'mtime_ns' not in old_itm:
+        if new_itm['last_mod'] != old_itm['last_mod']: return True
+
+    for field in fields:
+        if field in new_itm and field in old_itm and new_itm[field] != old_itm[field]: return True
+
+    return racy_ns is not None and 'mtime_ns' in old_itm and old_itm['mtime_ns'] >= racy_ns
+
+def racy_change(new_itm, old_itm, policy = 'size_mtime', racy_ns = None):
+    """ Change of a file compared as file_changed, or None if it has not changed. A file which
+    is only treated as changed because it was recorded within the racy window is given the
+    hash it was recorded with as 'racy_hash', so that it can be dropped by hash_new_files if
+    its contents turn out to be the same. """
+    if file_changed(new_itm, old_itm, policy): return with_status(new_itm, 'changed')
+    if not file_changed(new_itm, old_itm, policy, racy_ns): return None
+
+    change = with_status(new_itm, 'changed')
+    if 'hash' in old_itm: change['racy_hash'] = old_itm['hash']
+    return change
+
+############################################################################################
+def with_status(itm, status):
+    n_itm = itm.copy()
+    n_itm['status'] = status
+    return n_itm
+
+############################################################################################
+def find_manifest_changes(new_file_state, old_file_state, policy = 'size_mtime', racy_ns = None):
+    """ Find what has changed between two sets of files, see file_changed for the policy """
     prev_state_dict = make_dict(old_file_state)
 
     changed_files = {}
@@ -141,75 +238,165 @@ def find_manifest_changes(new_file_state, old_file_state):
             d_itm = prev_state_dict.pop(itm['path'])
 
             # If the file has been modified
-            if itm['last_mod'] != d_itm['last_mod']:
-                n_itm = itm.copy()
-                n_itm['status'] = 'changed'
-                changed_files[itm['path']] = n_itm
+            change = racy_change(itm, d_itm, policy, racy_ns)
+            if change is not None:
+                changed_files[itm['path']] = change
             else:
                 pass # The file has not changed
 
         else:
             # anything here was not found in the remote manifest is new on the server
-            n_itm = itm.copy()
-            n_itm['status'] = 'new'
-            changed_files[itm['path']] = n_itm
+            changed_files[itm['path']] = with_status(itm, 'new')
 
     # any files remaining in the remote manifest have been deleted locally
     for itm in prev_state_dict.values():
-        n_itm = itm.copy()
-        n_itm['status'] = 'deleted'
-        changed_files[itm['path']] = n_itm
+        changed_files[itm['path']] = with_status(itm, 'deleted')
 
     return changed_files
 
+############################################################################################
+def iter_manifest_changes(new_file_state, old_file_state, policy = 'size_mtime', racy_ns = None):
+    """ Find what has changed between two sets of files, as find_manifest_changes, given
+    as iterables which are both sorted by path. The changes are found by a merge join,
+    so neither set has to be held in memory, and are yielded in path order. """
+
+    new_iter = iter(new_file_state); old_iter = iter(old_file_state)
+    new_itm = next(new_iter, None);  old_itm = next(old_iter, None)
+
+    while new_itm is not None or old_itm is not None:
+        if old_itm is None or (new_itm is not None and new_itm['path'] < old_itm['path']):
+            yield with_status(new_itm, 'new')
+            new_itm = next(new_iter, None)
+
+        elif new_itm is None or old_itm['path'] < new_itm['path']:
+            yield with_status(old_itm, 'deleted')
+            old_itm = next(old_iter, None)
+
+        else:
+            change = racy_change(new_itm, old_itm, policy, racy_ns)
+            if change is not None: yield change
+            new_itm = next(new_iter, None); old_itm = next(old_iter, None)
+
 
 ############################################################################################
 def hash_new_files(diff, base_path):
     processed_files = []
     for val in diff:
         fpath = cpjoin(base_path, val['path'])
-        if val['status'] in ['new', 'changed']: val['hash'] = force_unicode(hash_file(fpath))
+        # files hashed while detecting moves do not need hashing again
+        if val['status'] in ['new', 'changed'] and 'hash' not in val: val['hash'] = force_unicode(hash_file(fpath))
+
+        # files only re-checked because of the racy window are dropped if their contents are the same
+        if 'racy_hash' in val and val.pop('racy_hash') == val['hash']: continue
         processed_files.append(val)
     return processed_files
 
+############################################################################################
+def same_file_state(new_itm, old_itm):
+    """ Does a newly scanned file have the same size and modification time as a manifest item """
+    return not file_changed(new_itm, old_itm, 'size_mtime')
+
+def detect_moved_files(changed_files, base_path, skip_delete = None):
+    """ Replace pairs of deleted and new files, as found by find_manifest_changes, which are
+    the same file at a different path with a single 'moved' change. Renaming a file keeps its
+    inode, size and modification time, so a match on these is taken as a move. Items in older
+    manifests have no inode, a match on size and modification time is then confirmed by
+    hashing the new file. Deleted files matching 'skip_delete' are never moved.
+
+    A moved change holds only the new path and file state, along with 'moved_from'. The
+    hash and stored object are taken from the entry at 'moved_from' when it is replayed. """
+
+    deleted_by_inode = defaultdict(list)
+    deleted_by_time  = defaultdict(list)
+    for itm in changed_files.values():
+        if itm['status'] != 'deleted' or 'hash' not in itm: continue
+        if skip_delete is not None and filter_helper(itm['path'], skip_delete): continue
+        if 'inode' in itm: deleted_by_inode[itm['inode']].append(itm)
+        deleted_by_time[itm['last_mod']].append(itm)
+
+    moved = {}      # moved change by new path
+    moved_from = {} # old path -> new path
+
+    for itm in changed_files.values():
+        if itm['status'] != 'new': continue
+
+        candidates = [d for d in deleted_by_inode[itm['inode']] if d['path'] not in moved_from
+                      and same_file_state(itm, d)] if 'inode' in itm else []
+        source = candidates[0] if candidates != [] else None
+
+        if source is None:
+            candidates = [d for d in deleted_by_time[itm['last_mod']] if d['path'] not in moved_from
+                          and same_file_state(itm, d)]
+            if candidates == []: continue
+
+            # the new file may have been removed since it was listed
+            try: itm['hash'] = force_unicode(hash_file(cpjoin(base_path, itm['path'])))
+            except (IOError, OSError): continue
+            source = next((d for d in candidates if d['hash'] == itm['hash']), None)
+            if source is None: continue
+
+        change = itm.copy()
+        if 'hash' in change: del change['hash']
+        change['status'] = 'moved'
+        change['moved_from'] = source['path']
+        moved[itm['path']] = change
+        moved_from[source['path']] = itm['path']
+
+    if moved == {}: return changed_files
+
+    result = {}
+    for path, itm in changed_files.items():
+        if itm['status'] == 'deleted' and path in moved_from: continue
+        result[path] = moved[path] if path in moved else itm
+    return result
+
+###########################################################################################
+class manifest_replay:
+    """ Applies a progression of diffs to a manifest. The manifest is held as a single
+    dict keyed by path, which preserves insertion order, so each diff is applied at a
+    cost proportional to the number of changes it contains rather than the size of the
+    manifest. The list form is only built when requested. Entries are stored in the
+    compact manifest_entry form. """
+
+    def __init__(self, manifest = None):
+        self.files = {}
+        if manifest is not None:
+            for item in manifest: self.files[item['path']] = to_entry(item)
+
+    def apply(self, diff):
+        # moved items take anything they do not record themselves from the item they were moved from
+        sources = {change['path'] : self.files.get(change['moved_from'])
+                   for change in diff if change['status'] == 'moved'}
+
+        # remove deleted, changed and moved items, anything else in the diff which
+        # already exists in the manifest is a duplicate and is treated as an update
+        for change in diff:
+            if change['status'] == 'moved': self.files.pop(change['moved_from'], None)
+            self.files.pop(change['path'], None)
+
+        # add new and changed items, removing the 'status' key
+        for change in diff:
+            if change['status'] in ['new', 'changed', 'moved']:
+                source = sources.get(change['path']) if change['status'] == 'moved' else None
+                if source is None:
+                    item = to_entry(change)
+                else:
+                    item = source.copy()
+                    for key, value in change.items(): item[key] = value
+                del item['status']
+                self.files[item['path']] = item
+
+    def to_list(self):
+        return list(self.files.values())
+
 ###########################################################################################
 def apply_diffs(diffs, manifest):
     """ Apply a series of differences to a manifest
-    diffs is an list(diffs) of list(diff) of dict(change item) """
-
-    manifest = copy.deepcopy(manifest)
-
-    # helper which removes the 'status' key from a diff
-    key_filter = lambda item : { key : value for key, value in item.items() if key != 'status'}
-
-    for diff in diffs:
-        # dict used to find duplicate items between the diff and manifest
-        manifest_dict = {item['path'] : None for item in manifest}
-
-        # dict used to remove items that have been moved
-        moved = {change['moved_from'] : None for change in diff if change['status'] == 'moved'}
-
-        # remove deleted, changed and moved items from manifest
-        # and filter the result to remove the 'status' key
-        deleted = {item['path'] : None for item in diff
-            if item['status'] == 'deleted'
-            or item['status'] == 'changed'
-            or item['status'] == 'moved'
-            or item['path'] in manifest_dict} # treat duplicate items as updates
-
-        applied = [key_filter(item) for item in manifest
-            if  item['path'] not in deleted
-            and item['path'] not in moved]
-
-        # add new and changed items
-        applied += [key_filter(item) for item in diff
-            if item['status'] == 'new'
-            or item['status'] == 'changed'
-            or item['status'] == 'moved']
-
-        manifest = applied
+    diffs is an iterable(diffs) of list(diff) of dict(change item) """
 
-    return manifest
+    replay = manifest_replay(manifest)
+    for diff in diffs: replay.apply(diff)
+    return replay.to_list()
 
 ############################################################################################
 def filter_helper(file_path, ignore_filters):
@@ -0,0 +1,185 @@
+"""
+Compact in-memory representation of manifest entries. A manifest may hold
+millions of files, and a dict per file with repeated string keys and hex
+hashes costs several times the memory of the information it holds.
+
+manifest_entry stores the common fields in slots: the directory part of the
+path is interned so it is shared by every file in that directory, sha256
+hashes are held as 32 raw bytes, and 'real_path' is not stored at all when it
+is the same as 'path'. The times, size and inode recorded for change detection
+also have slots. Anything else goes in a small overflow dict. Entries
+behave as mutable mappings, so existing code which treats manifest entries as
+dicts keeps working, and compare equal to dicts holding the same items.
+"""
+import sys
+from collections.abc import Mapping, MutableMapping
+
+MISSING   = object()     # slot value of a key which is not present
+SAME_PATH = object()     # real_path slot value when real_path is equal to path
+
+def hash_key(value):
+    """ Binary form of a hex sha256 hash. Anything which is not one is kept as it is. """
+    if isinstance(value, str) and len(value) == 64:
+        try: return bytes.fromhex(value)
+        except ValueError: pass
+    return value
+
+############################################################################################
+class manifest_entry(MutableMapping):
+    """ A single file in the manifest, see module documentation """
+
+    __slots__ = ('directory', 'name', 'digest', 'real_path_', 'created', 'last_mod', 'version_id',
+                 'size', 'mtime_ns', 'ctime_ns', 'inode', 'extra')
+
+    # keys which are stored unchanged in a slot of the same name
+    plain_fields = ('created', 'last_mod', 'version_id', 'size', 'mtime_ns', 'ctime_ns', 'inode')
+
+    def __init__(self, data = None):
+        self.directory = self.name = self.digest = self.real_path_ = MISSING
+        self.created = self.last_mod = self.version_id = self.extra = MISSING
+        self.size = self.mtime_ns = self.ctime_ns = self.inode = MISSING
+        if data is None: return
+
+        # This is the hot path when loading a manifest, so the common keys are set directly
+        real_path = MISSING
+        for key, value in data.items():
+            if   key == 'path':       self.set_path(value)
+            elif key == 'hash':       self.digest = hash_key(value)
+            elif key == 'real_path':  real_path = value
+            elif key == 'created':    self.created = value
+            elif key == 'last_mod':   self.last_mod = value
+            elif key == 'version_id': self.version_id = sys.intern(value) if isinstance(value, str) else value
+            elif key == 'size':       self.size = value
+            elif key == 'mtime_ns':   self.mtime_ns = value
+            elif key == 'ctime_ns':   self.ctime_ns = value
+            elif key == 'inode':      self.inode = value
+            else:
+                if self.extra is MISSING: self.extra = {}
+                self.extra[key] = value
+
+        if real_path is not MISSING: self['real_path'] = real_path
+
+    #----
+    def get_path(self):
+        if self.name is MISSING: return MISSING
+        if self.directory is MISSING: return self.name
+        return self.directory + '/' + self.name
+
+    def set_path(self, path):
+        directory, sep, name = path.rpartition('/')
+        self.directory = sys.intern(directory) if sep else MISSING
+        self.name = name
+
+    #----
+    def __getitem__(self, key):
+        if key == 'path':
+            value = self.get_path()
+
+        elif key == 'hash':
+            value = self.digest
+            if isinstance(value, bytes): value = value.hex()
+
+        elif key == 'real_path':
+            value = self.get_path() if self.real_path_ is SAME_PATH else self.real_path_
+
+        elif key in manifest_entry.plain_fields:
+            value = getattr(self, key)
+
+        elif self.extra is not MISSING and key in self.extra:
+            return self.extra[key]
+
+        else: value = MISSING
+
+        if value is MISSING: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key == 'path':
+            real_path = self['real_path'] if 'real_path' in self else MISSING
+            self.set_path(value)
+            if real_path is not MISSING: self['real_path'] = real_path
+
+        elif key == 'hash':
+            self.digest = hash_key(value)
+
+        elif key == 'real_path':
+            self.real_path_ = SAME_PATH if value == self.get_path() else value
+
+        elif key == 'version_id':
+            self.version_id = sys.intern(value) if isinstance(value, str) else value
+
+        elif key in manifest_entry.plain_fields:
+            setattr(self, key, value)
+
+        else:
+            if self.extra is MISSING: self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self: raise KeyError(key)
+
+        if key == 'path':
+            if self.real_path_ is SAME_PATH: self.real_path_ = self.get_path()
+            self.directory = self.name = MISSING
+        elif key == 'hash':      self.digest = MISSING
+        elif key == 'real_path': self.real_path_ = MISSING
+        elif key in manifest_entry.plain_fields: setattr(self, key, MISSING)
+        else:
+            del self.extra[key]
+            if self.extra == {}: self.extra = MISSING
+
+    #----
+    def __contains__(self, key):
+        if key == 'path':      return self.name is not MISSING
+        if key == 'hash':      return self.digest is not MISSING
+        if key == 'real_path': return self.real_path_ is not MISSING
+        if key in manifest_entry.plain_fields: return getattr(self, key) is not MISSING
+        return self.extra is not MISSING and key in self.extra
+
+    def __iter__(self):
+        for key in ('path', 'created', 'last_mod', 'size', 'mtime_ns', 'ctime_ns', 'inode', 'hash', 'real_path', 'version_id'):
+            if key in self: yield key
+        if self.extra is not MISSING:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def copy(self):
+        new = manifest_entry()
+        new.directory  = self.directory;  new.name     = self.name
+        new.digest     = self.digest;     new.real_path_ = self.real_path_
+        new.created    = self.created;    new.last_mod = self.last_mod
+        new.version_id = self.version_id
+        new.size       = self.size;       new.mtime_ns = self.mtime_ns
+        new.ctime_ns   = self.ctime_ns;   new.inode    = self.inode
+        new.extra      = dict(self.extra) if self.extra is not MISSING else MISSING
+        return new
+
+    def __repr__(self):
+        return 'manifest_entry(' + repr(dict(self)) + ')'
+
+def entry_hash_key(item):
+    """ Key used to index manifest items by hash, without converting an entry's hash to hex """
+    if isinstance(item, manifest_entry): return item.digest
+    return hash_key(item['hash'])
+
+############################################################################################
+def to_entry(item):
+    """ Convert a dict to a manifest entry, entries are copied """
+    if isinstance(item, manifest_entry): return item.copy()
+    return manifest_entry(item)
+
+def json_default(obj):
+    """ Use as json.dumps(..., default = json_default) to serialise manifest entries """
+    if isinstance(obj, Mapping): return dict(obj)
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+def json_object_hook(item: dict):
+    """ Use as json.loads(..., object_hook = json_object_hook) to decode anything
+    with a path, as found in manifests and diffs, directly to manifest entries """
+    if 'path' in item: return manifest_entry(item)
+    return item
@@ -1,21 +1,22 @@
 from rrbackup.fsutil import *
+from rrbackup.fsutil.compact import SAME_PATH, MISSING
 from unittest import TestCase
-import subprocess, os
-
-def move_helper(status, path, hsh):
-    return {'status'   : status,
-            'path'     : path,
-            'created'  : '',
-            'last_mod' : '',
-            'hash'     : hsh}
-
-def res_helper(status, moved_from, path, hsh):
-    return {'status'    : status,
-            'path'      : path,
-            'moved_from': moved_from,
-            'created'   : '',
-            'last_mod'  : '',
-            'hash'      : hsh}
+import subprocess, shutil, os, json
+
+def deleted_helper(path, hsh, **state):
+    return dict({'status'     : 'deleted',
+                 'path'       : path,
+                 'last_mod'   : 1,
+                 'size'       : 3,
+                 'hash'       : hsh,
+                 'real_path'  : path,
+                 'version_id' : 'v1'}, **state)
+
+def new_helper(path, **state):
+    return dict({'status'   : 'new',
+                 'path'     : path,
+                 'last_mod' : 1,
+                 'size'     : 3}, **state)
 
 def get_state(path, last_mod):
     return {'path'     : path,
@@ -60,6 +61,65 @@ class TestCommon(TestCase):
         self.assertEqual(diff_5, {'/file_2': {'status': 'changed', 'path': '/file_2', 'last_mod': 20},
                                   '/file_1': {'status': 'deleted', 'path': '/file_1', 'last_mod': 20}})
 
+    def test_file_changed_policies(self):
+        old = {'path' : '/a', 'last_mod' : 1.0, 'size' : 3, 'mtime_ns' : 1000000000, 'ctime_ns' : 5, 'inode' : 7}
+
+        touched   = dict(old, mtime_ns = 1000000001)
+        resized   = dict(old, size = 4)
+        rewritten = dict(old, ctime_ns = 6, inode = 8)
+
+        self.assertEqual([file_changed(new, old, 'mtime') for new in [old, touched, resized, rewritten]],
+                         [False, False, False, False])
+        self.assertEqual([file_changed(new, old, 'size_mtime') for new in [old, touched, resized, rewritten]],
+                         [False, True, True, False])
+        self.assertEqual([file_changed(new, old, 'ctime') for new in [old, touched, resized, rewritten]],
+                         [False, True, True, True])
+
+        # items from older manifests only have the floating point time
+        legacy = {'path' : '/a', 'last_mod' : 1.0}
+        self.assertFalse(file_changed(touched, legacy, 'ctime'))
+        self.assertTrue(file_changed(dict(old, last_mod = 2.0), legacy, 'ctime'))
+
+        # files modified close to the previous scan are re-checked
+        self.assertTrue(file_changed(old, old, 'size_mtime', racy_ns = 1000000000))
+        self.assertFalse(file_changed(old, old, 'size_mtime', racy_ns = 1000000001))
+
+    def test_racy_changes_dropped_if_same(self):
+        file_put_contents('RACY_TEST_FILE', 'contents')
+        new = {'path' : '/RACY_TEST_FILE', 'last_mod' : 1.0, 'size' : 8, 'mtime_ns' : 1000000000}
+        old = dict(new, hash = hash_file('RACY_TEST_FILE'))
+
+        changes = find_manifest_changes([dict(new)], [old], racy_ns = 1000000000)
+        self.assertEqual(changes['/RACY_TEST_FILE']['racy_hash'], old['hash'])
+        self.assertEqual(hash_new_files(list(changes.values()), '.'), [])
+
+        # a file rewritten within the window is kept, without the racy marker
+        file_put_contents('RACY_TEST_FILE', 'CONTENTS')
+        changes = list(iter_manifest_changes([dict(new)], [old], racy_ns = 1000000000))
+        self.assertEqual([('racy_hash' in c, c['status']) for c in hash_new_files(changes, '.')], [(False, 'changed')])
+        os.remove('RACY_TEST_FILE')
+
+    def test_iter_manifest_changes(self):
+        old_state = [get_state('/a', 10), get_state('/b', 10), get_state('/d', 10)]
+        new_state = [get_state('/b', 20), get_state('/c', 10), get_state('/d', 10), get_state('/e', 10)]
+
+        result = list(iter_manifest_changes(new_state, old_state))
+        self.assertEqual(result, [{'status': 'deleted', 'path': '/a', 'last_mod': 10},
+                                  {'status': 'changed', 'path': '/b', 'last_mod': 20},
+                                  {'status': 'new',     'path': '/c', 'last_mod': 10},
+                                  {'status': 'new',     'path': '/e', 'last_mod': 10}])
+
+        self.assertEqual({i['path'] : i for i in result}, find_manifest_changes(new_state, old_state))
+
+    def test_external_sort(self):
+        items = [get_state('/file_%d' % ((i * 7) % 20), i) for i in range(20)]
+        key = lambda itm: itm['path']
+
+        # fits in one run, and spilled to disk in several runs
+        self.assertEqual(list(external_sort(items, key, run_size = 100)), sorted(items, key = key))
+        self.assertEqual(list(external_sort(items, key, run_size = 3)), sorted(items, key = key))
+        self.assertEqual(list(external_sort([], key, run_size = 3)), [])
+
     def test_apply_diffs_new_to_empty(self):
         manifest = []
         diff = [{'path'   : '/file1',
@@ -102,117 +162,104 @@ class TestCommon(TestCase):
         result = apply_diffs([diff], manifest)
         self.assertEqual(result, [])
 
-    def test_detect_moved_files_one(self):
-        return True
-        file_manifest = {'files' : [{'hash' : '12345',
-                                    'path' : '/test'}]}
-
-        diff          = [move_helper('delete', '/test', '12345'),
-                         move_helper('new', '/test2', '12345')]
+    def test_apply_diffs_sequence(self):
+        manifest = [{'path' : '/file1'}, {'path' : '/file2'}, {'path' : '/file3'}]
+        diffs = [[{'path' : '/file2', 'status' : 'changed', 'v' : 2},
+                  {'path' : '/file4', 'status' : 'new'}],
+                 [{'path' : '/file1', 'status' : 'deleted'},
+                  {'path' : '/file5', 'moved_from' : '/file3', 'status' : 'moved'}],
+                 [{'path' : '/file4', 'status' : 'new', 'v' : 3}]]
 
-        result = detect_moved_files(file_manifest, diff)
+        result = apply_diffs(diffs, manifest)
+        self.assertEqual(result, [{'path' : '/file2', 'v' : 2},
+                                  {'path' : '/file5', 'moved_from' : '/file3'},
+                                  {'path' : '/file4', 'v' : 3}])
 
-        self.assertEqual(result, [res_helper('moved', '/test', '/test2', '12345')])
+        # the input manifest must not be modified
+        self.assertEqual(manifest, [{'path' : '/file1'}, {'path' : '/file2'}, {'path' : '/file3'}])
 
     def test_detect_moved_files_multiple(self):
-        return True
-
-        file_manifest = {'files' : [{'hash' : '12345',
-                                    'path' : '/test'},
-                                    {'hash' : 'a12345',
-                                    'path' : '/test2'}]}
-
-        diff          = [move_helper('delete', '/test', '12345'),
-                         move_helper('new', '/a/test', '12345'),
-                         move_helper('delete', '/test2', 'a12345'),
-                         move_helper('new', '/a/test2', 'a12345')]
-
-        result = detect_moved_files(file_manifest, diff)
-
-        self.assertEqual(result, [res_helper('moved', '/test2', '/a/test2', 'a12345'),
-                                  res_helper('moved', '/test', '/a/test', '12345')])
+        changes = {'/test'     : deleted_helper('/test', '12345', inode = 7),
+                   '/test2'    : deleted_helper('/test2', 'a12345', inode = 8),
+                   '/test3'    : deleted_helper('/test3', 'b12345', inode = 9),
+                   '/a/test'   : new_helper('/a/test', inode = 7),
+                   '/a/test2'  : new_helper('/a/test2', inode = 8),
+                   '/a/test3n' : new_helper('/a/test3n', inode = 9, size = 4)}
+
+        # a reused inode with a different size is not a move
+        result = detect_moved_files(changes, 'not_read')
+        self.assertEqual([(i['status'], i['path'], i.get('moved_from')) for i in result.values()],
+                         [('deleted', '/test3', None),
+                          ('moved', '/a/test', '/test'),
+                          ('moved', '/a/test2', '/test2'),
+                          ('new', '/a/test3n', None)])
 
     def test_detect_moved_files_duplicates(self):
-        return True
-
-        file_manifest = {'files' : [{'hash' : '12345',
-                                    'path' : '/test'},
-                                    {'hash' : '12345',
-                                    'path' : '/test2'}]}
-
-        diff          = [move_helper('delete', '/test', '12345'),
-                         move_helper('new', '/a/test', '12345'),
-                         move_helper('delete', '/test2', '12345'),
-                         move_helper('new', '/a/test2', '12345')]
-
-        result = detect_moved_files(file_manifest, diff)
-
-        self.assertEqual(result, [res_helper('moved', '/test2', '/a/test2', '12345'),
-                                  res_helper('moved', '/test', '/a/test', '12345')])
-
-    def test_detect_moved_files_duplicates_with_rename(self):
-        return True
-
-        file_manifest = {'files' : [{'hash' : '12345',
-                                    'path' : '/test'},
-                                    {'hash' : '12345',
-                                    'path' : '/test2'}]}
-
-        diff          = [move_helper('delete', '/test', '12345'),
-                         move_helper('new', '/a/test', '12345'),
-                         move_helper('delete', '/test2', '12345'),
-                         move_helper('new', '/a/test2n', '12345')]
-
-        result = detect_moved_files(file_manifest, diff)
-
-        self.assertEqual(result, [res_helper('moved', '/test', '/a/test', '12345'),
-                                  res_helper('moved', '/test2', '/a/test2n', '12345')])
+        os.makedirs('MOVE_TEST_DIR/a', exist_ok = True)
+        file_put_contents('MOVE_TEST_DIR/a/test', 'same contents')
+        file_put_contents('MOVE_TEST_DIR/a/test2', 'same contents')
+        file_hash = hash_file('MOVE_TEST_DIR/a/test')
+
+        # items from older manifests have no inode, each deleted duplicate is moved to one new file
+        changes = {'/test'    : deleted_helper('/test', file_hash),
+                   '/test2'   : deleted_helper('/test2', file_hash),
+                   '/a/test'  : new_helper('/a/test'),
+                   '/a/test2' : new_helper('/a/test2')}
+        result = detect_moved_files(changes, 'MOVE_TEST_DIR')
+        self.assertEqual([(i['status'], i['path'], i.get('moved_from')) for i in result.values()],
+                         [('moved', '/a/test', '/test'), ('moved', '/a/test2', '/test2')])
+
+        # files kept when deleted are never moved from, the other duplicate still is
+        result = detect_moved_files(changes, 'MOVE_TEST_DIR', ['/test'])
+        self.assertEqual([(i['status'], i['path'], i.get('moved_from')) for i in result.values()],
+                         [('deleted', '/test', None), ('moved', '/a/test', '/test2'), ('new', '/a/test2', None)])
+
+        shutil.rmtree('MOVE_TEST_DIR')
 
     def test_detect_moved_files_new_duplicate_not_moved(self):
-        return True
-
-        file_manifest = {'files' : [{'path' : '/test',
-                                      'hash' : '12345'}]}
-
-        diff          = [move_helper('new', '/a/test', '12345')]
-
-        result = detect_moved_files(file_manifest, diff)
-
-        self.assertEqual(result, [move_helper('new', '/a/test', '12345')])
-
-
-    def test_detect_moved_files_duplicates_and_no_duplicates(self):
-        return True
-
-        file_manifest = {'files' : [{'hash' : '12345',
-                                    'path' : '/test'},
-                                    {'hash' : '12345',
-                                    'path' : '/test2'},
-                                    {'hash' : 'a12345',
-                                    'path' : '/test3'},
-                                    {'hash' : 'b12345',
-                                    'path' : '/test4'},
-                                    {'hash' : 'c12345',
-                                    'path' : '/test5'}]}
-
-        diff          = [move_helper('delete', '/test', '12345'),
-                         move_helper('new', '/a/test', '12345'),
-                         move_helper('delete', '/test2', '12345'),
-                         move_helper('new', '/a/test2', '12345'),
-                         move_helper('delete', '/test3', 'a12345'),
-                         move_helper('new', '/a/test3', 'a12345'),
-                         move_helper('delete', '/test4', 'b12345'),
-                         move_helper('new', '/a/test4', 'b12345'),
-                         move_helper('delete', '/test5', 'c12345'),
-                         move_helper('new', '/a/test5n', 'c12345')]
-
-        result = detect_moved_files(file_manifest, diff)
-
-        self.assertEqual(result, [res_helper('moved', '/test', '/a/test', '12345'),
-                                  res_helper('moved', '/test5', '/a/test5n', 'c12345'),
-                                  res_helper('moved', '/test3', '/a/test3', 'a12345'),
-                                  res_helper('moved', '/test2', '/a/test2', '12345'),
-                                  res_helper('moved', '/test4', '/a/test4', 'b12345')])
+        # a copy of a file which still exists is de-duplicated later, not moved
+        changes = {'/a/test' : new_helper('/a/test', inode = 8)}
+        self.assertEqual(detect_moved_files(changes, 'not_read'), {'/a/test' : new_helper('/a/test', inode = 8)})
+
+    def test_detect_moves_by_inode(self):
+        changes = {'/a' : {'status' : 'deleted', 'path' : '/a', 'last_mod' : 1, 'size' : 3, 'inode' : 7,
+                           'hash' : '12345', 'real_path' : '/a', 'version_id' : 'v1'},
+                   '/b' : {'status' : 'new', 'path' : '/b', 'last_mod' : 1, 'size' : 3, 'inode' : 7},
+                   '/c' : {'status' : 'new', 'path' : '/c', 'last_mod' : 1, 'size' : 4, 'inode' : 8}}
+
+        result = detect_moved_files(changes, 'not_read')
+        self.assertEqual(result, {'/b' : {'status' : 'moved', 'path' : '/b', 'moved_from' : '/a',
+                                          'last_mod' : 1, 'size' : 3, 'inode' : 7},
+                                  '/c' : changes['/c']})
+
+        # the moved item takes its hash and object from the item it was moved from
+        manifest = [{'path' : '/a', 'last_mod' : 1, 'size' : 3, 'inode' : 7,
+                     'hash' : '12345', 'real_path' : '/a', 'version_id' : 'v1'}]
+        self.assertEqual(apply_diffs([[result['/b']]], manifest),
+                         [{'path' : '/b', 'moved_from' : '/a', 'last_mod' : 1, 'size' : 3, 'inode' : 7,
+                           'hash' : '12345', 'real_path' : '/a', 'version_id' : 'v1'}])
+
+        # never move from files which are kept when deleted
+        self.assertEqual(detect_moved_files(changes, 'not_read', ['/a']), changes)
+
+    def test_detect_moves_confirmed_by_hash(self):
+        file_put_contents('MOVE_TEST_FILE', 'some file contents')
+        file_hash = hash_file('MOVE_TEST_FILE')
+
+        # items without an inode are only moved if the hash matches
+        changes = {'/a' : {'status' : 'deleted', 'path' : '/a', 'last_mod' : 1, 'hash' : file_hash},
+                   '/MOVE_TEST_FILE' : {'status' : 'new', 'path' : '/MOVE_TEST_FILE', 'last_mod' : 1}}
+        result = detect_moved_files(changes, os.getcwd())
+        self.assertEqual(list(result.values()), [{'status' : 'moved', 'path' : '/MOVE_TEST_FILE',
+                                                  'moved_from' : '/a', 'last_mod' : 1}])
+
+        changes['/a']['hash'] = '12345'
+        del changes['/MOVE_TEST_FILE']['hash']
+        result = detect_moved_files(changes, os.getcwd())
+        self.assertEqual(result['/MOVE_TEST_FILE']['status'], 'new')
+        self.assertEqual(result['/MOVE_TEST_FILE']['hash'], file_hash)
+
+        os.remove('MOVE_TEST_FILE')
 
     def test_filter_helper(self):
         self.assertFalse(filter_helper('/test/file', ['/test/file2']))
@@ -227,3 +274,53 @@ class TestCommon(TestCase):
         self.assertEqual(filter_file_list([{'path':'test'}], ['other']),
                          [{'path':'test'}])
 
+
+############################################################################################
+class TestManifestEntry(TestCase):
+    def test_dict_compatible(self):
+        item = {'path'       : '/dir/file',
+                'created'    : 1.0,
+                'last_mod'   : 2.0,
+                'hash'       : 'ab' * 32,
+                'real_path'  : '/dir/file',
+                'version_id' : 'v1',
+                'empty'      : True}
+        entry = manifest_entry(item)
+
+        self.assertEqual(entry, item)
+        self.assertEqual(dict(entry), item)
+        self.assertEqual(entry['hash'], 'ab' * 32)
+        self.assertTrue('empty' in entry)
+        self.assertFalse('moved_from' in entry)
+        self.assertEqual(entry.get('moved_from', 'x'), 'x')
+        self.assertEqual(json.loads(json.dumps(entry, default = json_default)), item)
+
+    def test_file_state_slots(self):
+        entry = manifest_entry({'path' : '/a', 'size' : 3, 'mtime_ns' : 4, 'ctime_ns' : 5, 'inode' : 6})
+        self.assertIs(entry.extra, MISSING)
+        self.assertEqual((entry.size, entry.mtime_ns, entry.ctime_ns, entry.inode), (3, 4, 5, 6))
+        self.assertEqual(entry.copy(), {'path' : '/a', 'size' : 3, 'mtime_ns' : 4, 'ctime_ns' : 5, 'inode' : 6})
+
+    def test_compact_storage(self):
+        entry_1 = manifest_entry({'path' : '/dir/file1', 'hash' : 'ab' * 32, 'real_path' : '/dir/file1'})
+        entry_2 = manifest_entry({'path' : '/d' + 'ir/file2'})
+
+        self.assertIs(entry_1.directory, entry_2.directory)
+        self.assertEqual(entry_1.digest, bytes.fromhex('ab' * 32))
+        self.assertIs(entry_1.real_path_, SAME_PATH)
+
+    def test_modify(self):
+        entry = manifest_entry({'path' : '/file', 'real_path' : '/file', 'hash' : 'short'})
+        copy = entry.copy()
+
+        entry['path'] = '/moved'
+        entry['status'] = 'new'
+        del entry['status']
+
+        self.assertEqual(entry, {'path' : '/moved', 'real_path' : '/file', 'hash' : 'short'})
+        self.assertEqual(copy, {'path' : '/file', 'real_path' : '/file', 'hash' : 'short'})
+
+    def test_json_object_hook(self):
+        result = json.loads('{"files" : [{"path" : "/file"}]}', object_hook = json_object_hook)
+        self.assertIsInstance(result, dict)
+        self.assertIsInstance(result['files'][0], manifest_entry)
@@ -0,0 +1,176 @@
+"""
+Storage of the local manifest. Two formats are supported, selected with
+'local_manifest_store'. The default 'json' stores the manifest as a flat JSON
+file which is rewritten in full after every commit. 'sqlite' stores it in an
+SQLite database in WAL mode at '<local_manifest_file>.db', where every
+committed diff is applied as a transactional delta and entries are indexed by
+path and hash. Both formats are crash consistent: after a crash the local
+manifest holds either the previous or the new state, never a mixture.
+"""
+import os, json, sqlite3
+import rrbackup.fsutil as sfs
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['local_manifest_store'] = 'json'     # Format of the local manifest, 'json' or 'sqlite'
+    return config
+
+def validate_config(config: dict):
+    if 'local_manifest_store' in config and config['local_manifest_store'] not in ['json', 'sqlite']:
+        raise SystemExit("local_manifest_store in conf file must be 'json' or 'sqlite'")
+
+def is_indexed(config: dict) -> bool:
+    """ Does the configured store support indexed lookups """
+    return 'local_manifest_store' in config and config['local_manifest_store'] == 'sqlite'
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def load(config: dict, with_files: bool = True) -> dict:
+    """ Read the local manifest, raises IOError if it does not exist. The SQLite store
+    can leave the file list out, in which case it is read with iter_sorted instead. """
+    if is_indexed(config): return sqlite_load(config, with_files)
+    return json.loads(sfs.file_get_contents(config['local_manifest_file']), object_hook = sfs.json_object_hook)
+
+def iter_sorted(config: dict, file_manifest: dict = None):
+    """ Iterate over the files in the local manifest sorted by path. The SQLite store
+    streams them from a consistent snapshot of the database, so commits made while the
+    iterator is in use are not seen by it. The JSON store sorts 'file_manifest'. """
+    if is_indexed(config): return sqlite_iter_sorted(config)
+    return iter(sorted(file_manifest['files'], key = lambda fle: fle['path']))
+
+def write(config: dict, file_manifest: dict):
+    """ Replace the local manifest with 'file_manifest' """
+    if is_indexed(config): return sqlite_write(config, file_manifest)
+
+    # done using write and move for atomicity
+    sfs.file_put_contents(config['local_manifest_file']+'.tmp', json.dumps(file_manifest, default = sfs.json_default))
+    os.rename(config['local_manifest_file']+'.tmp', config['local_manifest_file'])
+
+def commit(config: dict, file_manifest: dict, diff: list):
+    """ Record that 'diff' has been applied to the local manifest, giving 'file_manifest'.
+    The JSON store has to rewrite everything, the SQLite store only applies the diff. """
+    if is_indexed(config): return sqlite_commit(config, file_manifest, diff)
+    write(config, file_manifest)
+
+def find_by_path(config: dict, path: str):
+    """ Indexed lookup of a manifest entry by path, returns None if not found """
+    return sqlite_find(config, 'SELECT data FROM files WHERE path = ?', path)
+
+def find_by_hash(config: dict, file_hash: str):
+    """ Indexed lookup of the most recently added manifest entry with a given hash,
+    returns None if not found """
+    return sqlite_find(config, 'SELECT data FROM files WHERE hash = ? ORDER BY rowid DESC LIMIT 1', file_hash)
+
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+# SQLite store
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+connections = {}
+
+def sqlite_path(config: dict) -> str:
+    return config['local_manifest_file'] + '.db'
+
+def sqlite_connect(config: dict, create: bool = False):
+    """ Open the database, raises IOError if it does not exist and 'create' is false """
+    path = sqlite_path(config)
+    if path in connections: return connections[path]
+
+    if not create and not os.path.isfile(path):
+        raise IOError('Local manifest database not found')
+
+    db = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = FULL')
+    db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL UNIQUE, hash TEXT, data TEXT NOT NULL)')
+    db.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    connections[path] = db
+    return db
+
+def sqlite_insert_files(db, files):
+    # rows are read back in rowid order, which matches the order of the manifest list
+    db.executemany('INSERT INTO files (path, hash, data) VALUES (?, ?, ?)',
+                   ((fle['path'], fle['hash'] if 'hash' in fle else None, json.dumps(fle, default = sfs.json_default))
+                    for fle in files))
+
+def sqlite_write_meta(db, file_manifest: dict):
+    db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                   ((k, json.dumps(v)) for k, v in file_manifest.items() if k != 'files'))
+
+def sqlite_load(config: dict, with_files: bool = True) -> dict:
+    try: db = sqlite_connect(config)
+    except IOError:
+        # Migrate an existing JSON manifest into the database. It is moved aside once migrated,
+        # as it would be out of date if the JSON store was later configured again.
+        file_manifest = json.loads(sfs.file_get_contents(config['local_manifest_file']), object_hook = sfs.json_object_hook)
+        sqlite_write(config, file_manifest)
+        os.rename(config['local_manifest_file'], config['local_manifest_file'] + '.migrated')
+        if not with_files: del file_manifest['files']
+        return file_manifest
+
+    file_manifest = {key : json.loads(value) for key, value in db.execute('SELECT key, value FROM meta')}
+    if 'latest_remote_diff' not in file_manifest: raise IOError('Local manifest database is empty')
+    if not with_files: return file_manifest
+
+    file_manifest['files'] = [json.loads(data, object_hook = sfs.json_object_hook)
+                              for (data,) in db.execute('SELECT data FROM files ORDER BY rowid')]
+    return file_manifest
+
+def sqlite_write(config: dict, file_manifest: dict):
+    db = sqlite_connect(config, create = True)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM files')
+        db.execute('DELETE FROM meta')
+        sqlite_insert_files(db, file_manifest['files'])
+        sqlite_write_meta(db, file_manifest)
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+
+def sqlite_commit(config: dict, file_manifest: dict, diff: list):
+    db = sqlite_connect(config, create = True)
+
+    # The diff is replayed against only the entries it touches, using the same
+    # rules as replaying it against the whole manifest.
+    touched = set()
+    for change in diff:
+        touched.add(change['path'])
+        if change['status'] == 'moved': touched.add(change['moved_from'])
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        existing = []
+        for path in touched:
+            row = db.execute('SELECT data FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None: existing.append(json.loads(row[0]))
+
+        replay = sfs.manifest_replay(existing)
+        replay.apply(diff)
+
+        db.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in touched))
+        sqlite_insert_files(db, replay.to_list())
+        sqlite_write_meta(db, file_manifest)
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+
+def sqlite_iter_sorted(config: dict):
+    # A separate connection is used so that the read transaction, which pins the
+    # snapshot, does not interfere with commits on the shared connection
+    sqlite_connect(config, create = True)
+    db = sqlite3.connect(sqlite_path(config), isolation_level = None, check_same_thread = False)
+    try:
+        db.execute('BEGIN')
+        for (data,) in db.execute('SELECT data FROM files ORDER BY path'):
+            yield json.loads(data, object_hook = sfs.json_object_hook)
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
+def sqlite_find(config: dict, query: str, value: str):
+    row = sqlite_connect(config, create = True).execute(query, (value,)).fetchone()
+    return json.loads(row[0], object_hook = sfs.json_object_hook) if row is not None else None
@@ -0,0 +1,290 @@
+"""
+Read-only file system exposing the versions of a backup, mounted with FUSE using
+the optional fusepy package. The root holds a directory for every version, named
+by its date and version id, and 'latest' linking to the newest.
+
+The file list of a version is built from the manifest diffs the first time the
+version is opened and then kept in memory, so listing directories and reading
+file attributes does not touch S3. Manifests written by older versions do not record
+the size of files, for those it is derived from the size of the stored object in a
+listing of the bucket, made once when first needed. The contents of files are fetched when they
+are read, a stored chunk at a time using ranged GETs, into a block cache bounded
+by 'mount_cache_bytes'.
+"""
+import os, stat, errno, struct, threading, collections
+import rrbackup.crypto as crypto
+import rrbackup.pipeline as pipeline
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['mount_cache_bytes']     = 1048576 * 256     # Maximum size of file contents cached by a mount
+    config['mount_cached_versions'] = 4                 # Number of version file lists kept in memory by a mount
+    return config
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class block_cache:
+    """ Least recently used cache of decoded chunks, bounded by their total size """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used      = 0
+        self.blocks    = collections.OrderedDict()
+        self.lock      = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.blocks: return None
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+    def put(self, key, data: bytes):
+        with self.lock:
+            if key in self.blocks: return
+            self.blocks[key] = data; self.used += len(data)
+            while self.used > self.max_bytes and len(self.blocks) > 1:
+                self.used -= len(self.blocks.popitem(last = False)[1])
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+GROUP_CHUNKS = 4     # Most chunks fetched by one read when decrypting forward to a chunk
+
+class stored_object:
+    """ Random access to the decoded contents of a streamed object. 'read_range' is called
+    as read_range(first, last) and returns the bytes of the stored object in that inclusive
+    range, followed by its total size. """
+
+    def __init__(self, config: dict, read_range, cache: block_cache, key):
+        self.read_range = read_range
+        self.cache      = cache
+        self.key        = key
+        self.lock       = threading.Lock()
+
+        # the headers are normally far smaller than the first read, but may not fit in it
+        data, total = read_range(0, 4095)
+        def read_front(length):
+            if len(data) >= min(length, total): return data
+            return data + read_range(len(data), length - 1)[0]
+
+        header_length = struct.unpack('!I', data[:4])[0]
+        data = read_front(4 + header_length)
+        self.pipeline_header = data[4 : 4 + header_length]
+        pl_format = pipeline.parse_pipeline_format(self.pipeline_header)
+
+        start, self.stride = pipeline.streaming_layout(pl_format)
+        self.chunk_size = pl_format['chunk_size']
+        self.body_start = 4 + header_length + start
+        data = read_front(self.body_start)
+
+        self.size = pipeline.streaming_content_size(self.pipeline_header, total)
+
+        self.decrypt = None
+        if 'encrypt' in pl_format['format']:
+            self.decrypt = crypto.seekable_decrypt(config, self.pipeline_header, data[4 + header_length : self.body_start])
+
+    def chunk_range(self, first: int, last: int):
+        """ Stored byte range holding chunks 'first' to 'last' """
+        return self.body_start + first * self.stride, self.body_start + (last + 1) * self.stride - 1
+
+    def chunk(self, index: int) -> bytes:
+        cached = self.cache.get((self.key, index))
+        if cached is not None: return cached
+
+        with self.lock:
+            cached = self.cache.get((self.key, index))
+            if cached is not None: return cached
+
+            # encrypted chunks are decrypted in order from the nearest one whose state is known,
+            # a few at a time so memory use does not grow with the distance to the chunk wanted
+            first = index if self.decrypt is None else self.decrypt.nearest_state(index)
+            while True:
+                last = min(index, first + GROUP_CHUNKS - 1)
+                data = self.read_range(*self.chunk_range(first, last))[0]
+
+                for i in range(first, last + 1):
+                    stored = data[(i - first) * self.stride : (i - first + 1) * self.stride]
+                    res = stored if self.decrypt is None else self.decrypt.decrypt(i, stored)
+                    self.cache.put((self.key, i), res)
+
+                if last == index: return res
+                first = last + 1
+
+    def read(self, size: int, offset: int) -> bytes:
+        end = min(offset + size, self.size); res = []
+        while offset < end:
+            index, skip = divmod(offset, self.chunk_size)
+            data = self.chunk(index)[skip : skip + end - offset]
+            res.append(data); offset += len(data)
+        return b''.join(res)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def fill_sizes(files, stored_sizes: dict, object_key, expected_header):
+    """ Manifests written by older versions do not record the size of files. Fill it in from
+    'stored_sizes', a dict of object key and version id to stored size taken from a listing
+    of the bucket, where 'object_key' maps a file to the key of its object and 'expected_header'
+    to the pipeline header the current configuration stores it with. """
+    for fle in files:
+        if 'size' in fle or ('empty' in fle and fle['empty']): continue
+        obj = (object_key(fle), fle['version_id'])
+        if obj in stored_sizes:
+            fle['size'] = pipeline.streaming_content_size(expected_header(fle), stored_sizes[obj])
+    return files
+
+def version_name(version) -> str:
+    return version['LastModified'].strftime('%Y-%m-%d_%H%M%S') + '_' + version['VersionId']
+
+def build_tree(files):
+    """ Index a manifest file list by path, and the names in each directory """
+    entries = {}; directories = {'/' : set()}
+    for fle in files:
+        entries[fle['path']] = fle
+        path = fle['path']
+        while path != '/':
+            parent, name = os.path.split(path)
+            if parent in directories:
+                directories[parent].add(name); break
+            directories[parent] = {name}
+            path = parent
+    return entries, directories
+
+class backup_fs:
+    """ FUSE operations, see module documentation. 'versions' is the listing of manifest
+    versions, 'load_files' is called as load_files(version_id) to build the file list of
+    a version, and 'read_range' as read_range(real_path, version_id, first, last) to
+    read part of a stored object, returning the bytes and the total object size. """
+
+    def __init__(self, config: dict, versions, load_files, read_range):
+        self.config     = config
+        self.versions   = {version_name(v) : v for v in versions}
+        self.latest     = version_name(versions[-1]) if versions else None
+        self.load_files = load_files
+        self.read_range = read_range
+        self.cache      = block_cache(config['mount_cache_bytes'] if 'mount_cache_bytes' in config else 1048576 * 256)
+        self.trees      = collections.OrderedDict()
+        self.objects    = collections.OrderedDict()
+        self.lock       = threading.Lock()
+
+    write_operations = {'chmod', 'chown', 'create', 'link', 'mkdir', 'mknod', 'rename', 'rmdir',
+                        'setxattr', 'removexattr', 'symlink', 'truncate', 'unlink', 'utimens', 'write'}
+
+    def __call__(self, op, *args):
+        if op in backup_fs.write_operations: raise OSError(errno.EROFS, '')
+        if not hasattr(self, op): raise OSError(errno.ENOSYS, '')
+        return getattr(self, op)(*args)
+
+    # defaults of operations which need no special handling, as in fusepy's Operations
+    def init(self, path):           return None
+    def destroy(self, path):        return None
+    def access(self, path, amode):  return 0
+    def opendir(self, path):        return 0
+    def releasedir(self, path, fh): return 0
+    def release(self, path, fh):    return 0
+    def flush(self, path, fh):      return 0
+    def statfs(self, path):         return {}
+    def listxattr(self, path):      return []
+    def getxattr(self, path, name, position = 0): raise OSError(errno.ENODATA, '')
+
+    #----
+    def tree(self, name):
+        """ File list of a version, by the name of its directory """
+        if name not in self.versions: raise OSError(errno.ENOENT, '')
+
+        with self.lock:
+            if name in self.trees:
+                self.trees.move_to_end(name)
+                return self.trees[name]
+
+        tree = build_tree(self.load_files(self.versions[name]['VersionId']))
+
+        max_versions = self.config['mount_cached_versions'] if 'mount_cached_versions' in self.config else 4
+        with self.lock:
+            self.trees[name] = tree
+            while len(self.trees) > max(1, max_versions): self.trees.popitem(last = False)
+        return tree
+
+    def resolve(self, path: str):
+        """ Split a path into the version directory and the manifest path within it """
+        parts = path.strip('/').split('/', 1)
+        return parts[0], '/' + (parts[1] if len(parts) > 1 else '')
+
+    def stored_object(self, fle):
+        key = (fle['real_path'], fle['version_id'])
+        with self.lock:
+            if key in self.objects: return self.objects[key]
+
+        def read_range(first, last):
+            return self.read_range(fle['real_path'], fle['version_id'], first, last)
+        obj = stored_object(self.config, read_range, self.cache, key)
+
+        with self.lock:
+            self.objects[key] = obj
+            while len(self.objects) > 1024: self.objects.popitem(last = False)
+        return obj
+
+    def file_size(self, fle) -> int:
+        if 'empty' in fle: return 0
+        if 'size' in fle: return fle['size']
+
+        # only objects missing from the listing given to fill_sizes are left without a size
+        return self.stored_object(fle).size
+
+    #----
+    def getattr(self, path, fh = None):
+        if path == '/':
+            return {'st_mode' : stat.S_IFDIR | 0o555, 'st_nlink' : 2}
+
+        name, inner = self.resolve(path)
+        if name == 'latest' and inner == '/' and self.latest is not None:
+            return {'st_mode' : stat.S_IFLNK | 0o777, 'st_nlink' : 1, 'st_size' : len(self.latest)}
+
+        if name not in self.versions: raise OSError(errno.ENOENT, '')
+        version_time = self.versions[name]['LastModified'].timestamp()
+        directory = {'st_mode' : stat.S_IFDIR | 0o555, 'st_nlink' : 2,
+                     'st_mtime' : version_time, 'st_ctime' : version_time, 'st_atime' : version_time}
+
+        # listing the root stats every version directory, which must not build their file lists
+        if inner == '/': return directory
+
+        entries, directories = self.tree(name)
+        if inner in directories: return directory
+
+        if inner not in entries: raise OSError(errno.ENOENT, '')
+        fle = entries[inner]
+        mtime = fle['mtime_ns'] / 10**9 if 'mtime_ns' in fle else fle['last_mod'] if 'last_mod' in fle else version_time
+        return {'st_mode' : stat.S_IFREG | 0o444, 'st_nlink' : 1, 'st_size' : self.file_size(fle),
+                'st_mtime' : mtime, 'st_ctime' : mtime, 'st_atime' : mtime}
+
+    def readdir(self, path, fh = None):
+        if path == '/':
+            return ['.', '..'] + sorted(self.versions) + (['latest'] if self.latest is not None else [])
+
+        name, inner = self.resolve(path)
+        directories = self.tree(name)[1]
+        if inner not in directories: raise OSError(errno.ENOENT, '')
+        return ['.', '..'] + sorted(directories[inner])
+
+    def readlink(self, path):
+        if path != '/latest' or self.latest is None: raise OSError(errno.ENOENT, '')
+        return self.latest
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR): raise OSError(errno.EROFS, '')
+        name, inner = self.resolve(path)
+        if inner not in self.tree(name)[0]: raise OSError(errno.ENOENT, '')
+        return 0
+
+    def read(self, path, size, offset, fh = None):
+        name, inner = self.resolve(path)
+        entries = self.tree(name)[0]
+        if inner not in entries: raise OSError(errno.ENOENT, '')
+
+        fle = entries[inner]
+        if 'empty' in fle: return b''
+        return self.stored_object(fle).read(size, offset)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def mount(config: dict, versions, load_files, read_range, mountpoint: str):
+    """ Mount the backup at 'mountpoint' until it is unmounted, see backup_fs """
+    try: import fuse
+    except ImportError: raise SystemExit('Mounting requires the fusepy package')
+
+    fuse.FUSE(backup_fs(config, versions, load_files, read_range), mountpoint, foreground = True, ro = True)
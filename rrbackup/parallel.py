@@ -0,0 +1,33 @@
+"""
+Helpers for overlapping the round trip latency of many small remote requests
+using a bounded pool of threads.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def ordered_map(func, items, workers: int, window: int = None):
+    """ Apply 'func' to every item using a pool of worker threads, yielding results
+    in the same order as 'items'. At most 'window' results are in flight or waiting
+    to be consumed at any time, so memory use is bounded however many items there
+    are. Stopping iteration early cancels any work which has not started. """
+
+    workers = max(1, workers)
+    window  = max(workers, window if window is not None else workers * 2)
+
+    items   = iter(items)
+    pending = collections.deque()
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    finally:
+        for future in pending: future.cancel()
+        executor.shutdown(wait = True)
@@ -23,7 +23,8 @@ def get_default_pipeline_format() -> dict:
 #------------------
 serialise_mapper = {'encrypt'    : 'E',
                     'compress'   : 'C',
-                    'hash_names' : 'H'}
+                    'hash_names' : 'H',
+                    'encoding'   : 'N'}
 
 def serialise_pipeline_format(pl_format: dict) -> bytes:
     """ For a given version the output of this MUST NOT CHANGE as it
@@ -91,6 +92,22 @@ def build_pipeline(interface, direction):
 
     return pipeline
 
+# -----------------
+def streaming_layout(pl_format: dict):
+    """ Layout of a streamed object after its pipeline header, as a tuple of (offset of
+    the first chunk, stored size of each chunk). Only the last chunk may be shorter. """
+    start, overhead = crypto.streaming_overhead(pl_format)
+    return start, pl_format['chunk_size'] + overhead
+
+def streaming_content_size(header: bytes, stored_size: int) -> int:
+    """ Size of the contents of a streamed object of 'stored_size' bytes, stored with
+    serialised pipeline format 'header' """
+    pl_format = parse_pipeline_format(header)
+    start, stride = streaming_layout(pl_format)
+    body = stored_size - 4 - len(header) - start
+    chunks = -(-body // stride)
+    return body - chunks * (stride - pl_format['chunk_size'])
+
 # -----------------
 def build_pipeline_streaming(interface, direction):
     """ Build a chunked (streaming) pipeline of transformers """
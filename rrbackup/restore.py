@@ -0,0 +1,297 @@
+"""
+Restores the files of a manifest to a local directory. Objects are fetched by
+a pool of worker threads, as restoring many small files one after another is
+dominated by the latency of each request. The number of files open at once
+and the total size of the objects being fetched at once are both bounded.
+
+Restored files are given the modification time recorded in the manifest. With
+'restore_incremental', files already in the target directory which match the
+manifest are not fetched again, so an interrupted restore can be resumed cheaply.
+
+Deduplication means many manifest items can share one stored object. Each object
+is fetched once, and the other paths sharing it are made from the first locally,
+as a reflink where the file system supports it, otherwise by copying, or as hard
+links if 'restore_duplicates' is 'hardlink'.
+
+restore_tar writes the files as a tar stream instead, for piping a restore to
+another host or to tape, without writing anything to local disk.
+"""
+import os, io, stat, shutil, fcntl, tarfile, threading
+import rrbackup.fsutil as sfs
+import rrbackup.parallel as parallel
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['restore_workers']            = 8                 # Number of objects fetched concurrently during a restore
+    config['restore_max_open_files']     = 64                # Maximum number of files open at once during a restore
+    config['restore_max_inflight_bytes'] = 1048576 * 1024    # Maximum total size of the objects being fetched at once
+    config['restore_incremental']        = False             # Skip files in the target which already match the manifest
+    config['restore_compare']            = 'size_mtime'      # How existing files are compared, 'size_mtime' or 'hash'
+    config['restore_delete_extra']       = False             # Remove files in the target which are not in the version
+    config['restore_duplicates']         = 'copy'            # How files sharing a stored object are made, 'copy' or 'hardlink'
+    return config
+
+def validate_config(config: dict):
+    if 'restore_compare' in config and config['restore_compare'] not in ['size_mtime', 'hash']:
+        raise SystemExit("restore_compare in conf file must be 'size_mtime' or 'hash'")
+    if 'restore_duplicates' in config and config['restore_duplicates'] not in ['copy', 'hardlink']:
+        raise SystemExit("restore_duplicates in conf file must be 'copy' or 'hardlink'")
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class byte_budget:
+    """ Limits the total size of the objects being fetched at once. An object larger than
+    the whole budget is allowed when nothing else is being fetched, so it cannot deadlock. """
+
+    def __init__(self, limit: int):
+        self.limit = limit; self.used = 0
+        self.cond  = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        size = min(size, self.limit)
+        with self.cond:
+            while self.used > 0 and self.used + size > self.limit: self.cond.wait()
+            self.used += size
+        return size
+
+    def release(self, size: int):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def create_directories(target_directory: str, files):
+    """ Create every directory needed by 'files' once, rather than checking for each file """
+    directories = {os.path.dirname(sfs.cpjoin(target_directory, fle['path'])) for fle in files}
+    for directory in sorted(directories): os.makedirs(directory, exist_ok = True)
+
+def set_file_times(local_file_path: str, fle):
+    """ Give a restored file the modification time recorded in the manifest """
+    if 'mtime_ns' in fle:   os.utime(local_file_path, ns = (fle['mtime_ns'], fle['mtime_ns']))
+    elif 'last_mod' in fle: os.utime(local_file_path, (fle['last_mod'], fle['last_mod']))
+
+def file_is_current(config: dict, local_file_path: str, fle) -> bool:
+    """ Does 'local_file_path' already hold the contents of manifest item 'fle'. Files with the
+    recorded size and modification time are trusted unless 'restore_compare' is 'hash',
+    otherwise a file of the right size is hashed and compared with the manifest. """
+    try: file_stat = os.stat(local_file_path)
+    except OSError: return False
+
+    if not stat.S_ISREG(file_stat.st_mode): return False
+    if 'empty' in fle: return file_stat.st_size == 0
+    if 'size' in fle and file_stat.st_size != fle['size']: return False
+
+    compare_hash = 'restore_compare' in config and config['restore_compare'] == 'hash'
+    if 'size' in fle and not compare_hash:
+        if 'mtime_ns' in fle and file_stat.st_mtime_ns == fle['mtime_ns']: return True
+        if 'mtime_ns' not in fle and 'last_mod' in fle and file_stat.st_mtime == fle['last_mod']: return True
+
+    if 'hash' not in fle or sfs.hash_file(local_file_path) != fle['hash']: return False
+    set_file_times(local_file_path, fle)
+    return True
+
+def restore_file(config: dict, fetch, target_directory: str, fle, budget: byte_budget, open_files):
+    """ Restore a single manifest item, returns True if it was fetched or False if the
+    existing file was kept """
+    local_file_path = sfs.cpjoin(target_directory, fle['path'])
+
+    with open_files:
+        if 'restore_incremental' in config and config['restore_incremental'] \
+                and file_is_current(config, local_file_path, fle):
+            return False
+
+        if 'empty' in fle:
+            open(local_file_path, 'w').close()
+            set_file_times(local_file_path, fle)
+            return True
+
+        # the size of files recorded by older versions is not known
+        size = budget.acquire(fle['size'] if 'size' in fle else config['chunk_size'])
+        try:
+            remote_file_path = sfs.cpjoin(config['remote_base_path'], fle['real_path'])
+            fetch(remote_file_path, fle['version_id'], local_file_path)
+        finally:
+            budget.release(size)
+
+        set_file_times(local_file_path, fle)
+    return True
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+FICLONE = 0x40049409    # Linux ioctl sharing the extents of one file with another
+
+def clone_file(source_path: str, local_file_path: str, hardlink: bool = False):
+    """ Make 'local_file_path' a copy of 'source_path', as a reflink if the file system
+    supports it, or as a hard link if 'hardlink' is set """
+    if hardlink:
+        if os.path.lexists(local_file_path): os.remove(local_file_path)
+        os.link(source_path, local_file_path)
+        return
+
+    with open(source_path, 'rb') as source, open(local_file_path, 'wb') as target:
+        try: fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError: shutil.copyfileobj(source, target, 1048576)
+
+def group_by_object(files) -> list:
+    """ Group manifest items which share a stored object, in order of first appearance """
+    groups = {}
+    for fle in files:
+        key = ('empty', fle['path']) if 'empty' in fle else (fle['real_path'], fle['version_id'])
+        if key not in groups: groups[key] = []
+        groups[key].append(fle)
+    return list(groups.values())
+
+def restore_group(config: dict, fetch, target_directory: str, group: list, budget: byte_budget, open_files):
+    """ Restore manifest items sharing one stored object, which is fetched at most once.
+    Returns a list of (item, action) where action is 'fetched', 'current' or 'copied'. """
+    first = group[0]
+    res = [(first, 'fetched' if restore_file(config, fetch, target_directory, first, budget, open_files) else 'current')]
+
+    source_path = sfs.cpjoin(target_directory, first['path'])
+    hardlink = 'restore_duplicates' in config and config['restore_duplicates'] == 'hardlink'
+
+    for fle in group[1:]:
+        local_file_path = sfs.cpjoin(target_directory, fle['path'])
+        with open_files:
+            if 'restore_incremental' in config and config['restore_incremental'] \
+                    and file_is_current(config, local_file_path, fle):
+                res.append((fle, 'current')); continue
+
+            clone_file(source_path, local_file_path, hardlink)
+            if not hardlink: set_file_times(local_file_path, fle)
+        res.append((fle, 'copied'))
+    return res
+
+def restore_files(config: dict, fetch, files, target_directory: str):
+    """ Restore manifest items to 'target_directory'. 'fetch' is called as
+    fetch(remote_file_path, version_id, local_file_path) to download one object, and
+    must be safe to call from several threads. Files sharing an object are reported
+    together, otherwise in the order given. """
+
+    create_directories(target_directory, files)
+
+    workers      = config['restore_workers'] if 'restore_workers' in config else 1
+    max_open     = config['restore_max_open_files'] if 'restore_max_open_files' in config else workers
+    max_inflight = config['restore_max_inflight_bytes'] if 'restore_max_inflight_bytes' in config else config['chunk_size']
+
+    budget     = byte_budget(max_inflight)
+    open_files = threading.BoundedSemaphore(max(1, max_open))
+
+    def restore(group):
+        return restore_group(config, fetch, target_directory, group, budget, open_files)
+
+    fetched = skipped = copied = bytes_saved = 0
+    for results in parallel.ordered_map(restore, group_by_object(files), workers):
+        for fle, action in results:
+            if action == 'fetched':
+                print('Downloading: ' + fle['path']); fetched += 1
+            elif action == 'current':
+                print('Up to date: ' + fle['path']); skipped += 1
+            else:
+                print('Copying: ' + fle['path']); copied += 1
+                bytes_saved += fle['size'] if 'size' in fle else os.path.getsize(sfs.cpjoin(target_directory, fle['path']))
+
+    if skipped > 0: print('Downloaded ' + str(fetched) + ' files, ' + str(skipped) + ' already up to date')
+    if copied > 0: print('Copied ' + str(copied) + ' files sharing a downloaded object, saving ' + str(bytes_saved) + ' bytes')
+
+def remove_extra_files(target_directory: str, keep_paths: set):
+    """ Remove files below 'target_directory' whose manifest path is not in 'keep_paths' """
+    for fle in sfs.iter_file_list(target_directory):
+        if fle['path'] not in keep_paths:
+            print('Removing: ' + fle['path'])
+            os.remove(sfs.cpjoin(target_directory, fle['path']))
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+# Restoring to a tar stream
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class chunk_reader:
+    """ File like object reading from an iterator of byte strings """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.pos    = 0
+
+    def read(self, size = -1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            chunk = next(self.chunks, None)
+            if chunk is None: break
+            self.buffer = self.buffer[self.pos:] + chunk; self.pos = 0
+
+        end = len(self.buffer) if size < 0 else self.pos + size
+        res = self.buffer[self.pos : end]; self.pos += len(res)
+        return res
+
+def tar_info(fle, size: int) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(fle['path'].lstrip('/'))
+    info.size = size
+    info.mode = 0o644
+    if 'mtime_ns' in fle:   info.mtime = fle['mtime_ns'] / 10**9
+    elif 'last_mod' in fle: info.mtime = fle['last_mod']
+    return info
+
+def open_tar_stream(fileobj, compression: str = None):
+    """ Open a tar stream writing to 'fileobj', returns the tar file and the zstd writer
+    if one is used, which has to be closed after it """
+    if compression == 'zst':
+        try: import zstandard
+        except ImportError: raise SystemExit('zstd compression requires the zstandard package')
+        writer = zstandard.ZstdCompressor().stream_writer(fileobj, closefd = False)
+        return tarfile.open(fileobj = writer, mode = 'w|'), writer
+
+    if compression not in [None, 'gz', 'bz2', 'xz']: raise SystemExit('Unknown compression ' + str(compression))
+    return tarfile.open(fileobj = fileobj, mode = 'w|' + (compression or '')), None
+
+def restore_tar(config: dict, open_object, files, fileobj, compression: str = None):
+    """ Write manifest items to 'fileobj' as a tar stream, in the order given. 'open_object'
+    is called as open_object(remote_file_path, version_id) and returns the size of the contents
+    of one object, taken from the stored object, and an iterator over them. It must be safe
+    to call from several threads. Files are fetched into memory ahead of being written, at
+    most twice 'restore_workers' at a time, as long as the manifest records them as no larger
+    than their share of 'restore_max_inflight_bytes'. Larger files, and those whose size was
+    not recorded, are streamed when their turn comes. With 'restore_duplicates' set to
+    'hardlink', files sharing a stored object are written as hard links to the first. """
+
+    workers      = config['restore_workers'] if 'restore_workers' in config else 1
+    max_inflight = config['restore_max_inflight_bytes'] if 'restore_max_inflight_bytes' in config else config['chunk_size']
+    window       = max(1, workers) * 2
+    hardlink     = 'restore_duplicates' in config and config['restore_duplicates'] == 'hardlink'
+
+    # the member each file links to is decided up front, as prefetching is out of order
+    items = []; first_members = {}
+    for fle in files:
+        key = ('empty', fle['path']) if 'empty' in fle else (fle['real_path'], fle['version_id'])
+        if hardlink and key in first_members: items.append((fle, first_members[key])); continue
+        first_members[key] = fle['path'].lstrip('/')
+        items.append((fle, None))
+
+    def remote_path(fle):
+        return sfs.cpjoin(config['remote_base_path'], fle['real_path'])
+
+    def prefetch(item):
+        fle, link = item
+        if link is not None or 'empty' in fle: return b''
+
+        # the size of files recorded by older versions is not known until they are opened
+        if 'size' not in fle or fle['size'] > max_inflight // window: return None
+        return b''.join(open_object(remote_path(fle), fle['version_id'])[1])
+
+    tar, writer = open_tar_stream(fileobj, compression)
+    for (fle, link), data in zip(items, parallel.ordered_map(prefetch, items, workers, window)):
+        if link is not None:
+            info = tar_info(fle, 0)
+            info.type = tarfile.LNKTYPE; info.linkname = link
+            tar.addfile(info)
+
+        elif data is not None:
+            tar.addfile(tar_info(fle, len(data)), io.BytesIO(data))
+
+        else:
+            # the size recorded in the manifest is from the scan, the file may have changed
+            # while it was uploaded, so the header is given the size of what was stored
+            size, chunks = open_object(remote_path(fle), fle['version_id'])
+            tar.addfile(tar_info(fle, size), chunk_reader(chunks))
+
+        print('Archiving: ' + fle['path'])
+
+    tar.close()
+    if writer is not None: writer.close()
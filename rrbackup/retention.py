@@ -0,0 +1,56 @@
+"""
+Retention rules deciding which versions of a backup are kept when it is pruned.
+Rules are counted back from the newest version, as follows:
+
+'retain_last'   keeps the newest N versions
+'retain_daily'  keeps the newest version of each of the N most recent days with a version
+'retain_weekly' keeps the newest version of each of the N most recent ISO weeks with a version
+
+A version is kept if any rule keeps it, and the newest version is always kept.
+Days and weeks are those of the UTC time stamp S3 records for each version.
+"""
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['retain_last']   = 0     # Number of most recent versions kept by prune
+    config['retain_daily']  = 0     # Number of days for which prune keeps the newest version of each
+    config['retain_weekly'] = 0     # Number of weeks for which prune keeps the newest version of each
+    return config
+
+RULES = ['retain_last', 'retain_daily', 'retain_weekly']
+
+def validate_config(config: dict):
+    for rule in RULES:
+        if rule in config and (not isinstance(config[rule], int) or config[rule] < 0):
+            raise SystemExit(rule + ' in conf file must be a whole number, 0 or more')
+
+def has_rules(config: dict) -> bool:
+    return any(rule in config and config[rule] > 0 for rule in RULES)
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def newest_per_period(versions, period, count: int):
+    """ Version ids of the newest version in each of the 'count' most recent periods,
+    'period' maps the time stamp of a version to the period it falls in """
+    kept = []; seen = set()
+    for vers in reversed(versions):
+        if len(seen) >= count: break
+        key = period(vers['LastModified'])
+        if key in seen: continue
+        seen.add(key); kept.append(vers['VersionId'])
+    return kept
+
+def select_versions(config: dict, versions) -> set:
+    """ Version ids of the versions retained by the configured rules, 'versions' is a
+    version listing ordered oldest first """
+    if versions == []: return set()
+
+    last   = config['retain_last']   if 'retain_last'   in config else 0
+    daily  = config['retain_daily']  if 'retain_daily'  in config else 0
+    weekly = config['retain_weekly'] if 'retain_weekly' in config else 0
+
+    kept = {versions[-1]['VersionId']}
+    kept.update(vers['VersionId'] for vers in versions[max(0, len(versions) - last):])
+    kept.update(newest_per_period(versions, lambda t: t.date(), daily))
+    kept.update(newest_per_period(versions, lambda t: tuple(t.isocalendar())[:2], weekly))
+    return kept
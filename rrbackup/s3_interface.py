@@ -1,6 +1,7 @@
 import struct
 import boto3
 import rrbackup.pipeline as pipeline
+import rrbackup.parallel as parallel
 
 def add_default_config(config):
     config["s3"] = { "access_key": "",
@@ -61,13 +62,15 @@ def wipe_all(conn):
         #    Key_marker = version_list['NextKeyMarker']
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
-def get_object(conn, key, error='object not found', version_id=None):
-    """ Gets an object from s3 """
+def get_object(conn, key, error='object not found', version_id=None, byte_range=None):
+    """ Gets an object from s3, or the inclusive range of bytes (first, last) of it """
 
     def helper():
+        args = {'Bucket' : conn['bucket'], 'Key' : key}
+        if version_id is not None: args['VersionId'] = version_id
+        if byte_range is not None: args['Range'] = 'bytes=%d-%d' % byte_range
         try:
-            if version_id is None: return conn['client'].get_object(Bucket=conn['bucket'], Key=key)
-            else: return conn['client'].get_object(Bucket=conn['bucket'], Key=key, VersionId=version_id)
+            return conn['client'].get_object(**args)
         except conn['client'].exceptions.NoSuchKey:
             raise ValueError(error)
     k = helper()
@@ -78,6 +81,7 @@ def get_object(conn, key, error='object not found', version_id=None):
             'content_length'  : k['ContentLength'],
             'content_type'    : k['ContentType'],
             'metadata'        : k['Metadata'],
+            'content_range'   : k['ContentRange'] if 'ContentRange' in k else None,
             'last_modified'   : k['LastModified']}
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
@@ -99,6 +103,27 @@ def delete_object(conn, key, version_id=None):
 
 
 
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def delete_versions(conn, versions, workers = 4):
+    """ Delete object versions, given as (key, version id) pairs, using multi-object
+    deletes of up to 1000 versions each, several at once. Returns the versions which
+    could not be deleted, as dicts of 'Key', 'VersionId', 'Code' and 'Message'. """
+
+    versions = list(versions)
+    batches = [versions[i : i + 1000] for i in range(0, len(versions), 1000)]
+
+    def delete_batch(batch):
+        result = conn['client'].delete_objects(Bucket=conn['bucket'], Delete={
+            'Objects' : [{'Key' : key, 'VersionId' : version_id} for key, version_id in batch],
+            'Quiet'   : True})
+        return result['Errors'] if 'Errors' in result else []
+
+    errors = []
+    for batch_errors in parallel.ordered_map(delete_batch, batches, workers):
+        errors += batch_errors
+    return errors
+
+
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
 def list_versions(conn, fle = None):
 
@@ -139,12 +164,80 @@ def list_versions(conn, fle = None):
                 break
 
 
-    # Sort result by date
-    version_list = sorted(version_list, key=lambda v: v['LastModified'])
+    # Sort result by date. Versions of each key are listed newest first, and time stamps
+    # only have a resolution of one second, so the listing is reversed before a stable sort
+    # to keep versions written within the same second in the order they were written.
+    version_list = sorted(reversed(version_list), key=lambda v: v['LastModified'])
 
     return version_list
 
 
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def iter_versions(conn, prefix = None):
+    """ Iterate over the versions of objects a page at a time, in the order S3 lists them,
+    which is by key with the newest version of each key first. """
+    args = {'Bucket' : conn['bucket']}
+    if prefix is not None: args['Prefix'] = prefix
+
+    while True:
+        result = conn['client'].list_object_versions(**args)
+        if 'Versions' in result: yield from result['Versions']
+        if not result['IsTruncated']: break
+        args['KeyMarker'] = result['NextKeyMarker']; args['VersionIdMarker'] = result['NextVersionIdMarker']
+
+
+#++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def list_latest_versions(conn, keys, workers = 8):
+    """ Find the latest version of each of 'keys' with far fewer requests than listing them
+    one at a time. Keys are grouped by directory and the directories are listed concurrently,
+    one level deep, stopping once the listing has passed the last key wanted from it. S3 lists
+    keys in order with the newest version of each first. If a directory holds many more objects
+    than are wanted from it, so listing it costs more requests than listing the remaining keys
+    individually, those are listed individually instead. Returns a dict of key to version,
+    keys with no versions are not included. """
+
+    groups = {}
+    for key in set(keys):
+        directory = key.rpartition('/')[0]
+        if directory not in groups: groups[directory] = []
+        groups[directory].append(key)
+
+    def first_version(key):
+        # the key itself sorts before any other key it is a prefix of
+        result = conn['client'].list_object_versions(Bucket=conn['bucket'], Prefix=key)
+        versions = [v for v in result['Versions'] if v['Key'] == key] if 'Versions' in result else []
+        return versions[0] if versions != [] else None
+
+    def list_group(item):
+        directory, group = item
+        wanted = set(group); found = {}; pages = 0
+        args = {'Bucket' : conn['bucket'], 'Prefix' : directory + '/' if directory != '' else '', 'Delimiter' : '/'}
+
+        while True:
+            result = conn['client'].list_object_versions(**args); pages += 1
+            for version in result['Versions'] if 'Versions' in result else []:
+                if version['Key'] in wanted and version['Key'] not in found: found[version['Key']] = version
+
+            if not result['IsTruncated']: return found
+
+            # keys before the marker have been listed in full
+            remaining = [key for key in group if key > result['NextKeyMarker']]
+            if remaining == []: return found
+
+            if len(remaining) <= pages:
+                for key in remaining:
+                    version = first_version(key)
+                    if version is not None: found[key] = version
+                return found
+
+            args['KeyMarker'] = result['NextKeyMarker']; args['VersionIdMarker'] = result['NextVersionIdMarker']
+
+    latest = {}
+    for found in parallel.ordered_map(list_group, groups.items(), workers):
+        latest.update(found)
+    return latest
+
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
 def write_file(conn, data, meta, config): # pylint: disable=unused-argument
     """ Pipeline format and other metadata is stored in the header to allow decryption should
@@ -166,6 +259,7 @@ def read_file(conn, meta, config): # pylint: disable=unused-argument
     header_length = struct.unpack('!I', res['body'].read(4))[0]
     header = res['body'].read(header_length)
     meta['header'] = header
+    meta['version_id'] = res['version_id']
     meta['last_modified'] = res['last_modified']
     data = res['body'].read()
     return data, meta
@@ -237,9 +331,11 @@ class streaming_download:
     def __init__(self):
         self.res        = None
         self.chunk_size = None
+        self.total      = None
 
     def begin(self, conn, key, version_id):
         self.res = get_object(conn, key, version_id = version_id)
+        self.total = self.res['content_length']
         header_length = struct.unpack('!I', self.res['body'].read(4))[0]
         header = self.res['body'].read(header_length)
 
@@ -250,3 +346,79 @@ class streaming_download:
     def next_chunk(self, add_bytes = 0):
         res = self.res['body'].read(self.chunk_size + add_bytes)
         return res if res != b'' else None
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class ranged_download:
+    """ Streaming (chunked) object download which fetches parts of an object concurrently
+    using ranged GETs, so a large object is not limited to the throughput of one connection.
+    The pipeline header is read from the front of the first part, the ranges after that part
+    end on the stored chunk boundaries it records. Parts are reassembled in order, so the
+    decrypting stage sees exactly the stream that streaming_download produces. At most
+    'workers' + 1 parts are held in memory. """
+
+    def __init__(self, workers = 4, part_size = 1048576 * 16):
+        self.workers    = workers
+        self.part_size  = part_size
+        self.chunk_size = None
+        self.total      = None
+        self.buffer     = b''
+        self.pos        = 0
+        self.parts      = None
+
+    def begin(self, conn, key, version_id):
+        first = get_object(conn, key, version_id = version_id, byte_range = (0, self.part_size - 1))
+        total = int(first['content_range'].split('/')[1]) if first['content_range'] is not None else first['content_length']
+        self.total = total
+        first_end = first_length = min(self.part_size, total)
+
+        # later ranges are read from the version the first was, in case the object is replaced
+        def fetch(byte_range):
+            part = get_object(conn, key, version_id = first['version_id'], byte_range = byte_range)['body'].read()
+            if len(part) != byte_range[1] - byte_range[0] + 1: raise ValueError('Short read of ' + key)
+            return part
+
+        # the header is normally far smaller than a part, but may not fit in a very small one
+        def read_front(length):
+            nonlocal first_end
+            res = first['body'].read(length)
+            if len(res) < length and first_end < total:
+                extra = fetch((first_end, min(first_end + length - len(res), total) - 1))
+                first_end += len(extra); res += extra
+            return res
+
+        header_length = struct.unpack('!I', read_front(4))[0]
+        header = read_front(header_length)
+        pl_format = pipeline.parse_pipeline_format(header)
+        self.chunk_size = pl_format['chunk_size']
+
+        start, stride = pipeline.streaming_layout(pl_format)
+        first_chunk = 4 + header_length + start
+        chunks_per_part = max(1, self.part_size // stride)
+
+        ranges = []; offset = first_end
+        while offset < total:
+            # end on the first chunk boundary at least a part after the start of the range
+            end = first_chunk + ((offset - first_chunk) // stride + chunks_per_part) * stride
+            end = min(end, total)
+            ranges.append((offset, end - 1)); offset = end
+
+        # the rest of the first part is read by the pool alongside the other ranges
+        first_rest = max(0, first_length - 4 - header_length)
+        def read_part(byte_range):
+            if byte_range is not None: return fetch(byte_range)
+            part = first['body'].read()
+            if len(part) != first_rest: raise ValueError('Short read of ' + key)
+            return part
+
+        self.parts = parallel.ordered_map(read_part, [None] + ranges, self.workers, self.workers + 1)
+        return header, pl_format
+
+    def next_chunk(self, add_bytes = 0):
+        want = self.chunk_size + add_bytes
+        while len(self.buffer) - self.pos < want:
+            part = next(self.parts, None)
+            if part is None: break
+            self.buffer = self.buffer[self.pos:] + part; self.pos = 0
+
+        res = self.buffer[self.pos : self.pos + want]; self.pos += len(res)
+        return res if res != b'' else None
@@ -0,0 +1,130 @@
+"""
+Checks the objects referenced by a version of the backup without restoring it.
+
+The fast check lists the stored objects and compares the size of each with the size
+expected from the size of the file recorded in the manifest. A streamed object is a
+pipeline header followed by the file in chunks, each grown by a fixed amount by
+encryption, so its size is known exactly. It is first computed with the pipeline the
+current configuration gives the file, and objects which do not match are checked again
+with the header actually stored, read with a small ranged GET, as the configuration
+may have changed since they were uploaded.
+
+The deep check downloads and decrypts objects, a number at once, and compares the
+sha256 hash of their contents with the hash recorded in the manifest. It can be limited
+to a sample of the objects, chosen by a hash of their key and version so a resumed check
+chooses the same sample. Objects are recorded in a local checkpoint file as they are
+checked, so an interrupted deep check carries on from where it stopped.
+"""
+import os, json, hashlib, struct
+import rrbackup.pipeline as pipeline
+import rrbackup.parallel as parallel
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def add_default_config(config: dict):
+    """ The default configuration structure. """
+    config['verify_workers']         = 4                     # Number of objects downloaded at once by a deep verify
+    config['verify_checkpoint_file'] = 'verify_checkpoint'   # Local record of the progress of a deep verify
+    return config
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def expected_stored_size(header: bytes, size: int) -> int:
+    """ Size of a streamed object holding 'size' bytes, stored with pipeline header 'header' """
+    pl_format = pipeline.parse_pipeline_format(header)
+    start, stride = pipeline.streaming_layout(pl_format)
+    chunks = -(-size // pl_format['chunk_size'])
+    return 4 + len(header) + start + size + chunks * (stride - pl_format['chunk_size'])
+
+def is_sampled(key: str, version_id: str, fraction: float) -> bool:
+    if fraction >= 1: return True
+    digest = hashlib.sha256((key + '\0' + version_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') < fraction * 2**64
+
+def stored_objects(files, object_key):
+    """ The stored objects referenced by a manifest file list, once each as files sharing
+    an object are only checked once. Maps (key, version id) to the first file using it. """
+    objects = {}
+    for fle in files:
+        if 'empty' in fle and fle['empty']: continue
+        objects.setdefault((object_key(fle), fle['version_id']), fle)
+    return objects
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+def check_sizes(objects: dict, listing, expected_header, read_header):
+    """ Compare the sizes of the stored objects in 'listing', an iterable of S3 version
+    listing items, with those expected. 'expected_header' is called with a manifest item and
+    returns the pipeline header it would be stored with now, 'read_header' is called as
+    read_header(key, version id) and returns the header it was stored with. Returns a list
+    of problems as (status, key, version id). """
+    problems = []; found = set()
+
+    for vers in listing:
+        obj = (vers['Key'], vers['VersionId'])
+        if obj not in objects: continue
+        found.add(obj)
+
+        fle = objects[obj]
+        if 'size' not in fle: continue  # not recorded by older versions
+
+        if vers['Size'] == expected_stored_size(expected_header(fle), fle['size']): continue
+        if vers['Size'] != expected_stored_size(read_header(*obj), fle['size']):
+            problems.append(('size mismatch', obj[0], obj[1]))
+
+    for obj in objects:
+        if obj not in found: problems.append(('missing', obj[0], obj[1]))
+    return problems
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==
+class checkpoint:
+    """ Objects already checked by a deep verify, kept in a local file of JSON lines. The
+    first line describes the check, a checkpoint written by a different check is discarded. """
+
+    def __init__(self, path: str, run: dict):
+        self.path = path; self.done = {}
+
+        try:
+            with open(path) as fle:
+                lines = fle.read().splitlines()
+            if lines != [] and json.loads(lines[0]) == run:
+                for line in lines[1:]:
+                    try: key, version_id, status = json.loads(line)
+                    except ValueError: break # a line cut short by an interruption
+                    self.done[(key, version_id)] = status
+            else: lines = []
+        except FileNotFoundError: lines = []
+
+        self.fle = open(path, 'a' if lines != [] else 'w')
+        if lines == []: self.fle.write(json.dumps(run) + '\n'); self.fle.flush()
+
+    def record(self, key: str, version_id: str, status: str):
+        self.done[(key, version_id)] = status
+        self.fle.write(json.dumps([key, version_id, status]) + '\n'); self.fle.flush()
+
+    def remove(self):
+        self.fle.close()
+        os.remove(self.path)
+
+def check_hashes(config: dict, objects: dict, fetch_chunks, progress: checkpoint):
+    """ Download the objects not yet in the checkpoint and compare the hash of their contents
+    with the manifest, yielding (status, key, version id) for each. 'fetch_chunks' is called as
+    fetch_chunks(key, version id) and yields the decoded contents. """
+
+    def check(obj):
+        digest = hashlib.sha256()
+        try:
+            for chunk in fetch_chunks(*obj): digest.update(chunk)
+        except ValueError: return 'unreadable'
+        return 'ok' if digest.hexdigest() == objects[obj]['hash'] else 'hash mismatch'
+
+    todo = [obj for obj in objects if obj not in progress.done]
+    workers = config['verify_workers'] if 'verify_workers' in config else 1
+    for obj, status in zip(todo, parallel.ordered_map(check, todo, workers)):
+        progress.record(obj[0], obj[1], status)
+        yield status, obj[0], obj[1]
+
+def read_stored_header(get_range, key: str, version_id: str) -> bytes:
+    """ Pipeline header of a stored object, 'get_range' is called as get_range(key, version id,
+    first, last) and returns the bytes in that inclusive range """
+    data = get_range(key, version_id, 0, 4095)
+    header_length = struct.unpack('!I', data[:4])[0]
+    if len(data) < 4 + header_length: data = get_range(key, version_id, 0, 3 + header_length)
+    return data[4 : 4 + header_length]
@@ -31,6 +31,10 @@ setup(
     install_requires=[
         'boto3', 'boto3-stubs', 'termcolor', 'pysodium'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'mount': ['fusepy']
+    },
     scripts=['cli/rrbackup'],
     zip_safe=False)
 
@@ -0,0 +1,363 @@
+import rrbackup.core as core
+import rrbackup.s3_interface as interface
+import rrbackup.pipeline as pipeline
+import rrbackup.manifest_store as manifest_store
+import unittest, contextlib, datetime, io, os, shutil, tempfile, threading
+
+class versioned_client:
+    """ In memory versioned bucket, serving the calls made by s3_interface. Every write is
+    given a time stamp one second after the previous one. """
+    class exceptions:
+        class NoSuchKey(Exception): pass
+
+    def __init__(self):
+        self.objects = {}; self.uploads = {}; self.deleted = []; self.gets = []; self.count = 0
+        self.fail_deletes = None # prefix of keys whose deletion fails, as if interrupted
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            self.count += 1
+            version = {'VersionId' : 'v%04d' % self.count, 'Body' : bytes(Body), 'Metadata' : kwargs.get('Metadata', {}),
+                       'LastModified' : datetime.datetime(2020, 1, 1, tzinfo = datetime.timezone.utc) + datetime.timedelta(seconds = self.count)}
+            self.objects.setdefault(Key, []).append(version)
+        return {'VersionId' : version['VersionId']}
+
+    def get_object(self, Bucket, Key, VersionId = None, Range = None):
+        self.gets.append(Key)
+        versions = [v for v in self.objects.get(Key, []) if VersionId is None or v['VersionId'] == VersionId]
+        if versions == []: raise self.exceptions.NoSuchKey()
+        version = versions[-1]; data = version['Body']; total = len(data)
+
+        res = {'VersionId' : version['VersionId'], 'Metadata' : version['Metadata'], 'ContentType' : '',
+               'LastModified' : version['LastModified']}
+        if Range is not None:
+            first, last = (int(i) for i in Range.split('=')[1].split('-'))
+            data = data[first : last + 1]; res['ContentRange'] = 'bytes %d-%d/%d' % (first, first + len(data) - 1, total)
+        res['Body'] = io.BytesIO(data); res['ContentLength'] = len(data)
+        return res
+
+    def delete_object(self, Bucket, Key, VersionId = None):
+        with self.lock:
+            if VersionId is None: self.objects.pop(Key, None)
+            else:
+                self.objects[Key] = [v for v in self.objects.get(Key, []) if v['VersionId'] != VersionId]
+                self.deleted.append((Key, VersionId))
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        if self.fail_deletes is not None and any(obj['Key'].startswith(self.fail_deletes) for obj in Delete['Objects']):
+            raise ConnectionError('Interrupted')
+        for obj in Delete['Objects']: self.delete_object(Bucket, obj['Key'], obj.get('VersionId'))
+        return {'Deleted' : Delete['Objects']}
+
+    def list_object_versions(self, Bucket, Prefix = '', Delimiter = None, KeyMarker = None, VersionIdMarker = None):
+        versions = []; prefixes = set()
+        for key in sorted(self.objects):
+            if not key.startswith(Prefix): continue
+            if Delimiter is not None and Delimiter in key[len(Prefix):]:
+                prefixes.add(Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter); continue
+            versions += [{'Key' : key, 'VersionId' : v['VersionId'], 'LastModified' : v['LastModified'],
+                          'Size' : len(v['Body']), 'IsLatest' : v is self.objects[key][-1]}
+                         for v in reversed(self.objects[key])]
+
+        res = {'IsTruncated' : False, 'Versions' : versions}
+        if prefixes: res['CommonPrefixes'] = [{'Prefix' : p} for p in sorted(prefixes)]
+        return res
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.count += 1; self.uploads['u%d' % self.count] = {}
+        return {'UploadId' : 'u%d' % self.count}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag' : str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        res = self.put_object(Bucket, Key, b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts']))
+        return dict(res, Key = Key)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def list_multipart_uploads(self, Bucket):
+        return {'IsTruncated' : False}
+
+class test_core(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base = os.path.join(self.directory, 'base'); os.makedirs(self.base)
+
+        self.config = core.default_config(interface)
+        self.config.update({'base_path'           : self.base,
+                            'local_manifest_file' : os.path.join(self.directory, 'manifest'),
+                            'local_lock_file'     : os.path.join(self.directory, 'lock')})
+        self.client = versioned_client()
+        self.conn = {'client' : self.client, 'bucket' : 'bucket'}
+        self.config = pipeline.preprocess_config(interface, self.conn, self.config)
+        self.quiet(core.init, interface, self.conn, self.config)
+
+    def tearDown(self):
+        manifest_store.connections.clear()
+        shutil.rmtree(self.directory)
+
+    def quiet(self, func, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()): return func(*args, **kwargs)
+
+    def write(self, path, data):
+        full_path = os.path.join(self.base, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok = True)
+        with open(full_path, 'w') as fle: fle.write(data)
+
+    def backup(self):
+        self.quiet(core.backup, interface, self.conn, self.config)
+
+    def diffs(self):
+        """ Bodies of the remote manifest diffs, oldest first """
+        return [core.get_remote_manifest_diff(self.config, v['VersionId'])['body']
+                for v in core.get_remote_manifest_versions(interface, self.conn, self.config)]
+
+    #----
+    def test_unchanged_tree_racy(self):
+        # files written just before a backup are within the racy window of the next one
+        self.write('keep.txt', 'keep'); self.write('same.txt', 'aaaa')
+        self.backup()
+
+        # rewriting a file without changing its size or time stamp is still found
+        state = os.stat(os.path.join(self.base, 'same.txt'))
+        self.write('same.txt', 'bbbb')
+        os.utime(os.path.join(self.base, 'same.txt'), ns = (state.st_atime_ns, state.st_mtime_ns))
+        self.backup()
+        self.assertEqual([(c['status'], c['path']) for c in self.diffs()[-1]], [('changed', '/same.txt')])
+
+        # files within the window whose contents are the same are not recorded, and no diff is written
+        count = len(self.diffs())
+        self.backup()
+        self.assertEqual(len(self.diffs()), count)
+
+        # nor in low memory mode, where changes are committed a chunk at a time
+        self.config['low_memory_scan'] = True; self.config['split_chunk_size'] = 1
+        self.write('new.txt', 'new')
+        self.backup()
+        self.assertEqual([[(c['status'], c['path']) for c in diff] for diff in self.diffs()[count:]], [[('new', '/new.txt')]])
+
+    #----
+    def objects_of(self, version_id):
+        """ Stored objects referenced by a version, by manifest path """
+        files = core.get_manifest_at_version(interface, self.conn, self.config, version_id)['files']
+        return {fle['path'] : ('files' + fle['real_path'], fle['version_id']) for fle in files if 'empty' not in fle}
+
+    def read_object(self, obj):
+        return b''.join(core.streaming_file_chunks(interface, self.conn, self.config, *obj))
+
+    def test_prune(self):
+        self.write('a', 'AAAA'); self.write('b', 'BBBB'); self.write('x', 'XXXX'); self.write('e', 'E1E1')
+        self.backup()
+        self.write('c', 'AAAA'); self.write('e', 'E2E2'); os.remove(os.path.join(self.base, 'x'))
+        self.backup()
+        os.remove(os.path.join(self.base, 'a')); os.rename(os.path.join(self.base, 'b'), os.path.join(self.base, 'b2'))
+        self.write('g', 'GGGG')
+        self.backup()
+        self.write('d', 'DDDD'); os.remove(os.path.join(self.base, 'g'))
+        self.backup()
+
+        versions = [v['VersionId'] for v in core.get_remote_manifest_versions(interface, self.conn, self.config)]
+        self.assertEqual(len(versions), 4)
+        first = self.objects_of(versions[0])
+        kept = {version_id : self.objects_of(version_id) for version_id in versions[2:]}
+
+        # 'c' is a duplicate of 'a' and 'b2' a move of 'b', so still use the objects uploaded first
+        self.assertEqual(kept[versions[2]]['/c'], first['/a'])
+        self.assertEqual(kept[versions[2]]['/b2'], first['/b'])
+
+        self.config['retain_last'] = 2
+        self.quiet(core.prune, interface, self.conn, self.config)
+
+        # only objects no kept version references are deleted
+        deleted = {obj for obj in self.client.deleted if obj[0].startswith('files/')}
+        self.assertEqual(deleted, {first['/x'], first['/e']})
+        for version_id, objects in kept.items():
+            self.assertEqual(self.objects_of(version_id), objects)
+            for path, obj in objects.items():
+                self.assertEqual(self.read_object(obj), b'GGGG' if path == '/g' else
+                                 open(os.path.join(self.base, path.lstrip('/')), 'rb').read())
+
+        with self.assertRaises(SystemExit): core.get_manifest_at_version(interface, self.conn, self.config, versions[0])
+
+        # pruning again with the same rules deletes nothing
+        count = len(self.client.deleted)
+        self.quiet(core.prune, interface, self.conn, self.config)
+        self.assertEqual(len(self.client.deleted), count)
+
+        # pruning a history which starts from a baseline only deletes the object of 'g', which no other version has
+        self.write('f', 'FFFF')
+        self.backup()
+        self.quiet(core.prune, interface, self.conn, self.config)
+        self.assertEqual({obj for obj in self.client.deleted[count:] if obj[0].startswith('files/')}, {kept[versions[2]]['/g']})
+        latest = self.objects_of(None)
+        self.assertEqual(set(latest), {'/b2', '/c', '/d', '/e', '/f'})
+        for path, obj in latest.items(): self.assertIn(obj[1], [v['VersionId'] for v in self.client.objects[obj[0]]])
+
+    #----
+    def test_batch_changes(self):
+        changes = [{'status' : 'new', 'path' : '/%d' % i, 'size' : 10} for i in range(5)]
+        changes.insert(2, {'status' : 'deleted', 'path' : '/gone', 'size' : 1000})
+        paths = lambda batches: [[c['path'] for c in batch] for batch in batches]
+
+        self.assertEqual(paths(core.batch_changes(changes)), [[c['path'] for c in changes]])
+        self.assertEqual(paths(core.batch_changes(changes, max_files = 4)), [['/0', '/1', '/gone', '/2'], ['/3', '/4']])
+
+        # only files which may be uploaded count towards the byte limit
+        self.assertEqual(paths(core.batch_changes(changes, max_bytes = 20)), [['/0', '/1'], ['/gone', '/2', '/3'], ['/4']])
+        self.assertEqual(paths(core.batch_changes(changes, max_files = 2, max_bytes = 30)), [['/0', '/1'], ['/gone', '/2'], ['/3', '/4']])
+        self.assertEqual(list(core.batch_changes([], 2, 20)), [])
+
+    def test_deadline_deferral(self):
+        # the deadline passes as soon as a file has been uploaded, so each commit uploads one
+        self.config['split_chunk_seconds'] = 10**-9
+        self.write('one', '1'); self.write('three', '333'); self.write('two', '22'); self.write('two_copy', '22')
+        self.backup()
+
+        diffs = self.diffs()
+        self.assertEqual([[c['path'] for c in diff] for diff in diffs], [['/one'], ['/three'], ['/two', '/two_copy']])
+
+        # the duplicate was carried over with the file it duplicates
+        latest = self.objects_of(None)
+        self.assertEqual(latest['/two_copy'], latest['/two'])
+        self.assertEqual(self.read_object(latest['/two_copy']), b'22')
+
+    #----
+    def snapshot_history(self):
+        """ Five versions with a snapshot written after every second """
+        self.config['manifest_snapshot_diffs'] = 2; self.config['manifest_snapshot_bytes'] = 0
+        for i in range(5):
+            self.write('f%d' % i, 'x' * i); self.write('changing', str(i) * 3)
+            if i == 3: os.remove(os.path.join(self.base, 'f1'))
+            self.backup()
+        return core.get_remote_manifest_versions(interface, self.conn, self.config)
+
+    def test_snapshot_rebuild(self):
+        versions = self.snapshot_history()
+        snapshots = interface.list_versions(self.conn, self.config['remote_manifest_snapshot_file'])
+        self.assertEqual(len(snapshots), 2)
+
+        # a snapshot plus the diffs after it gives the same manifest as replaying every diff
+        for target, vers in enumerate(versions):
+            replayed = core.rebuild_manifest_from_diffs(core.iter_remote_manifest_diffs(interface, self.conn, self.config, versions[: target + 1]))
+            rebuilt = core.get_manifest_at_version(interface, self.conn, self.config, vers['VersionId'])
+            self.assertEqual(rebuilt['files'], replayed['files'])
+            self.assertEqual(rebuilt['latest_remote_diff'], replayed['latest_remote_diff'])
+
+        snapshot = core.find_manifest_snapshot(interface, self.conn, self.config, versions, 4)
+        self.assertEqual((snapshot['index'], snapshot['version_id']), (3, versions[3]['VersionId']))
+
+    def test_snapshot_cutoff(self):
+        versions = self.snapshot_history()
+
+        # snapshots written after the diff following the target are skipped without being read
+        self.client.gets.clear()
+        self.assertIsNone(core.find_manifest_snapshot(interface, self.conn, self.config, versions, 0))
+        self.assertNotIn(self.config['remote_manifest_snapshot_file'], self.client.gets)
+
+        snapshot = core.find_manifest_snapshot(interface, self.conn, self.config, versions, 2)
+        self.assertEqual(snapshot['index'], 1)
+        self.assertEqual(self.client.gets.count(self.config['remote_manifest_snapshot_file']), 1)
+
+    def test_snapshot_counters(self):
+        self.config['manifest_snapshot_diffs'] = 2; self.config['manifest_snapshot_bytes'] = 0
+        counters = []
+        for i in range(3):
+            self.write('f', str(i)); self.backup()
+            counters.append(manifest_store.load(self.config)['since_snapshot']['diffs'])
+        self.assertEqual(counters, [1, 0, 1])
+        self.assertEqual(len(interface.list_versions(self.conn, self.config['remote_manifest_snapshot_file'])), 1)
+
+        # the size of the diffs also triggers a snapshot
+        file_manifest = manifest_store.load(self.config)
+        self.config['manifest_snapshot_diffs'] = 0; self.config['manifest_snapshot_bytes'] = 10
+        file_manifest['since_snapshot'] = {'diffs' : 1, 'bytes' : 9}
+        self.quiet(core.write_manifest_snapshot_if_due, self.config, file_manifest)
+        self.assertEqual(len(interface.list_versions(self.conn, self.config['remote_manifest_snapshot_file'])), 1)
+
+        file_manifest['since_snapshot'] = {'diffs' : 1, 'bytes' : 10}
+        file_manifest = self.quiet(core.write_manifest_snapshot_if_due, self.config, file_manifest)
+        self.assertEqual(file_manifest['since_snapshot'], {'diffs' : 0, 'bytes' : 0})
+        self.assertEqual(manifest_store.load(self.config)['since_snapshot'], {'diffs' : 0, 'bytes' : 0})
+        self.assertEqual(len(interface.list_versions(self.conn, self.config['remote_manifest_snapshot_file'])), 2)
+
+    #----
+    def remote_diff(self, path, meta):
+        """ Write a diff adding a copy of '/a' at 'path' behind the back of the local manifest """
+        item = dict(manifest_store.load(self.config)['files'][0], path = path, status = 'new')
+        return self.quiet(core.write_manifest_object, self.config, self.config['remote_manifest_diff_file'], [item], meta)['version_id']
+
+    def test_get_manifest_one_ahead(self):
+        self.write('a', 'AAAA'); self.backup()
+        local = core.get_manifest(interface, self.conn, self.config)['latest_remote_diff']
+
+        # as after a crash between writing the remote diff and committing the local manifest
+        version_id = self.remote_diff('/b', {'seq' : local['seq'] + 1, 'parent' : local['version_id']})
+        file_manifest = self.quiet(core.get_manifest, interface, self.conn, self.config)
+        self.assertEqual([fle['path'] for fle in file_manifest['files']], ['/a', '/b'])
+        self.assertEqual(file_manifest['latest_remote_diff'], {'version_id' : version_id, 'seq' : local['seq'] + 1})
+
+        # the update was committed locally
+        self.assertEqual(manifest_store.load(self.config)['latest_remote_diff']['version_id'], version_id)
+
+    def test_get_manifest_parent_mismatch(self):
+        self.write('a', 'AAAA'); self.backup()
+        local = core.get_manifest(interface, self.conn, self.config)['latest_remote_diff']
+
+        self.remote_diff('/b', {'seq' : local['seq'] + 1, 'parent' : 'elsewhere'})
+        with self.assertRaises(SystemExit): core.get_manifest(interface, self.conn, self.config)
+
+    def test_get_manifest_legacy_diff(self):
+        self.write('a', 'AAAA'); self.backup()
+
+        # diffs written by older versions record no parent, the version listing is used instead
+        version_id = self.remote_diff('/b', None)
+        file_manifest = self.quiet(core.get_manifest, interface, self.conn, self.config)
+        self.assertEqual([fle['path'] for fle in file_manifest['files']], ['/a', '/b'])
+        self.assertEqual(file_manifest['latest_remote_diff']['version_id'], version_id)
+
+        # more than one diff ahead can not be aligned
+        self.remote_diff('/c', None); self.remote_diff('/d', None)
+        with self.assertRaises(SystemExit): core.get_manifest(interface, self.conn, self.config)
+
+    #----
+    def garbage_segments(self, count):
+        """ Objects, each listed as garbage in a segment of its own """
+        objects = []
+        for i in range(count):
+            obj = ('files/garbage%d' % i, self.client.put_object('bucket', 'files/garbage%d' % i, b'x')['VersionId'])
+            core.append_garbage_log_segment(self.config, [obj]); objects.append(obj)
+        return objects
+
+    def test_compact_garbage_log(self):
+        objects = self.garbage_segments(5)
+        self.config['garbage_log_batch_segments'] = 2
+        self.quiet(core.compact_garbage_log, interface, self.conn, self.config)
+
+        # two batches of two are merged, the single segment left over is not
+        segments = core.list_garbage_log_segments(interface, self.conn, self.config)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(sorted(core.read_garbage_log_segments(self.config, segments)), sorted(objects))
+        self.assertTrue(all(obj[0] in self.client.objects for obj in objects))
+
+    def test_clean_gc_log_interrupted(self):
+        objects = self.garbage_segments(4)
+        self.config['garbage_log_batch_segments'] = 2
+
+        # interrupted once the objects of the first batch are deleted, before its segments are
+        self.client.fail_deletes = self.config['remote_garbage_object_log_file'] + '/'
+        with self.assertRaises(ConnectionError): self.quiet(core.clean_gc_log, interface, self.conn, self.config)
+        self.assertEqual(len(core.list_garbage_log_segments(interface, self.conn, self.config)), 4)
+        self.assertEqual([obj for obj in objects if obj in self.client.deleted], objects[:2])
+
+        # running it again deletes the rest, and the first batch again without error
+        self.client.fail_deletes = None
+        self.quiet(core.clean_gc_log, interface, self.conn, self.config)
+        self.assertEqual(core.list_garbage_log_segments(interface, self.conn, self.config), [])
+        self.assertTrue(all(self.client.objects[obj[0]] == [] for obj in objects))
@@ -0,0 +1,72 @@
+import rrbackup.daemon as daemon
+import unittest, tempfile, shutil, os, stat, socket, threading, time, contextlib, io
+
+class test_daemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = daemon.add_default_config({})
+        self.config['daemon_socket'] = os.path.join(self.tmp, 'rrbackup.sock')
+        self.config['daemon_interval'] = 0.05
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def start(self, run_backup, queries):
+        self.stop = threading.Event()
+        self.output = io.StringIO()
+        def run():
+            with contextlib.redirect_stdout(self.output), contextlib.redirect_stderr(self.output):
+                daemon.serve(self.config, run_backup, queries, self.stop)
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        while 'Listening' not in self.output.getvalue(): time.sleep(0.01)
+
+    def finish(self):
+        self.stop.set(); self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.config['daemon_socket']))
+
+    def test_queries(self):
+        def failing():
+            raise SystemExit('The given version ID x does not exist')
+        self.start(lambda: None, {'echo' : lambda *args: list(args), 'fails' : failing,
+                                  'broken' : lambda: 1 / 0})
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.config['daemon_socket']).st_mode), 0o600)
+        self.assertEqual(daemon.query(self.config, 'echo', ['a', 1]), ['a', 1])
+        self.assertEqual(daemon.query(self.config, 'echo'), [])
+
+        for command, message in [('fails', 'The given version ID x does not exist'), ('nothing', 'Unknown command'),
+                                 ('broken', 'ZeroDivisionError: division by zero')]:
+            with self.assertRaises(SystemExit) as ctx: daemon.query(self.config, command)
+            self.assertEqual(str(ctx.exception), message)
+
+        # a second service cannot start on the same socket
+        with self.assertRaises(SystemExit): daemon.remove_stale_socket(self.config['daemon_socket'])
+        self.finish()
+
+        with self.assertRaises(OSError): daemon.query(self.config, 'echo')
+
+    def test_backups_repeat_after_failure(self):
+        runs = []
+        def run_backup():
+            runs.append(time.monotonic())
+            if len(runs) == 2: raise RuntimeError('connection lost')
+        self.start(run_backup, {})
+
+        while len(runs) < 4: time.sleep(0.01)
+        self.finish()
+        self.assertIn('connection lost', self.output.getvalue())
+        self.assertTrue(all(b - a >= 0.04 for a, b in zip(runs, runs[1:])))
+
+    def test_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.config['daemon_socket']); sock.close()
+        self.start(lambda: None, {'ping' : lambda: 'pong'})
+        self.assertEqual(daemon.query(self.config, 'ping'), 'pong')
+        self.finish()
+
+    def test_validate(self):
+        daemon.validate_config({'daemon_interval' : 60})
+        with self.assertRaises(SystemExit): daemon.validate_config({'daemon_interval' : 0})
+        with self.assertRaises(SystemExit): daemon.validate_config({'daemon_interval' : '60'})
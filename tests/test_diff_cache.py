@@ -0,0 +1,55 @@
+import rrbackup.diff_cache as diff_cache
+import unittest, tempfile, shutil, datetime, os, time
+
+def make_meta():
+    return {'path'          : 'manifest_diffs',
+            'header'        : b'{"V":"1"}',
+            'last_modified' : datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)}
+
+class test_diff_cache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.config = diff_cache.add_default_config({})
+        self.config['local_diff_cache_dir'] = self.cache_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        diff_cache.put(self.config, 'v1', b'[1, 2]', make_meta())
+        data, meta = diff_cache.get(self.config, 'v1')
+
+        self.assertEqual(data, b'[1, 2]')
+        self.assertEqual(meta['version_id'], 'v1')
+        self.assertEqual(meta['header'], make_meta()['header'])
+        self.assertEqual(meta['last_modified'], make_meta()['last_modified'])
+        self.assertIsNone(diff_cache.get(self.config, 'v2'))
+
+    def test_disabled(self):
+        self.config['local_diff_cache_dir'] = None
+        diff_cache.put(self.config, 'v1', b'[]', make_meta())
+        self.assertIsNone(diff_cache.get(self.config, 'v1'))
+
+    def test_corrupt_entry_discarded(self):
+        diff_cache.put(self.config, 'v1', b'[1, 2]', make_meta())
+        path = diff_cache.entry_path(self.config, 'v1')
+        with open(path, 'r+b') as fle:
+            fle.seek(-1, os.SEEK_END); fle.write(b'3')
+
+        self.assertIsNone(diff_cache.get(self.config, 'v1'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            diff_cache.put(self.config, 'v' + str(i), b'x' * 1000, make_meta())
+            os.utime(diff_cache.entry_path(self.config, 'v' + str(i)), (time.time() + i, time.time() + i))
+
+        # reading v0 makes it the most recently used
+        os.utime(diff_cache.entry_path(self.config, 'v0'), (time.time() + 10, time.time() + 10))
+
+        self.config['local_diff_cache_size'] = os.path.getsize(diff_cache.entry_path(self.config, 'v0')) * 2
+        diff_cache.evict(self.config)
+
+        self.assertIsNotNone(diff_cache.get(self.config, 'v0'))
+        self.assertIsNone(diff_cache.get(self.config, 'v1'))
+        self.assertIsNotNone(diff_cache.get(self.config, 'v2'))
@@ -0,0 +1,47 @@
+import rrbackup.diff_codec as diff_codec
+import rrbackup.fsutil as sfs
+import unittest, json
+
+class test_diff_codec(unittest.TestCase):
+    def test_round_trip(self):
+        diff = [{'status' : 'new', 'path' : '/dir/file1', 'created' : 1.5, 'last_mod' : 2.25,
+                 'hash' : 'ab' * 32, 'real_path' : '/dir/file1', 'version_id' : 'v1'},
+                {'status' : 'new', 'path' : '/dir/file2', 'created' : 1.5, 'last_mod' : 2.25,
+                 'hash' : 'ab' * 32, 'real_path' : '/dir/file1', 'version_id' : 'v1'},
+                {'status' : 'moved', 'path' : '/other/file3', 'moved_from' : '/dir/file3'},
+                {'status' : 'deleted', 'path' : 'no_directory', 'created' : 10, 'hash' : '12345'},
+                {'status' : 'unusual', 'path' : '/dir/é', 'empty' : True, 'last_mod' : ''}]
+
+        meta, items = diff_codec.decode(diff_codec.encode(diff, {'seq' : 3}))
+
+        self.assertEqual(meta, {'seq' : 3})
+        self.assertEqual(items, diff)
+        self.assertIsInstance(items[0], sfs.manifest_entry)
+        self.assertIs(items[0].directory, items[1].directory)
+
+    def test_file_state(self):
+        diff = [{'status' : 'new', 'path' : '/file', 'last_mod' : 2.25, 'size' : 3,
+                 'mtime_ns' : 2250000000, 'ctime_ns' : 2250000001, 'inode' : 2 ** 40},
+                {'status' : 'new', 'path' : '/other', 'size' : -1, 'inode' : 'unusual'}]
+
+        self.assertEqual(diff_codec.decode(diff_codec.encode(diff))[1], diff)
+
+    def test_reads_version_1(self):
+        data = bytearray(diff_codec.encode([{'status' : 'new', 'path' : '/file', 'last_mod' : 2.25}]))
+        data[3] = 1
+        self.assertEqual(diff_codec.decode(bytes(data))[1], [{'status' : 'new', 'path' : '/file', 'last_mod' : 2.25}])
+
+    def test_empty(self):
+        self.assertEqual(diff_codec.decode(diff_codec.encode([])), ({}, []))
+
+    def test_smaller_than_json(self):
+        diff = [{'status' : 'new', 'path' : '/some/long/directory/name/file' + str(i),
+                 'created' : 1500000000.0 + i, 'last_mod' : 1500000000.0 + i,
+                 'hash' : '%064x' % i, 'real_path' : '/some/long/directory/name/file' + str(i),
+                 'version_id' : 'v%030d' % i} for i in range(100)]
+
+        self.assertLess(len(diff_codec.encode(diff)) * 2, len(json.dumps(diff)))
+
+    def test_rejects_other_data(self):
+        with self.assertRaises(ValueError):
+            diff_codec.decode(b'[{"path" : "/file"}]')
@@ -0,0 +1,79 @@
+import rrbackup.manifest_store as manifest_store
+import rrbackup.fsutil as sfs
+import unittest, tempfile, shutil, os
+
+def entry(path, hsh):
+    return {'path' : path, 'hash' : hsh, 'version_id' : 'v' + hsh}
+
+class test_manifest_store(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = manifest_store.add_default_config({})
+        self.config['local_manifest_file'] = os.path.join(self.directory, 'manifest')
+
+    def tearDown(self):
+        manifest_store.connections.clear()
+        shutil.rmtree(self.directory)
+
+    def manifest(self, files):
+        return {'latest_remote_diff' : {'version_id' : 'a'}, 'files' : files}
+
+    def test_json_round_trip(self):
+        file_manifest = self.manifest([entry('/a', '1')])
+        manifest_store.write(self.config, file_manifest)
+        self.assertEqual(manifest_store.load(self.config), file_manifest)
+
+    def test_missing(self):
+        for store in ['json', 'sqlite']:
+            self.config['local_manifest_store'] = store
+            with self.assertRaises(IOError):
+                manifest_store.load(self.config)
+
+    def test_sqlite_commit_matches_replay(self):
+        self.config['local_manifest_store'] = 'sqlite'
+        files = [entry('/a', '1'), entry('/b', '2'), entry('/c', '3')]
+        manifest_store.write(self.config, self.manifest(files))
+
+        diff = [{'path' : '/b', 'status' : 'deleted'},
+                {'path' : '/d', 'status' : 'new', 'hash' : '4'},
+                {'path' : '/e', 'status' : 'moved', 'moved_from' : '/a', 'hash' : '1'},
+                {'path' : '/c', 'status' : 'changed', 'hash' : '5'}]
+
+        expected = self.manifest(sfs.apply_diffs([diff], files))
+        expected['latest_remote_diff'] = {'version_id' : 'b'}
+        manifest_store.commit(self.config, expected, diff)
+
+        manifest_store.connections.clear()
+        self.assertEqual(manifest_store.load(self.config), expected)
+        self.assertEqual(manifest_store.find_by_path(self.config, '/c')['hash'], '5')
+        self.assertEqual(manifest_store.find_by_hash(self.config, '1')['path'], '/e')
+        self.assertIsNone(manifest_store.find_by_path(self.config, '/b'))
+
+    def test_iter_sorted(self):
+        files = [entry('/c', '1'), entry('/a', '2'), entry('/b', '3')]
+        for store in ['json', 'sqlite']:
+            self.config['local_manifest_store'] = store
+            manifest_store.write(self.config, self.manifest(files))
+
+            file_manifest = manifest_store.load(self.config, with_files = store == 'json')
+            sorted_files = manifest_store.iter_sorted(self.config, file_manifest)
+            self.assertEqual(next(sorted_files)['path'], '/a')
+
+            # commits made while iterating are not seen
+            if store == 'sqlite':
+                self.assertNotIn('files', file_manifest)
+                manifest_store.commit(self.config, file_manifest, [{'path' : '/b', 'status' : 'deleted'}])
+            self.assertEqual([fle['path'] for fle in sorted_files], ['/b', '/c'])
+
+    def test_sqlite_migrates_json(self):
+        file_manifest = self.manifest([entry('/a', '1')])
+        manifest_store.write(self.config, file_manifest)
+
+        self.config['local_manifest_store'] = 'sqlite'
+        self.assertEqual(manifest_store.load(self.config), file_manifest)
+        self.assertTrue(os.path.isfile(manifest_store.sqlite_path(self.config)))
+
+        # the JSON manifest is moved aside, so going back to the JSON store does not load it
+        self.assertFalse(os.path.exists(self.config['local_manifest_file']))
+        self.config['local_manifest_store'] = 'json'
+        with self.assertRaises(IOError): manifest_store.load(self.config)
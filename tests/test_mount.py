@@ -0,0 +1,105 @@
+import rrbackup.mount as mount
+import rrbackup.pipeline as pipeline
+import unittest, datetime, errno, os, random, stat, struct, pysodium
+
+def make_object(data, chunk_size, key = None):
+    """ Stored form of 'data', as written by the streaming pipeline """
+    pl_format = {'version' : 1, 'chunk_size' : chunk_size, 'format' : {}}
+    if key is not None: pl_format['format']['encrypt'] = {}
+    header = pipeline.serialise_pipeline_format(pl_format)
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    body = b''
+    if key is not None:
+        state, stream_header = pysodium.crypto_secretstream_xchacha20poly1305_init_push(key)
+        body = stream_header + b''.join(pysodium.crypto_secretstream_xchacha20poly1305_push(state, c, header, 0) for c in chunks)
+    else: body = b''.join(chunks)
+    return struct.pack('!I', len(header)) + header + body
+
+class test_mount(unittest.TestCase):
+    def setUp(self):
+        self.key = pysodium.crypto_secretstream_xchacha20poly1305_keygen()
+        self.config = mount.add_default_config({'crypto' : {'stream_crypt_key' : self.key}})
+        self.config['mount_cache_bytes'] = 100
+
+        rnd = random.Random(0)
+        self.data = bytes(rnd.randrange(256) for _ in range(1000))
+        self.objects = {('/big', '1')   : make_object(self.data, 30, self.key),
+                        ('/plain', '2') : make_object(self.data, 30),
+                        ('/small', '3') : make_object(b'small', 30, self.key)}
+        self.reads = []
+
+        files = {'v1' : [{'path' : '/a/big', 'real_path' : '/big', 'version_id' : '1'},
+                         {'path' : '/a/b/plain', 'real_path' : '/plain', 'version_id' : '2', 'size' : 1000},
+                         {'path' : '/small', 'real_path' : '/small', 'version_id' : '3', 'size' : 5},
+                         {'path' : '/empty', 'empty' : True}],
+                 'v2' : [{'path' : '/small', 'real_path' : '/small', 'version_id' : '3', 'size' : 5}]}
+
+        def read_range(real_path, version_id, first, last):
+            self.reads.append((real_path, first, last))
+            data = self.objects[(real_path, version_id)]
+            return data[first : last + 1], len(data)
+
+        # sizes not recorded in the manifest come from a listing, with the header the configuration gives
+        stored_sizes = {obj : len(data) for obj, data in self.objects.items()}
+        def expected_header(fle):
+            data = self.objects[(fle['real_path'], fle['version_id'])]
+            return data[4 : 4 + struct.unpack('!I', data[:4])[0]]
+
+        self.loads = []
+        def load_files(version_id):
+            self.loads.append(version_id)
+            return mount.fill_sizes(files[version_id], stored_sizes, lambda fle: fle['real_path'], expected_header)
+
+        versions = [{'VersionId' : 'v1', 'LastModified' : datetime.datetime(2020, 1, 1)},
+                    {'VersionId' : 'v2', 'LastModified' : datetime.datetime(2020, 1, 2)}]
+        self.fs = mount.backup_fs(self.config, versions, load_files, read_range)
+        self.v1 = '/2020-01-01_000000_v1'
+
+    def test_listing(self):
+        self.assertEqual(self.fs('readdir', '/'), ['.', '..', '2020-01-01_000000_v1', '2020-01-02_000000_v2', 'latest'])
+        self.assertEqual(self.fs('readlink', '/latest'), '2020-01-02_000000_v2')
+
+        # the version directories are listed without building their file lists
+        for name in ['2020-01-01_000000_v1', '2020-01-02_000000_v2']:
+            self.assertTrue(self.fs('getattr', '/' + name)['st_mode'] & stat.S_IFDIR)
+        self.assertEqual(self.loads, [])
+
+        self.assertEqual(self.fs('readdir', self.v1 + '/a'), ['.', '..', 'b', 'big'])
+        self.assertEqual(self.fs('getattr', self.v1 + '/a/b/plain')['st_size'], 1000)
+        self.assertEqual(self.fs('getattr', self.v1 + '/empty')['st_size'], 0)
+
+        # the size of a file recorded by an older version is derived from the listing
+        self.assertEqual(self.fs('getattr', self.v1 + '/a/big')['st_size'], 1000)
+        self.assertEqual(self.reads, [])
+
+        with self.assertRaises(OSError) as cm: self.fs('getattr', self.v1 + '/missing')
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        with self.assertRaises(OSError) as cm: self.fs('open', self.v1 + '/small', os.O_WRONLY)
+        self.assertEqual(cm.exception.errno, errno.EROFS)
+
+    def test_read(self):
+        rnd = random.Random(1)
+        for path in ['/a/big', '/a/b/plain']:
+            for _ in range(50):
+                offset = rnd.randrange(1100); size = rnd.randrange(200)
+                self.assertEqual(self.fs('read', self.v1 + path, size, offset, 0), self.data[offset : offset + size])
+
+        self.assertEqual(self.fs('read', self.v1 + '/small', 100, 0, 0), b'small')
+        self.assertEqual(self.fs('read', self.v1 + '/empty', 100, 0, 0), b'')
+
+    def test_read_bounded(self):
+        # reading the end of a file first decrypts forward from the start a few chunks per read
+        self.fs('open', self.v1 + '/a/big', os.O_RDONLY)
+        self.reads.clear()
+        self.assertEqual(self.fs('read', self.v1 + '/a/big', 10, 990, 0), self.data[990:])
+        body_reads = [(first, last) for _, first, last in self.reads if first > 0]
+        self.assertTrue(len(body_reads) > 1)
+        self.assertTrue(all(last - first < mount.GROUP_CHUNKS * 47 for first, last in body_reads))
+
+    def test_block_cache(self):
+        cache = mount.block_cache(10)
+        cache.put('a', b'12345'); cache.put('b', b'12345')
+        cache.get('a'); cache.put('c', b'12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'12345')
@@ -0,0 +1,31 @@
+import rrbackup.parallel as parallel
+import unittest, time, random, threading
+
+class test_parallel(unittest.TestCase):
+    def test_ordered_map_preserves_order(self):
+        def slow_square(i):
+            time.sleep(random.random() / 100)
+            return i * i
+
+        result = list(parallel.ordered_map(slow_square, range(50), 8))
+        self.assertEqual(result, [i * i for i in range(50)])
+
+    def test_ordered_map_bounded_window(self):
+        started = []; lock = threading.Lock()
+        def record(i):
+            with lock: started.append(i)
+            return i
+
+        results = parallel.ordered_map(record, range(1000), 2, 4)
+        self.assertEqual(next(results), 0)
+        results.close()
+
+        self.assertLessEqual(len(started), 5)
+
+    def test_ordered_map_propagates_errors(self):
+        def fail(i):
+            if i == 3: raise ValueError('failed')
+            return i
+
+        with self.assertRaises(ValueError):
+            list(parallel.ordered_map(fail, range(10), 4))
@@ -67,6 +67,18 @@ class test_pipeline(unittest.TestCase):
 
         self.assertEqual(data_in, data_out)
 
+    def test_streaming_content_size(self):
+        for fmt in [{}, {'encrypt' : {}}]:
+            pl_format = pipeline.get_default_pipeline_format()
+            pl_format['chunk_size'] = 100; pl_format['format'] = fmt
+            header = pipeline.serialise_pipeline_format(pl_format)
+            start, stride = pipeline.streaming_layout(pl_format)
+
+            for size in [0, 1, 99, 100, 101, 250]:
+                chunks = -(-size // 100)
+                stored = 4 + len(header) + start + size + chunks * (stride - 100)
+                self.assertEqual(pipeline.streaming_content_size(header, stored), size)
+
     @unittest.skipUnless(os.path.isfile('test_s3_conf.json'), "To test using s3 please create 'test_s3_conf.json")
     def test_streaming_pipeline(self):
 
@@ -0,0 +1,127 @@
+import rrbackup.restore as restore
+import unittest, tempfile, shutil, os, threading, time, hashlib, io, tarfile
+
+class test_restore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = restore.add_default_config({'chunk_size' : 10, 'remote_base_path' : 'files'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_restore_files(self):
+        files = [{'path' : '/a/b/file' + str(i), 'real_path' : '/file' + str(i), 'version_id' : str(i), 'size' : 4}
+                 for i in range(20)]
+        files.append({'path' : '/c/empty', 'empty' : True})
+
+        active = []; peak = []; lock = threading.Lock()
+        def fetch(remote_file_path, version_id, local_file_path):
+            with lock: active.append(1); peak.append(len(active))
+            time.sleep(0.01)
+            with open(local_file_path, 'w') as fle: fle.write(remote_file_path + ' ' + version_id)
+            with lock: active.pop()
+
+        self.config['restore_workers'] = 4
+        restore.restore_files(self.config, fetch, files, self.directory)
+
+        with open(os.path.join(self.directory, 'a/b/file3')) as fle: self.assertEqual(fle.read(), 'files/file3 3')
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, 'c/empty')), 0)
+        self.assertGreater(max(peak), 1)
+        self.assertLessEqual(max(peak), 4)
+
+    def test_byte_budget(self):
+        budget = restore.byte_budget(10)
+        self.assertEqual(budget.acquire(6), 6)
+
+        # an object which does not fit waits until there is room
+        acquired = []
+        thread = threading.Thread(target = lambda: acquired.append(budget.acquire(6)))
+        thread.start(); time.sleep(0.05)
+        self.assertEqual(acquired, [])
+
+        budget.release(6); thread.join()
+        self.assertEqual(acquired, [6])
+
+        # objects larger than the budget are allowed alone
+        budget.release(6)
+        self.assertEqual(budget.acquire(100), 10)
+
+    def test_incremental(self):
+        files = [{'path' : '/file' + str(i), 'real_path' : '/file' + str(i), 'version_id' : str(i),
+                  'size' : 4, 'mtime_ns' : 1500000000 * 10**9, 'hash' : hashlib.sha256(b'data').hexdigest()}
+                 for i in range(3)]
+
+        fetched = []
+        def fetch(remote_file_path, version_id, local_file_path):
+            fetched.append(version_id)
+            with open(local_file_path, 'wb') as fle: fle.write(b'data')
+
+        self.config['restore_incremental'] = True
+        restore.restore_files(self.config, fetch, files, self.directory)
+        self.assertEqual(sorted(fetched), ['0', '1', '2'])
+        self.assertEqual(os.stat(os.path.join(self.directory, 'file0')).st_mtime_ns, 1500000000 * 10**9)
+
+        # a file with the wrong contents is fetched again, one with only the wrong time is not
+        with open(os.path.join(self.directory, 'file1'), 'wb') as fle: fle.write(b'xxxx')
+        os.utime(os.path.join(self.directory, 'file2'), None)
+
+        fetched.clear()
+        restore.restore_files(self.config, fetch, files, self.directory)
+        self.assertEqual(fetched, ['1'])
+        self.assertEqual(os.stat(os.path.join(self.directory, 'file2')).st_mtime_ns, 1500000000 * 10**9)
+
+        with open(os.path.join(self.directory, 'extra'), 'wb') as fle: fle.write(b'x')
+        restore.remove_extra_files(self.directory, {'/file0', '/file1', '/file2'})
+        self.assertEqual(sorted(os.listdir(self.directory)), ['file0', 'file1', 'file2'])
+
+    def test_duplicates_fetched_once(self):
+        files = [{'path' : '/copy' + str(i), 'real_path' : '/shared', 'version_id' : '1', 'size' : 4} for i in range(5)]
+        files.append({'path' : '/other', 'real_path' : '/other', 'version_id' : '2', 'size' : 4})
+
+        fetched = []
+        def fetch(remote_file_path, version_id, local_file_path):
+            fetched.append(remote_file_path)
+            with open(local_file_path, 'w') as fle: fle.write(version_id * 4)
+
+        restore.restore_files(self.config, fetch, files, self.directory)
+        self.assertEqual(sorted(fetched), ['files/other', 'files/shared'])
+        for i in range(5):
+            with open(os.path.join(self.directory, 'copy' + str(i))) as fle: self.assertEqual(fle.read(), '1111')
+
+        # hard links share the inode of the first copy
+        self.config['restore_duplicates'] = 'hardlink'
+        restore.restore_files(self.config, fetch, files, self.directory)
+        self.assertEqual(os.stat(os.path.join(self.directory, 'copy4')).st_ino,
+                         os.stat(os.path.join(self.directory, 'copy0')).st_ino)
+
+    def test_restore_tar(self):
+        files = [{'path' : '/a/small', 'real_path' : '/small', 'version_id' : '1', 'size' : 5, 'mtime_ns' : 1500000000 * 10**9},
+                 {'path' : '/a/large', 'real_path' : '/large', 'version_id' : '2', 'size' : 4000},
+                 {'path' : '/b/legacy', 'real_path' : '/legacy', 'version_id' : '3'},
+                 {'path' : '/b/copy', 'real_path' : '/small', 'version_id' : '1', 'size' : 5},
+                 {'path' : '/c/empty', 'empty' : True}]
+        contents = {'1' : b'small', '2' : b'x' * 5000, '3' : b'legacy'}
+
+        # '/large' changed after it was scanned, so is stored larger than the manifest records
+        opened = []
+        def open_object(remote_file_path, version_id):
+            opened.append(version_id); data = contents[version_id]
+            return len(data), (data[i : i + 10] for i in range(0, len(data), 10))
+
+        self.config['restore_max_inflight_bytes'] = 100
+        self.config['restore_duplicates'] = 'hardlink'
+        output = io.BytesIO()
+        restore.restore_tar(self.config, open_object, files, output)
+        self.assertEqual(sorted(opened), ['1', '2', '3'])
+
+        output.seek(0)
+        with tarfile.open(fileobj = output) as tar:
+            members = tar.getmembers()
+            self.assertEqual([m.name for m in members], ['a/small', 'a/large', 'b/legacy', 'b/copy', 'c/empty'])
+            self.assertEqual(members[1].size, 5000)
+            self.assertEqual(tar.extractfile('a/large').read(), contents['2'])
+            self.assertEqual(tar.extractfile('b/legacy').read(), contents['3'])
+            self.assertEqual(members[0].mtime, 1500000000)
+            self.assertTrue(members[3].islnk())
+            self.assertEqual(members[3].linkname, 'a/small')
+            self.assertEqual(members[4].size, 0)
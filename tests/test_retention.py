@@ -0,0 +1,43 @@
+import rrbackup.retention as retention
+import unittest, datetime
+
+def make_versions(times):
+    return [{'VersionId' : str(i), 'LastModified' : t} for i, t in enumerate(times)]
+
+class test_retention(unittest.TestCase):
+    def setUp(self):
+        start = datetime.datetime(2021, 3, 1, 12, tzinfo = datetime.timezone.utc) # a Monday
+        # two versions a day for three weeks
+        self.versions = make_versions([start + datetime.timedelta(days = d, hours = h)
+                                       for d in range(21) for h in [0, 6]])
+
+    def select(self, **rules):
+        config = retention.add_default_config({}); config.update(rules)
+        return retention.select_versions(config, self.versions)
+
+    def test_newest_always_kept(self):
+        self.assertEqual(retention.select_versions({}, self.versions), {'41'})
+        self.assertEqual(retention.select_versions({}, []), set())
+
+    def test_last(self):
+        self.assertEqual(self.select(retain_last = 3), {'39', '40', '41'})
+        self.assertEqual(self.select(retain_last = 100), {str(i) for i in range(42)})
+
+    def test_daily(self):
+        # the later version of each of the last three days
+        self.assertEqual(self.select(retain_daily = 3), {'37', '39', '41'})
+
+    def test_weekly(self):
+        # the last version of each week, the newest week is the current one
+        self.assertEqual(self.select(retain_weekly = 2), {'27', '41'})
+        self.assertEqual(self.select(retain_weekly = 10), {'13', '27', '41'})
+
+    def test_combined(self):
+        self.assertEqual(self.select(retain_last = 2, retain_daily = 2, retain_weekly = 3),
+                         {'13', '27', '39', '40', '41'})
+
+    def test_validate(self):
+        self.assertFalse(retention.has_rules(retention.add_default_config({})))
+        self.assertTrue(retention.has_rules({'retain_weekly' : 1}))
+        with self.assertRaises(SystemExit): retention.validate_config({'retain_last' : -1})
+        with self.assertRaises(SystemExit): retention.validate_config({'retain_daily' : '3'})
@@ -0,0 +1,123 @@
+import rrbackup.s3_interface as s3_interface
+import rrbackup.pipeline as pipeline
+import unittest, datetime, io, struct, threading
+
+class stub_client:
+    """ Returns a fixed version listing, newest first as S3 does """
+    def __init__(self, versions):
+        self.versions = versions
+
+    def list_object_versions(self, **kwargs):
+        return {'Versions' : self.versions, 'IsTruncated' : False}
+
+class ranged_client:
+    """ Serves ranged GETs of a single object """
+    class exceptions:
+        class NoSuchKey(Exception): pass
+
+    def __init__(self, data):
+        self.data = data; self.ranges = []; self.version_ids = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, VersionId = None, Range = None):
+        first, last = (int(i) for i in Range.split('=')[1].split('-'))
+        last = min(last, len(self.data) - 1)
+        with self.lock:
+            self.ranges.append((first, last)); self.version_ids.append(VersionId)
+        return {'Body' : io.BytesIO(self.data[first : last + 1]), 'VersionId' : 'v1', 'Metadata' : {},
+                'LastModified' : None, 'ContentLength' : last + 1 - first, 'ContentType' : '',
+                'ContentRange' : 'bytes %d-%d/%d' % (first, last, len(self.data))}
+
+class listing_client:
+    """ Lists versions of a set of keys a few at a time, as S3 does a thousand """
+    def __init__(self, objects, page_size):
+        self.objects = objects; self.page_size = page_size; self.requests = 0
+
+    def list_object_versions(self, Bucket, Prefix = '', Delimiter = None, KeyMarker = None, VersionIdMarker = None):
+        self.requests += 1
+        rows = [(key, version) for key in sorted(self.objects) if key.startswith(Prefix)
+                and not (Delimiter and Delimiter in key[len(Prefix):]) for version in self.objects[key]]
+        start = rows.index((KeyMarker, VersionIdMarker)) + 1 if KeyMarker is not None else 0
+        page = rows[start : start + self.page_size]
+
+        res = {'Versions' : [{'Key' : key, 'VersionId' : version} for key, version in page],
+               'IsTruncated' : start + self.page_size < len(rows)}
+        if res['IsTruncated']: res['NextKeyMarker'], res['NextVersionIdMarker'] = page[-1]
+        return res
+
+class test_s3_interface(unittest.TestCase):
+    def test_list_versions_same_second(self):
+        second = datetime.datetime(2020, 1, 1)
+        versions = [{'Key' : 'manifest_diffs', 'VersionId' : str(i), 'LastModified' : second} for i in [3, 2, 1]]
+        versions.append({'Key' : 'manifest_diffs', 'VersionId' : '0', 'LastModified' : second - datetime.timedelta(seconds = 1)})
+
+        conn = {'client' : stub_client(versions), 'bucket' : 'bucket'}
+        result = s3_interface.list_versions(conn, 'manifest_diffs')
+        self.assertEqual([v['VersionId'] for v in result], ['0', '1', '2', '3'])
+
+    def test_ranged_download(self):
+        header = pipeline.serialise_pipeline_format({'version' : 1, 'chunk_size' : 10, 'format' : {}})
+        payload = bytes(range(95))
+        data = struct.pack('!I', len(header)) + header + payload
+
+        client = ranged_client(data)
+        conn = {'client' : client, 'bucket' : 'bucket'}
+        download = s3_interface.ranged_download(workers = 3, part_size = 32)
+        download.begin(conn, 'key', None)
+        self.assertEqual(download.total, len(data))
+
+        chunks = []
+        while True:
+            chunk = download.next_chunk()
+            if chunk is None: break
+            chunks.append(chunk)
+        self.assertEqual(chunks, [payload[i:i+10] for i in range(0, 95, 10)])
+
+        # parts after the first end on chunk boundaries, and are read from the same version
+        body_start = 4 + len(header)
+        ranges = sorted(client.ranges)
+        for first, last in ranges[1:-1]:
+            self.assertEqual((last + 1 - body_start) % 10, 0)
+        self.assertEqual(ranges[-1][1], len(data) - 1)
+        self.assertEqual(client.version_ids.count('v1'), len(ranges) - 1)
+
+    def test_list_latest_versions(self):
+        # versions are listed newest first
+        objects = {'files/d/f%03d' % i : ['v%d.2' % i, 'v%d.1' % i] for i in range(100)}
+        objects['files/d/f010x'] = ['other']
+        objects['files/d/sub/f'] = ['nested']
+        objects['files/e'] = ['e']
+        client = listing_client(objects, 10)
+        conn = {'client' : client, 'bucket' : 'bucket'}
+
+        wanted = ['files/d/f001', 'files/d/f010', 'files/d/missing', 'files/e', 'files/d/sub/f']
+        latest = s3_interface.list_latest_versions(conn, wanted, 2)
+        self.assertEqual({k : v['VersionId'] for k, v in latest.items()},
+                         {'files/d/f001' : 'v1.2', 'files/d/f010' : 'v10.2', 'files/e' : 'e', 'files/d/sub/f' : 'nested'})
+
+        # a large directory with only a few wanted keys is not listed in full
+        client.requests = 0
+        latest = s3_interface.list_latest_versions(conn, ['files/d/f050', 'files/d/f090'], 2)
+        self.assertEqual({k : v['VersionId'] for k, v in latest.items()}, {'files/d/f050' : 'v50.2', 'files/d/f090' : 'v90.2'})
+        self.assertLessEqual(client.requests, 4)
+
+    def test_delete_versions(self):
+        batches = []; lock = threading.Lock()
+        class client:
+            def delete_objects(self, Bucket, Delete):
+                with lock: batches.append(len(Delete['Objects']))
+                return {'Errors' : [dict(o, Code = 'AccessDenied', Message = 'Access Denied')
+                                    for o in Delete['Objects'] if o['Key'] == 'files/denied']}
+
+        versions = [('files/f%d' % i, 'v%d' % i) for i in range(2500)] + [('files/denied', 'v')]
+        errors = s3_interface.delete_versions({'client' : client(), 'bucket' : 'bucket'}, versions, 3)
+        self.assertEqual(sorted(batches), [501, 1000, 1000])
+        self.assertEqual([(e['Key'], e['Code']) for e in errors], [('files/denied', 'AccessDenied')])
+
+    def test_iter_versions(self):
+        objects = {'files/f%02d' % i : ['b', 'a'] for i in range(15)}
+        client = listing_client(objects, 4)
+        versions = list(s3_interface.iter_versions({'client' : client, 'bucket' : 'bucket'}))
+        self.assertEqual([(v['Key'], v['VersionId']) for v in versions],
+                         [(key, version) for key in sorted(objects) for version in objects[key]])
+        self.assertEqual(client.requests, 8)
@@ -0,0 +1,114 @@
+import rrbackup.verify as verify
+import rrbackup.pipeline as pipeline
+import unittest, tempfile, shutil, os, struct, hashlib, pysodium
+
+def make_header(chunk_size, encrypt):
+    pl_format = {'version' : 1, 'chunk_size' : chunk_size, 'format' : {'encrypt' : {}} if encrypt else {}}
+    return pipeline.serialise_pipeline_format(pl_format)
+
+def make_object(data, header, key = None):
+    """ Stored form of 'data', as written by the streaming pipeline """
+    chunk_size = pipeline.parse_pipeline_format(header)['chunk_size']
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+    if key is None: body = b''.join(chunks)
+    else:
+        state, stream_header = pysodium.crypto_secretstream_xchacha20poly1305_init_push(key)
+        body = stream_header + b''.join(pysodium.crypto_secretstream_xchacha20poly1305_push(state, c, header, 0) for c in chunks)
+    return struct.pack('!I', len(header)) + header + body
+
+class test_verify(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_expected_stored_size(self):
+        key = pysodium.crypto_secretstream_xchacha20poly1305_keygen()
+        for size in [1, 99, 100, 101, 1000]:
+            data = os.urandom(size)
+            header = make_header(100, False)
+            self.assertEqual(verify.expected_stored_size(header, size), len(make_object(data, header)))
+            header = make_header(100, True)
+            self.assertEqual(verify.expected_stored_size(header, size), len(make_object(data, header, key)))
+
+    def test_check_sizes(self):
+        old = make_header(100, False); new = make_header(50, True)
+        objects = {('a', '1') : {'path' : '/a', 'size' : 10},
+                   ('b', '1') : {'path' : '/b', 'size' : 300},
+                   ('c', '1') : {'path' : '/c', 'size' : 300},
+                   ('d', '1') : {'path' : '/d'},
+                   ('e', '1') : {'path' : '/e', 'size' : 5}}
+        listing = [{'Key' : 'a', 'VersionId' : '1', 'Size' : verify.expected_stored_size(new, 10)},
+                   {'Key' : 'a', 'VersionId' : '0', 'Size' : 1},
+                   {'Key' : 'b', 'VersionId' : '1', 'Size' : verify.expected_stored_size(old, 300)},
+                   {'Key' : 'c', 'VersionId' : '1', 'Size' : verify.expected_stored_size(old, 299)},
+                   {'Key' : 'd', 'VersionId' : '1', 'Size' : 1}]
+        headers_read = []
+        def read_header(key, version_id):
+            headers_read.append(key); return old
+
+        problems = verify.check_sizes(objects, listing, lambda fle: new, read_header)
+        self.assertEqual(sorted(problems), [('missing', 'e', '1'), ('size mismatch', 'c', '1')])
+
+        # the stored header is only read when the size does not match the current configuration
+        self.assertEqual(headers_read, ['b', 'c'])
+
+    def test_read_stored_header(self):
+        header = make_header(100, True) + b' ' * 5000
+        obj = make_object(b'data', make_header(100, True))
+        obj = struct.pack('!I', len(header)) + header + obj
+        get_range = lambda key, version_id, first, last: obj[first : last + 1]
+        self.assertEqual(verify.read_stored_header(get_range, 'a', '1'), header)
+
+    def test_is_sampled(self):
+        objects = [('key' + str(i), 'v') for i in range(2000)]
+        sample = [obj for obj in objects if verify.is_sampled(obj[0], obj[1], 0.25)]
+        self.assertTrue(400 < len(sample) < 600)
+        self.assertEqual(sample, [obj for obj in objects if verify.is_sampled(obj[0], obj[1], 0.25)])
+        self.assertTrue(all(verify.is_sampled(obj[0], obj[1], 1) for obj in objects))
+
+    def test_check_hashes_resumes(self):
+        contents = {('k' + str(i), '1') : os.urandom(50) for i in range(10)}
+        objects = {obj : {'hash' : hashlib.sha256(data).hexdigest()} for obj, data in contents.items()}
+        objects[('k3', '1')]['hash'] = '0' * 64
+        path = os.path.join(self.tmp, 'checkpoint')
+        run = {'version_id' : 'v', 'sample' : 1.0}
+
+        fetched = []
+        def fetch_chunks(key, version_id):
+            fetched.append(key)
+            if key == 'k6': raise KeyboardInterrupt()
+            if key == 'k7': raise ValueError('object not found')
+            yield contents[(key, version_id)]
+
+        progress = verify.checkpoint(path, run)
+        with self.assertRaises(KeyboardInterrupt):
+            for res in verify.check_hashes({'verify_workers' : 1}, objects, fetch_chunks, progress): pass
+
+        progress = verify.checkpoint(path, run)
+        self.assertEqual(len(progress.done), 6)
+        self.assertEqual(progress.done[('k3', '1')], 'hash mismatch')
+
+        fetched.clear()
+        contents[('k6', '1')] = b'fixed'; objects[('k6', '1')]['hash'] = hashlib.sha256(b'fixed').hexdigest()
+        fetch_chunks_ok = lambda key, version_id: fetch_chunks(key, version_id) if key != 'k6' else iter([contents[(key, version_id)]])
+        results = list(verify.check_hashes({'verify_workers' : 3}, objects, fetch_chunks_ok, progress))
+        self.assertEqual([res[1] for res in results], ['k6', 'k7', 'k8', 'k9'])
+        self.assertEqual([res[0] for res in results], ['ok', 'unreadable', 'ok', 'ok'])
+        self.assertNotIn('k0', fetched)
+
+        progress.remove()
+        self.assertFalse(os.path.exists(path))
+
+        # a checkpoint of a different check is discarded
+        verify.checkpoint(path, run).record('k0', '1', 'ok')
+        self.assertEqual(verify.checkpoint(path, {'version_id' : 'w', 'sample' : 1.0}).done, {})
+
+    def test_stored_objects(self):
+        files = [{'path' : '/a', 'real_path' : '/a', 'version_id' : '1'},
+                 {'path' : '/b', 'real_path' : '/a', 'version_id' : '1'},
+                 {'path' : '/c', 'empty' : True}]
+        objects = verify.stored_objects(files, lambda fle: 'files' + fle['real_path'])
+        self.assertEqual(list(objects), [('files/a', '1')])
+        self.assertEqual(objects[('files/a', '1')]['path'], '/a')